@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import copy
+import json
+import time
+import base64
+from sharding import shard_for
+
+# 模板中每个用户不同的字段, 渲染骨架时用占位符代替
+USER_FIELDS = {
+    "id": "__V2RAY_USER_ID__",
+    "alterId": "__V2RAY_USER_AID__",
+    "email": "__V2RAY_USER_EMAIL__",
+}
+PLACEHOLDERS = {token: field for field, token in USER_FIELDS.items()}
+
+UUID_PATTERN = re.compile(r'^[0-9a-fA-F]{8}(-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12}$')
+
+# 格式 -> 输出文件名
+FORMAT_FILES = {
+    "vmess": "vmess_link.txt",
+    "clash": "clash.yaml",
+    "v2rayng": "v2rayng.json",
+    "surge": "surge.conf",
+}
+ALL_FORMATS = list(FORMAT_FILES)
+
+
+def json_value(value):
+    """JSON格式的字段值"""
+    return json.dumps(value, ensure_ascii=False)
+
+
+def yaml_value(value):
+    """YAML格式的字段值: UUID和整数与yaml.dump的输出一致, 其他字符串使用双引号"""
+    if isinstance(value, int) or UUID_PATTERN.match(str(value)):
+        return str(value)
+    return json.dumps(value)
+
+
+def text_value(value):
+    return str(value)
+
+
+class Template:
+    """由带占位符的渲染结果编译而成的模板, 渲染时只拼接各用户的字段"""
+
+    def __init__(self, text, quoted, escape):
+        # JSON中的占位符带引号, 替换时连同引号一起替换
+        tokens = "|".join(re.escape(token) for token in PLACEHOLDERS)
+        pattern = f'"({tokens})"' if quoted else f'({tokens})'
+        parts = re.split(pattern, text)
+        self.literals = parts[0::2]
+        self.fields = [PLACEHOLDERS[token] for token in parts[1::2]]
+        self.escape = escape
+
+    def render(self, user):
+        values = {field: self.escape(user[field]) for field in set(self.fields)}
+        out = [self.literals[0]]
+        for field, literal in zip(self.fields, self.literals[1:]):
+            out.append(values[field])
+            out.append(literal)
+        return "".join(out)
+
+
+def load_clients(config_file):
+    """读取服务端配置中第一个inbound的所有用户"""
+    with open(config_file, 'r') as f:
+        config = json.load(f)
+    return config["inbounds"][0]["settings"].get("clients", [])
+
+
+class BatchRenderer:
+    """批量渲染所有用户的客户端配置: 模板骨架只构建一次, 每个用户只填充不同的字段"""
+
+    def __init__(self, deployer, server_ip, formats=None):
+        self.server_ip = server_ip
+        # 只渲染当前传输方式支持的客户端格式
+        self.formats = [f for f in (formats or ALL_FORMATS) if f in deployer.client_formats()]
+        self.default_email = deployer.user_email
+        self.default_alter_id = deployer.alter_id
+        self.rendered = 0
+        self.elapsed = 0.0
+
+        # 多实例部署时各实例端口不同, 每个实例一套模板
+        self.instances = deployer.instances
+        self.shard_templates = [self.build_templates(deployer.client_view(shard), server_ip)
+                                for shard in deployer.shards()]
+        self.templates = self.shard_templates[0]
+
+    def build_templates(self, deployer, server_ip):
+        """用占位符代替用户字段, 用原有的生成函数渲染一次骨架"""
+        skeleton = copy.copy(deployer)
+        skeleton.user_uuid = USER_FIELDS["id"]
+        skeleton.alter_id = USER_FIELDS["alterId"]
+        skeleton.user_email = USER_FIELDS["email"]
+
+        templates = {}
+        if "vmess" in self.formats:
+            link = skeleton.generate_vmess_link(server_ip)
+            raw = base64.b64decode(link[len("vmess://"):]).decode()
+            templates["vmess"] = Template(raw, True, json.dumps)
+        if "clash" in self.formats:
+            templates["clash"] = Template(
+                skeleton.generate_clash_config(server_ip), False, yaml_value)
+        if "v2rayng" in self.formats:
+            templates["v2rayng"] = Template(
+                skeleton.generate_v2rayng_config(server_ip), True, json_value)
+        if "surge" in self.formats:
+            templates["surge"] = Template(
+                skeleton.generate_surge_config(server_ip), False, text_value)
+        return templates
+
+    def render_user(self, client):
+        """渲染单个用户的所有客户端配置"""
+        started = time.perf_counter()
+        user = {
+            "id": client["id"],
+            "alterId": client.get("alterId", self.default_alter_id),
+            "email": client.get("email", self.default_email)
+        }
+        templates = self.templates
+        if self.instances > 1:
+            templates = self.shard_templates[shard_for(user["id"], self.instances)]
+        result = {}
+        for name, template in templates.items():
+            text = template.render(user)
+            if name == "vmess":
+                text = "vmess://" + base64.b64encode(text.encode()).decode()
+            result[name] = text
+        self.rendered += 1
+        self.elapsed += time.perf_counter() - started
+        return result
+
+    def render(self, clients):
+        """逐个生成 (用户, 配置), 不在内存中保留全部结果"""
+        for client in clients:
+            yield client, self.render_user(client)
+
+    def users_per_second(self):
+        return self.rendered / self.elapsed if self.elapsed else 0.0
+
+    def report(self):
+        print(f"已渲染 {self.rendered} 个用户, 耗时 {self.elapsed:.2f}s, "
+              f"{self.users_per_second():.0f} 用户/秒")
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""manage.py 各操作的冷启动/热启动耗时测试
+
+冷启动: 项目模块没有可用的字节码缓存, 每次运行都重新编译
+热启动: 字节码缓存已生成后的重复运行
+zipapp内置预编译字节码, 作为对照; 冷启动时每次运行新复制的压缩包
+
+manage.py 非root运行时在权限检查处直接退出, 因此通过引导代码把os.geteuid替换为返回0后再运行,
+并在PATH前加入空的systemctl脚本, 测试不会重启本机的服务
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import build_zipapp
+
+ACTIONS = [
+    ["status"],
+    ["list-users"],
+    ["config"],
+    ["add-user", "--email", "bench@example.com"],
+    ["remove-user", "--uuid", "00000000-0000-0000-0000-000000000000"],
+    ["change-port", "--port", "10087"],
+    ["logs", "--lines", "1"],
+]
+
+
+# 跳过manage.py的root检查后运行argv[1]指定的脚本或zipapp
+BOOTSTRAP = """
+import os, sys, runpy
+os.geteuid = lambda: 0
+sys.argv = sys.argv[1:]
+if not sys.argv[0].endswith(".pyz"):
+    sys.path.insert(0, os.path.dirname(sys.argv[0]))
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+def write_config(path):
+    config = {
+        "inbounds": [{
+            "port": 10086,
+            "protocol": "vmess",
+            "settings": {"clients": [{"id": "11111111-1111-1111-1111-111111111111", "alterId": 0}]}
+        }],
+        "outbounds": [{"protocol": "freedom", "settings": {}}]
+    }
+    with open(path, 'w') as f:
+        json.dump(config, f)
+
+
+def timed_run(cmd):
+    started = time.perf_counter()
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (time.perf_counter() - started) * 1000
+
+
+def write_stubs(bin_dir):
+    """PATH中代替systemctl的空脚本"""
+    os.makedirs(bin_dir)
+    path = os.path.join(bin_dir, "systemctl")
+    with open(path, 'w') as f:
+        f.write("#!/bin/sh\nexit 0\n")
+    os.chmod(path, 0o755)
+
+
+def copy_sources(target_dir):
+    """复制项目模块到新目录 (不带__pycache__)"""
+    shutil.rmtree(target_dir, ignore_errors=True)
+    os.makedirs(target_dir)
+    for module in build_zipapp.find_modules():
+        shutil.copy(os.path.join(ROOT, module), target_dir)
+    return os.path.join(target_dir, "manage.py")
+
+
+def measure(make_cmd, runs, cold):
+    """返回多次运行的耗时中位数 (毫秒); make_cmd(fresh) 返回要运行的命令"""
+    samples = []
+    cmd = make_cmd(True)
+    for _ in range(runs + 1):
+        samples.append(timed_run(cmd))
+        if cold:
+            cmd = make_cmd(True)
+    # 丢弃第一次运行 (热启动时用于生成缓存)
+    return statistics.median(samples[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='manage.py 启动耗时测试')
+    parser.add_argument('--runs', type=int, default=10, help='每项测试的运行次数')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        config_file = os.path.join(work_dir, "config.json")
+        zipapp_path = build_zipapp.build(os.path.join(work_dir, "dist"))[0]
+        source_dir = os.path.join(work_dir, "src")
+        fresh_zipapp = os.path.join(work_dir, "fresh", os.path.basename(zipapp_path))
+        bin_dir = os.path.join(work_dir, "bin")
+        write_stubs(bin_dir)
+        os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+
+        def source_cmd(fresh):
+            script = copy_sources(source_dir) if fresh else os.path.join(source_dir, "manage.py")
+            return [sys.executable, "-c", BOOTSTRAP, script]
+
+        def zipapp_cmd(fresh):
+            if fresh:
+                os.makedirs(os.path.dirname(fresh_zipapp), exist_ok=True)
+                shutil.copy(zipapp_path, fresh_zipapp)
+            return [sys.executable, "-c", BOOTSTRAP, fresh_zipapp]
+
+        baseline = measure(lambda fresh: [sys.executable, "-c", "pass"], args.runs, False)
+        print(f"Python解释器空启动: {baseline:.1f} ms")
+        print("manage.py 的root检查已跳过 (os.geteuid替换为返回0), systemctl由空脚本代替")
+        print(f"{'操作':<14} {'源码冷启动':>10} {'源码热启动':>10} {'zipapp冷':>10} {'zipapp热':>10}")
+        print("-" * 60)
+
+        for action in ACTIONS:
+            args_tail = action + ["--config", config_file]
+            row = []
+            for make_cmd in (source_cmd, zipapp_cmd):
+                for cold in (True, False):
+                    write_config(config_file)
+                    row.append(measure(lambda fresh: make_cmd(fresh) + args_tail,
+                                       args.runs, cold))
+            print(f"{action[0]:<14} " + " ".join(f"{ms:>10.1f}" for ms in row))
+        print("单位: ms (中位数)")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
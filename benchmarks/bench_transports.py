@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""各传输方式的本机回环握手延迟测试
+
+对每种传输方式, 用部署脚本生成服务端配置和V2RayNG客户端配置, 在本机启动两个v2ray进程,
+经客户端的socks入站反复建立新连接访问本机的HTTP服务, 统计从建立连接到收到首字节的耗时
+需要已安装的v2ray程序; h2传输需要 --tls-cert/--tls-key 提供证书
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import struct
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from deploy_v2ray import V2rayDeployer
+from transport import TRANSPORTS
+
+
+class TargetHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def socks_request(proxy_port, target_port):
+    """经socks5代理发送一个HTTP请求, 返回从建立连接到收到首字节的耗时 (毫秒)"""
+    started = time.perf_counter()
+    with socket.create_connection(("127.0.0.1", proxy_port), timeout=10) as sock:
+        sock.sendall(b"\x05\x01\x00")
+        if sock.recv(2) != b"\x05\x00":
+            raise RuntimeError("socks握手失败")
+        sock.sendall(b"\x05\x01\x00\x01" + socket.inet_aton("127.0.0.1") + struct.pack(">H", target_port))
+        reply = sock.recv(10)
+        if len(reply) < 2 or reply[1] != 0:
+            raise RuntimeError("socks连接失败")
+        sock.sendall(b"GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n")
+        if not sock.recv(1):
+            raise RuntimeError("未收到响应")
+        elapsed = (time.perf_counter() - started) * 1000
+        while sock.recv(4096):
+            pass
+    return elapsed
+
+
+def write_configs(work_dir, name, args):
+    """生成服务端和客户端配置, 返回 (服务端配置路径, 客户端配置路径, socks端口)"""
+    deployer = V2rayDeployer()
+    deployer.transport = name
+    deployer.port = free_port()
+    deployer.log_dir = work_dir
+    deployer.mux_concurrency = args.mux
+    if args.tls_cert:
+        deployer.tls_domain = args.tls_domain
+        deployer.tls_cert_file = args.tls_cert
+        deployer.tls_key_file = args.tls_key
+
+    server = json.loads(deployer.render_config())
+    server["log"] = {"access": "none", "loglevel": "error"}
+
+    client = json.loads(deployer.generate_v2rayng_config("127.0.0.1"))
+    socks_port = free_port()
+    client["log"] = {"access": "none", "loglevel": "error"}
+    client["inbounds"] = [dict(client["inbounds"][0], port=socks_port)]
+    tls = client["outbounds"][0]["streamSettings"].get("tlsSettings")
+    if tls:
+        # 测试证书通常是自签名的
+        tls["allowInsecure"] = True
+
+    paths = []
+    for role, config in (("server", server), ("client", client)):
+        path = os.path.join(work_dir, f"{name}-{role}.json")
+        with open(path, 'w') as f:
+            json.dump(config, f, indent=2)
+        paths.append(path)
+    return paths[0], paths[1], socks_port
+
+
+def bench_transport(name, args, work_dir, target_port):
+    """返回 (首个连接耗时, 后续连接中位数, 后续连接p95)"""
+    server_file, client_file, socks_port = write_configs(work_dir, name, args)
+    processes = [subprocess.Popen([args.v2ray, "run", "-config", path],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                 for path in (server_file, client_file)]
+    try:
+        if not wait_for_port(socks_port):
+            raise RuntimeError("v2ray未能启动")
+        samples = [socks_request(socks_port, target_port) for _ in range(args.requests + 1)]
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+    rest = sorted(samples[1:])
+    return samples[0], statistics.median(rest), rest[int(len(rest) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='各传输方式的本机回环握手延迟测试')
+    parser.add_argument('--v2ray', default='/usr/local/v2ray/v2ray', help='v2ray程序路径')
+    parser.add_argument('--requests', type=int, default=50, help='每种传输方式的连接数')
+    parser.add_argument('--transports', nargs='+', choices=list(TRANSPORTS),
+                        default=list(TRANSPORTS), help='要测试的传输方式')
+    parser.add_argument('--mux', type=int, help='客户端多路复用并发数 (默认由传输方式决定)')
+    parser.add_argument('--tls-cert', help='TLS证书 (开启后所有传输方式都使用TLS)')
+    parser.add_argument('--tls-key', help='TLS私钥')
+    parser.add_argument('--tls-domain', default='localhost', help='证书中的域名')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.v2ray):
+        print(f"未找到v2ray程序: {args.v2ray}, 请使用 --v2ray 指定")
+        sys.exit(1)
+
+    target = ThreadingHTTPServer(("127.0.0.1", 0), TargetHandler)
+    threading.Thread(target=target.serve_forever, daemon=True).start()
+    work_dir = tempfile.mkdtemp()
+
+    print(f"{'传输方式':<10} {'首个连接':>10} {'中位数':>10} {'p95':>10}")
+    print("-" * 45)
+    try:
+        for name in args.transports:
+            if TRANSPORTS[name].get("requires_tls") and not args.tls_cert:
+                print(f"{name:<10} 跳过 (需要 --tls-cert/--tls-key)")
+                continue
+            try:
+                first, median, p95 = bench_transport(name, args, work_dir, target.server_address[1])
+            except Exception as e:
+                print(f"{name:<10} 失败: {e}")
+                continue
+            print(f"{name:<10} {first:>10.2f} {median:>10.2f} {p95:>10.2f}")
+        print("单位: ms (从建立连接到收到首字节)")
+    finally:
+        target.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""用户库测试
+
+在不同用户数下比较直接修改config.json (解析、线性扫描、整体重写) 与使用SQLite用户库的
+添加、删除和查找用户耗时; 使用用户库时添加和删除仍需渲染config.json, 查找和不存在的删除不需要
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from manage import V2rayManager
+
+
+def write_config(path, count):
+    clients = [{"id": str(uuid.uuid4()), "alterId": 0, "email": f"user{i}@example.com"}
+               for i in range(count)]
+    config = {"inbounds": [{"port": 10086, "protocol": "vmess", "settings": {"clients": clients}}],
+              "outbounds": [{"protocol": "freedom", "settings": {}}]}
+    with open(path, 'w') as f:
+        json.dump(config, f, indent=2)
+    return clients
+
+
+def legacy_add(path):
+    """原来的add_user: 解析配置, 追加用户, 整体重写"""
+    with open(path) as f:
+        config = json.load(f)
+    config["inbounds"][0]["settings"]["clients"].append({"id": str(uuid.uuid4()), "alterId": 0})
+    with open(path, 'w') as f:
+        json.dump(config, f, indent=2, ensure_ascii=False)
+
+
+def legacy_remove(path, user_id):
+    """原来的remove_user: 解析配置, 重建clients列表, 找到时整体重写"""
+    with open(path) as f:
+        config = json.load(f)
+    clients = config["inbounds"][0]["settings"]["clients"]
+    remaining = [c for c in clients if c["id"] != user_id]
+    if len(remaining) < len(clients):
+        config["inbounds"][0]["settings"]["clients"] = remaining
+        with open(path, 'w') as f:
+            json.dump(config, f, indent=2, ensure_ascii=False)
+
+
+def legacy_find(path, email):
+    with open(path) as f:
+        config = json.load(f)
+    return [c for c in config["inbounds"][0]["settings"]["clients"] if c.get("email") == email]
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(None):
+        func(*args)
+    return (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='用户库测试')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='用户数')
+    args = parser.parse_args()
+
+    print(f"{'用户数':>8} {'方式':<8} {'迁移':>10} {'添加':>10} {'删除':>10} "
+          f"{'删除(不存在)':>12} {'按email查找':>12}")
+    print("-" * 80)
+    for size in args.sizes:
+        test_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(test_dir, "config.json")
+            clients = write_config(path, size)
+            victim, missing = clients[size // 2]["id"], str(uuid.uuid4())
+            email = clients[-1]["email"]
+            print(f"{size:>8} {'config':<8} {'-':>10} {timed(legacy_add, path):>8.1f}ms "
+                  f"{timed(legacy_remove, path, victim):>8.1f}ms "
+                  f"{timed(legacy_remove, path, missing):>10.1f}ms "
+                  f"{timed(legacy_find, path, email):>10.1f}ms")
+
+            write_config(path, size)
+            manager = V2rayManager(path)
+            migrate = timed(manager.user_store)
+            store = manager.user_store()
+            victim = store.users()[size // 2][1]["id"]
+            email = f"user{size - 1}@example.com"
+            print(f"{'':>8} {'sqlite':<8} {migrate:>8.1f}ms {timed(manager.add_user):>8.1f}ms "
+                  f"{timed(manager.remove_user, victim):>8.1f}ms "
+                  f"{timed(manager.remove_user, missing):>10.1f}ms "
+                  f"{timed(store.find_email, email):>10.1f}ms")
+            store.close()
+        finally:
+            shutil.rmtree(test_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,41 +5,273 @@ import os
 import sys
 import json
 import uuid
+import io
+import hashlib
 import base64
-import urllib.request
-import tarfile
-import zipfile
 import subprocess
+import argparse
 import platform
 import socket
-from pathlib import Path
-import yaml
+import ipaddress
+import time
+import copy
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from downloader import (ArtifactCache, MirrorSelector, RangedDownloader,
+                        DEFAULT_CACHE_SIZE, DEFAULT_MIRRORS, DEFAULT_WORKERS,
+                        extract_members, parse_dgst, sha256_file)
+from pipeline import StageGraph
+from tuning import DEFAULT_PROFILE, PROFILES, apply_profile, validate_config
+from stats import DEFAULT_API_PORT, enable_stats
+from routing import DEFAULT_DOMAIN_STRATEGY, ROUTE_POLICIES, apply_routing, compile_route_set
+from transport import DEFAULT_TRANSPORT, KCP_SETTINGS, TCP_HTTP_SETTINGS, TRANSPORTS, get_transport
+from sharding import (TEMPLATE_UNIT, cpu_affinity_for, instance_config_file,
+                      instance_name, shard_for, unit_name)
+
+# Clash默认分流规则
+DEFAULT_CLASH_RULES = [
+    "DOMAIN-SUFFIX,google.com,Proxy",
+    "DOMAIN-SUFFIX,youtube.com,Proxy",
+    "DOMAIN-SUFFIX,github.com,Proxy",
+    "DOMAIN-SUFFIX,twitter.com,Proxy",
+    "DOMAIN-SUFFIX,facebook.com,Proxy",
+    "GEOIP,CN,DIRECT",
+    "MATCH,Proxy"
+]
+
+# 已序列化的静态YAML段落, 进程内复用
+_yaml_section_cache = {}
+YAML_SECTION_CACHE_SIZE = 32
+
+def dump_yaml(data, fast=True, static_keys=()):
+    """序列化YAML, 输出与yaml.dump一致
+    
+    fast为True时优先使用C实现的Dumper, static_keys中的顶层段落 (例如dns、rules)
+    每个进程只序列化一次, 之后直接拼接
+    """
+    # yaml、zipfile、urllib等较重的模块只在用到的函数中导入, 以加快脚本启动
+    import yaml
+    if not fast:
+        return yaml.dump(data, allow_unicode=True, default_flow_style=False)
+    
+    dumper = getattr(yaml, "CDumper", yaml.Dumper)
+    
+    def dump(section):
+        return yaml.dump(section, Dumper=dumper, allow_unicode=True, default_flow_style=False)
+    
+    # yaml.dump按键名排序输出顶层段落, 逐段拼接的结果与整体序列化相同
+    parts = []
+    dynamic = {}
+    for key in sorted(data):
+        if key not in static_keys:
+            dynamic[key] = data[key]
+            continue
+        if dynamic:
+            parts.append(dump(dynamic))
+            dynamic = {}
+        section = {key: data[key]}
+        cache_key = json.dumps(section, sort_keys=True)
+        text = _yaml_section_cache.get(cache_key)
+        if text is None:
+            if len(_yaml_section_cache) >= YAML_SECTION_CACHE_SIZE:
+                _yaml_section_cache.clear()
+            text = _yaml_section_cache[cache_key] = dump(section)
+        parts.append(text)
+    if dynamic:
+        parts.append(dump(dynamic))
+    return "".join(parts)
 
 class V2rayDeployer:
-    def __init__(self):
+    def __init__(self, root="/"):
+        # 目标根目录: 非 "/" 时安装、配置和服务文件都写到该前缀下 (用于批量部署)
+        self.root = root
         self.v2ray_version = "v5.20.0"
         self.install_dir = "/usr/local/v2ray"
         self.config_dir = "/etc/v2ray"
         self.log_dir = "/var/log/v2ray"
         self.config_file = f"{self.config_dir}/config.json"
         self.service_file = "/etc/systemd/system/v2ray.service"
+        self.client_configs_dir = "client_configs"
+        # 批量写入配置文件的线程数
+        self.write_workers = 8
+        # 服务管理命令前缀, 例如 ["docker", "exec", "box1"]; manage_service为False时不启动服务
+        self.service_command = []
+        self.manage_service = True
+        self.cache_dir = "/var/cache/v2ray"
+        self.cache_max_bytes = DEFAULT_CACHE_SIZE
+        self.download_workers = DEFAULT_WORKERS
+        # 下载源列表, 可通过环境变量 V2RAY_MIRRORS (逗号分隔) 覆盖
+        mirrors = os.environ.get("V2RAY_MIRRORS")
+        self.mirrors = mirrors.split(",") if mirrors else list(DEFAULT_MIRRORS)
         
         # 生成随机UUID作为用户ID
         self.user_uuid = str(uuid.uuid4())
         self.port = 10086
         self.alter_id = 0
+        # 客户端配置中的用户邮箱 (V2RayNG用于区分用户)
+        self.user_email = "t@t.tt"
         
-    def get_public_ip(self):
-        """获取服务器公网IP"""
+        # Clash分流规则; clash_fast_yaml为False时使用纯Python的yaml.dump
+        self.clash_rules = list(DEFAULT_CLASH_RULES)
+        self.clash_fast_yaml = True
+        
+        # 规则列表: [{"name": 名称, "files": [列表文件], "policy": 策略}], 编译为Clash rule-provider
+        # 和Surge规则集文件, 保存在客户端配置目录的rules/下; 设置rule_base_url后客户端从该地址下载
+        self.rule_sets = []
+        self.rule_base_url = None
+        self._compiled_rules = {}
+        
+        # 服务端路由: [{"name": 名称, "files": [列表文件], "policy": "block"|"direct"}],
+        # 编译为routing.rules, block转到blackhole出站; 列表中可使用geosite:/geoip:引用
+        self.route_sets = []
+        self.domain_strategy = DEFAULT_DOMAIN_STRATEGY
+        self._compiled_routes = {}
+        
+        # 公网IP探测: 并发查询以下接口及本机网卡, 结果缓存在磁盘上
+        self.ip_endpoints = [
+            "https://ipinfo.io/ip",
+            "https://api.ipify.org",
+            "https://ifconfig.me/ip",
+            "https://icanhazip.com"
+        ]
+        self.ip_use_interfaces = True
+        self.ip_quorum = 2
+        self.ip_timeout = 5
+        self.ip_cache_ttl = 3600
+        
+        # 部署阶段超时时间 (秒)
+        self.stage_timeouts = {
+            "install": 600,
+            "public_ip": 30,
+            "config": 30,
+            "service": 30,
+            "start": 120,
+            "client_configs": 60
+        }
+        
+        # 增量部署: 沿用上次的UUID, 只执行输入有变化的阶段
+        self.incremental = True
+        self.deploy_state = {}
+        
+        # 服务端性能配置, 见tuning.PROFILES
+        self.tuning_profile = DEFAULT_PROFILE
+        
+        # 多实例部署: instances大于1时按用户UUID分片到 v2ray@shard<i>, 实例i使用端口 port+i
+        # cpu_affinity: None 不绑定, "auto" 按实例序号轮流绑定CPU, 或每个实例的CPU列表
+        self.instances = 1
+        self.cpu_affinity = None
+        
+        # 传输方式, 见transport.TRANSPORTS; mux_concurrency为None时使用传输方式的默认值, 0表示关闭
+        self.transport = DEFAULT_TRANSPORT
+        self.transport_path = "/ray"
+        self.grpc_service_name = "v2ray"
+        self.kcp_seed = None
+        self.mux_concurrency = None
+        # TLS: 设置tls_domain后服务端使用以下证书, 客户端按该域名校验 (h2传输必须开启)
+        self.tls_domain = None
+        self.tls_cert_file = "/etc/v2ray/tls.crt"
+        self.tls_key_file = "/etc/v2ray/tls.key"
+        
+        # 流量统计: 开启stats和只监听127.0.0.1的api入站, 用户按email统计
+        # 多实例时实例i的api端口为 api_port-i (实例端口向上递增, 默认设置下不会冲突)
+        self.enable_stats = False
+        self.api_port = DEFAULT_API_PORT
+        
+        # 安装模式: stream 只解压需要的文件且压缩包不落盘, full 解压全部文件
+        self.install_mode = "stream"
+        self.install_geodata = True
+        
+    def host_path(self, path):
+        """将目标机上的路径映射为本机路径"""
+        if not self.root or self.root == "/":
+            return path
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def _query_ip_endpoint(self, url):
+        """从HTTP接口查询公网IP"""
+        import urllib.request
+        response = urllib.request.urlopen(url, timeout=self.ip_timeout)
+        return str(ipaddress.ip_address(response.read().decode().strip()))
+
+    def _query_local_interface(self):
+        """从本机出口网卡获取公网IP (NAT环境下为内网地址, 不采用)"""
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            # UDP connect不会发送数据包, 只用于确定出口网卡
+            s.connect(("8.8.8.8", 80))
+            address = ipaddress.ip_address(s.getsockname()[0])
+        if not address.is_global:
+            raise ValueError(f"出口网卡地址不是公网地址: {address}")
+        return str(address)
+
+    def _ip_cache_file(self):
+        return os.path.join(self.cache_dir, "public_ip.json") if self.cache_dir else None
+
+    def _load_cached_ip(self):
+        cache_file = self._ip_cache_file()
         try:
-            response = urllib.request.urlopen('https://ipinfo.io/ip', timeout=10)
-            return response.read().decode().strip()
-        except:
-            try:
-                response = urllib.request.urlopen('https://api.ipify.org', timeout=10)
-                return response.read().decode().strip()
-            except:
-                return "YOUR_SERVER_IP"
+            with open(cache_file, 'r') as f:
+                cached = json.load(f)
+            if time.time() - cached["time"] < self.ip_cache_ttl:
+                return cached["ip"]
+        except (TypeError, OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def _save_cached_ip(self, ip):
+        cache_file = self._ip_cache_file()
+        if not cache_file:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(f"{cache_file}.tmp", 'w') as f:
+                json.dump({"ip": ip, "time": time.time()}, f)
+            os.replace(f"{cache_file}.tmp", cache_file)
+        except OSError:
+            pass
+
+    def discover_public_ip(self):
+        """并发查询所有探测方式, 返回第一个得到足够多一致结果的IP"""
+        backends = [lambda url=url: self._query_ip_endpoint(url) for url in self.ip_endpoints]
+        if self.ip_use_interfaces:
+            backends.append(self._query_local_interface)
+        if not backends:
+            return None
+        
+        quorum = min(self.ip_quorum, len(backends))
+        votes = Counter()
+        pool = ThreadPoolExecutor(max_workers=len(backends))
+        futures = [pool.submit(backend) for backend in backends]
+        try:
+            for future in as_completed(futures, timeout=self.ip_timeout + 1):
+                try:
+                    ip = future.result()
+                except Exception:
+                    continue
+                votes[ip] += 1
+                if votes[ip] >= quorum:
+                    return ip
+        except Exception:
+            # 超时后使用已得到的结果
+            pass
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+        
+        if votes:
+            return votes.most_common(1)[0][0]
+        return None
+
+    def get_public_ip(self, refresh=False):
+        """获取服务器公网IP"""
+        if not refresh:
+            cached = self._load_cached_ip()
+            if cached:
+                return cached
+        
+        ip = self.discover_public_ip()
+        if ip:
+            self._save_cached_ip(ip)
+            return ip
+        return "YOUR_SERVER_IP"
 
     def detect_architecture(self):
         """检测系统架构"""
@@ -53,92 +285,257 @@ class V2rayDeployer:
         else:
             raise Exception(f"不支持的架构: {arch}")
 
-    def download_v2ray(self):
-        """下载v2ray核心文件"""
+    def get_artifact_cache(self):
+        """获取制品缓存 (cache_dir为空时禁用缓存)"""
+        if not self.cache_dir:
+            return None
+        return ArtifactCache(self.cache_dir, self.cache_max_bytes)
+
+    def get_mirror_selector(self):
+        """获取下载源选择器, 最快的源记录在缓存目录中"""
+        state_file = os.path.join(self.cache_dir, "mirrors.json") if self.cache_dir else None
+        return MirrorSelector(self.mirrors, state_file)
+
+    def fetch_release_digest(self, urls):
+        """并发从所有下载源获取release文件的sha256摘要, 返回最先得到的结果, 都失败时返回None"""
+        import urllib.request
+
+        def fetch(url):
+            try:
+                with urllib.request.urlopen(f"{url}.dgst", timeout=10) as response:
+                    return parse_dgst(response.read().decode())
+            except Exception:
+                return None
+
+        urls = list(urls)
+        if not urls:
+            return None
+        pool = ThreadPoolExecutor(max_workers=len(urls))
+        try:
+            for future in as_completed([pool.submit(fetch, url) for url in urls]):
+                sha256 = future.result()
+                if sha256:
+                    return sha256
+            return None
+        finally:
+            # 不等待不可达的源超时
+            pool.shutdown(wait=False)
+
+    def download_v2ray(self, to_memory=False):
+        """下载v2ray核心文件 (to_memory为True时返回内存中的压缩包)"""
         arch = self.detect_architecture()
         filename = f"v2ray-{arch}.zip"
         url = f"https://github.com/v2fly/v2ray-core/releases/download/{self.v2ray_version}/{filename}"
         
+        selector = self.get_mirror_selector()
+        cache = self.get_artifact_cache()
+        
+        expected_sha256 = self.fetch_release_digest(selector.candidates(url))
+        if not expected_sha256:
+            print("未能获取release摘要, 仅使用缓存记录校验")
+        
+        if cache:
+            cached = cache.lookup(self.v2ray_version, arch, expected_sha256)
+            if cached:
+                print(f"使用已校验的缓存文件: {cached}")
+                return cached
+        
         print(f"正在下载v2ray {self.v2ray_version} for {arch}...")
         
-        try:
-            urllib.request.urlretrieve(url, filename)
-            print("下载完成!")
-            return filename
-        except Exception as e:
-            print(f"下载失败: {e}")
-            print("尝试使用镜像源...")
-            mirror_url = f"https://ghproxy.com/{url}"
-            urllib.request.urlretrieve(mirror_url, filename)
-            print("镜像源下载完成!")
-            return filename
+        # 并发探测所有下载源, 按速度依次尝试
+        downloader = RangedDownloader(workers=self.download_workers)
+        partial = {}
+        last_error = None
+        for source_url in selector.select(url):
+            try:
+                started = time.time()
+                if to_memory:
+                    data = downloader.fetch_bytes(source_url, partial)
+                    size = len(data)
+                    # 完整下载后不再续传, 摘要不符时换源重新下载
+                    partial.clear()
+                    self._verify_digest(data, expected_sha256, filename)
+                else:
+                    downloader.download(source_url, filename)
+                    size = os.path.getsize(filename)
+                # 续传时size包含之前下载的部分, 带宽偏高, 只会少触发重新探测
+                selector.record_success(url, source_url, size / max(time.time() - started, 1e-6))
+                print(f"下载完成! ({source_url})")
+                break
+            except Exception as e:
+                # 已完成的分段保留在.part文件 (或内存中的partial) 中, 换源后继续续传
+                print(f"下载失败: {e}")
+                last_error = e
+        else:
+            raise Exception(f"所有下载源均失败: {last_error}")
+        
+        if to_memory:
+            if not cache:
+                return io.BytesIO(data)
+            # 启用缓存时压缩包本来就需要持久化, 直接写入缓存目录
+            os.makedirs(cache.cache_dir, exist_ok=True)
+            filename = os.path.join(cache.cache_dir, f"{filename}.download")
+            with open(filename, 'wb') as f:
+                f.write(data)
+        elif expected_sha256 and sha256_file(filename) != expected_sha256:
+            os.remove(filename)
+            raise Exception(f"{filename} sha256校验失败")
+        
+        if cache:
+            return cache.store(self.v2ray_version, arch, filename, expected_sha256)
+        return filename
+
+    def _verify_digest(self, data, expected_sha256, filename):
+        """校验内存中压缩包的sha256"""
+        if expected_sha256 and hashlib.sha256(data).hexdigest() != expected_sha256:
+            raise Exception(f"{filename} sha256校验失败")
 
-    def install_v2ray(self):
-        """安装v2ray"""
-        filename = self.download_v2ray()
+    def install_v2ray(self, archive=None):
+        """安装v2ray (archive为已下载的压缩包时不再下载)"""
+        install_dir = self.host_path(self.install_dir)
         
         # 创建目录
-        os.makedirs(self.install_dir, exist_ok=True)
-        os.makedirs(self.config_dir, exist_ok=True)
-        os.makedirs(self.log_dir, exist_ok=True)
+        os.makedirs(install_dir, exist_ok=True)
+        os.makedirs(self.host_path(self.config_dir), exist_ok=True)
+        os.makedirs(self.host_path(self.log_dir), exist_ok=True)
+        
+        if self.install_mode == "stream":
+            if archive is None:
+                archive = self.download_v2ray(to_memory=True)
+            optional = ["geoip.dat", "geosite.dat"] if self.install_geodata else []
+            print("正在解压v2ray...")
+            digests = extract_members(archive, install_dir, ["v2ray"], optional)
+            os.chmod(os.path.join(install_dir, 'v2ray'), 0o755)
+            for name, digest in digests.items():
+                print(f"  {name}: sha256 {digest}")
+            print(f"v2ray已安装到: {install_dir}")
+            return digests
+        
+        import zipfile
+        filename = archive if archive is not None else self.download_v2ray()
         
         # 解压文件
         print("正在解压v2ray...")
         with zipfile.ZipFile(filename, 'r') as zip_ref:
-            zip_ref.extractall(self.install_dir)
+            zip_ref.extractall(install_dir)
         
         # 设置执行权限
-        v2ray_bin = os.path.join(self.install_dir, 'v2ray')
+        v2ray_bin = os.path.join(install_dir, 'v2ray')
         os.chmod(v2ray_bin, 0o755)
         
-        # 删除下载的压缩包
-        os.remove(filename)
+        # 删除下载的压缩包 (缓存中的文件和外部传入的压缩包保留)
+        cache = self.get_artifact_cache()
+        if archive is None and (not cache or not cache.owns(filename)):
+            os.remove(filename)
         
-        print(f"v2ray已安装到: {self.install_dir}")
+        print(f"v2ray已安装到: {install_dir}")
+
+    def shards(self):
+        """所有实例的分片序号, 单实例部署时为 [None]"""
+        return list(range(self.instances)) if self.instances > 1 else [None]
+
+    def instance_port(self, shard=None):
+        return self.port if shard is None else self.port + shard
+
+    def instance_config_file(self, shard=None):
+        if shard is None:
+            return self.config_file
+        return instance_config_file(self.config_dir, shard)
+
+    def instance_api_port(self, shard=None):
+        return self.api_port if shard is None else self.api_port - shard
+
+    def instance_log_dir(self, shard=None):
+        if shard is None:
+            return self.log_dir
+        return f"{self.log_dir}/{instance_name(shard)}"
+
+    def user_shard(self):
+        """当前用户所在的实例, 单实例部署时为None"""
+        return shard_for(self.user_uuid, self.instances) if self.instances > 1 else None
+
+    def service_units(self):
+        return [unit_name("v2ray", shard) for shard in self.shards()]
 
     def generate_config(self):
-        """生成v2ray配置文件"""
+        """生成v2ray配置文件 (多实例时每个实例一个), 内容未变化时不重写, 返回是否有变化"""
+        changed = False
+        for shard in self.shards():
+            config_file = self.host_path(self.instance_config_file(shard))
+            os.makedirs(os.path.dirname(config_file), exist_ok=True)
+            os.makedirs(self.host_path(self.instance_log_dir(shard)), exist_ok=True)
+            content = self.render_config(shard)
+            validate_config(json.loads(content), self.tuning_profile)
+            self.register_user(shard)
+            if not self.write_if_changed(config_file, content):
+                print(f"配置文件未变化: {config_file}")
+                continue
+            print(f"配置文件已生成: {config_file}")
+            changed = True
+        return changed
+
+    def user_db(self):
+        """manage.py的用户库, 存在时是已部署用户的唯一来源"""
+        return self.host_path(os.path.join(self.config_dir, "users.db"))
+
+    def existing_clients(self, shard=None):
+        """已部署实例的用户 (包括manage.py添加的用户), 优先读取用户库, 没有时读取现有配置文件"""
+        if os.path.exists(self.user_db()):
+            from user_store import UserStore
+            store = UserStore(self.user_db())
+            try:
+                return store.clients(shard)
+            finally:
+                store.close()
+        try:
+            with open(self.host_path(self.instance_config_file(shard)), 'r') as f:
+                return json.load(f)["inbounds"][0]["settings"]["clients"]
+        except (OSError, ValueError, KeyError, IndexError, TypeError):
+            return []
+
+    def register_user(self, shard=None):
+        """用户库存在时把部署的用户写入用户库, 否则manage.py下次按用户库渲染时会删掉该用户"""
+        if not os.path.exists(self.user_db()) or (shard is not None and self.user_shard() != shard):
+            return
+        from user_store import UserStore
+        store = UserStore(self.user_db())
+        try:
+            store.import_clients([self.render_user()], shard)
+        finally:
+            store.close()
+
+    def render_user(self):
+        """部署的用户 (第一个用户)"""
+        client = {"id": self.user_uuid, "alterId": self.alter_id}
+        if self.enable_stats:
+            client["email"] = self.user_email
+        return client
+
+    def render_config(self, shard=None):
+        """渲染v2ray服务端配置 (shard为实例序号时只包含分到该实例的用户)"""
+        log_dir = self.instance_log_dir(shard)
+        # 重新部署时保留已有的用户, 只合并部署的用户
+        clients = self.existing_clients(shard)
+        if shard is None or self.user_shard() == shard:
+            own = next((c for c in clients if c.get("id", "").lower() == self.user_uuid.lower()), None)
+            if own is None:
+                clients.insert(0, self.render_user())
+            elif self.enable_stats:
+                own.setdefault("email", self.user_email)
         config = {
             "log": {
-                "access": f"{self.log_dir}/access.log",
-                "error": f"{self.log_dir}/error.log",
+                "access": f"{log_dir}/access.log",
+                "error": f"{log_dir}/error.log",
                 "loglevel": "warning"
             },
             "inbounds": [
                 {
-                    "port": self.port,
+                    "port": self.instance_port(shard),
                     "protocol": "vmess",
                     "settings": {
-                        "clients": [
-                            {
-                                "id": self.user_uuid,
-                                "alterId": self.alter_id
-                            }
-                        ]
+                        "clients": clients
                     },
-                    "streamSettings": {
-                        "network": "tcp",
-                        "tcpSettings": {
-                            "header": {
-                                "type": "http",
-                                "request": {
-                                    "version": "1.1",
-                                    "method": "GET",
-                                    "path": ["/"],
-                                    "headers": {
-                                        "Host": ["www.cloudflare.com", "www.amazon.com"],
-                                        "User-Agent": [
-                                            "Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/55.0.2883.75 Safari/537.36",
-                                            "Mozilla/5.0 (iPhone; CPU iPhone OS 10_0_2 like Mac OS X) AppleWebKit/601.1 (KHTML, like Gecko) CriOS/53.0.2785.109 Mobile/14A456 Safari/601.1.46"
-                                        ],
-                                        "Accept-Encoding": ["gzip, deflate"],
-                                        "Connection": ["keep-alive"],
-                                        "Pragma": "no-cache"
-                                    }
-                                }
-                            }
-                        }
-                    }
+                    "streamSettings": self.render_stream_settings(server=True)
                 }
             ],
             "outbounds": [
@@ -149,15 +546,122 @@ class V2rayDeployer:
             ]
         }
         
-        with open(self.config_file, 'w') as f:
-            json.dump(config, f, indent=2, ensure_ascii=False)
+        apply_routing(config, self.compile_route_sets(), self.domain_strategy)
+        if self.enable_stats:
+            enable_stats(config, self.instance_api_port(shard))
+        apply_profile(config, self.tuning_profile, log_dir)
+        return json.dumps(config, indent=2, ensure_ascii=False)
+
+    def compile_route_sets(self):
+        """编译route_sets中的路由列表, 返回routing规则, 列表文件未变化时复用编译结果"""
+        from rule_compiler import read_lines
+        rules = []
+        for route_set in self.route_sets:
+            files = route_set["files"]
+            key = (route_set["name"], route_set["policy"], self.install_geodata,
+                   tuple((f, os.stat(f).st_mtime_ns) for f in files))
+            if key not in self._compiled_routes:
+                compiled_rules, compiled = compile_route_set(
+                    route_set["name"], route_set["policy"], read_lines(files), self.install_geodata)
+                compiled.report()
+                self._compiled_routes[key] = compiled_rules
+            rules.extend(self._compiled_routes[key])
+        return rules
+
+    def template_service_file(self):
+        """多实例服务模板 v2ray@.service 的路径"""
+        return os.path.join(os.path.dirname(self.service_file), TEMPLATE_UNIT)
+
+    def affinity_file(self, shard):
+        """实例的CPUAffinity配置片段路径"""
+        return os.path.join(os.path.dirname(self.service_file),
+                            f"{unit_name('v2ray', shard)}.service.d", "cpu-affinity.conf")
+
+    def client_formats(self):
+        """当前传输方式支持的客户端配置格式"""
+        return get_transport(self.transport)["clients"]
+
+    def mux_settings(self):
+        """客户端的多路复用设置"""
+        concurrency = self.mux_concurrency
+        if concurrency is None:
+            concurrency = get_transport(self.transport)["mux"]
+        return {
+            "enabled": concurrency > 0,
+            "concurrency": concurrency if concurrency > 0 else -1
+        }
+
+    def render_stream_settings(self, server=True):
+        """渲染传输设置, 服务端入站和V2RayNG出站除TLS证书外完全相同"""
+        transport = get_transport(self.transport)
+        if transport.get("requires_tls") and not self.tls_domain:
+            raise ValueError(f"传输方式 {self.transport} 需要TLS, 请设置tls_domain")
+        
+        if self.transport == "tcp-http":
+            stream = {"network": "tcp", "tcpSettings": copy.deepcopy(TCP_HTTP_SETTINGS)}
+        elif self.transport == "ws":
+            stream = {"network": "ws", "wsSettings": {"path": self.transport_path}}
+            if self.tls_domain:
+                stream["wsSettings"]["headers"] = {"Host": self.tls_domain}
+        elif self.transport == "grpc":
+            stream = {"network": "grpc", "grpcSettings": {"serviceName": self.grpc_service_name}}
+        elif self.transport == "mkcp":
+            stream = {"network": "kcp", "kcpSettings": copy.deepcopy(KCP_SETTINGS)}
+            if self.kcp_seed:
+                stream["kcpSettings"]["seed"] = self.kcp_seed
+        else:
+            stream = {"network": "http",
+                      "httpSettings": {"host": [self.tls_domain], "path": self.transport_path}}
         
-        print(f"配置文件已生成: {self.config_file}")
+        if self.tls_domain:
+            stream["security"] = "tls"
+            if server:
+                stream["tlsSettings"] = {"certificates": [{
+                    "certificateFile": self.tls_cert_file,
+                    "keyFile": self.tls_key_file
+                }]}
+            else:
+                stream["tlsSettings"] = {"serverName": self.tls_domain}
+        return stream
 
     def create_systemd_service(self):
-        """创建systemd服务"""
-        service_content = f"""[Unit]
-Description=V2Ray Service
+        """创建systemd服务 (多实例时为服务模板和各实例的CPUAffinity), 内容未变化时不重写, 返回是否有变化"""
+        if self.instances <= 1:
+            service_file = self.host_path(self.service_file)
+            os.makedirs(os.path.dirname(service_file), exist_ok=True)
+            if not self.write_if_changed(service_file, self.render_systemd_service()):
+                print(f"Systemd服务文件未变化: {service_file}")
+                return False
+            print(f"Systemd服务文件已创建: {service_file}")
+            return True
+        
+        service_file = self.host_path(self.template_service_file())
+        os.makedirs(os.path.dirname(service_file), exist_ok=True)
+        changed = self.write_if_changed(service_file, self.render_systemd_service())
+        for shard in self.shards():
+            affinity = cpu_affinity_for(self.cpu_affinity, shard)
+            drop_in = self.host_path(self.affinity_file(shard))
+            if affinity is None:
+                if os.path.exists(drop_in):
+                    os.remove(drop_in)
+                    changed = True
+                continue
+            os.makedirs(os.path.dirname(drop_in), exist_ok=True)
+            changed |= self.write_if_changed(drop_in, f"[Service]\nCPUAffinity={affinity}\n")
+        print(f"Systemd服务模板{'已创建' if changed else '未变化'}: {service_file} "
+              f"({self.instances} 个实例)")
+        return changed
+
+    def render_systemd_service(self):
+        """渲染systemd服务文件 (多实例时渲染服务模板, %i为实例名)"""
+        if self.instances > 1:
+            description = "V2Ray Service (%i)"
+            config_file = os.path.join(self.config_dir, "%i", "config.json")
+        else:
+            description = "V2Ray Service"
+            config_file = self.config_file
+        return f"""[Unit]
+Description={description}
 Documentation=https://www.v2ray.com/
 After=network.target nss-lookup.target
 
@@ -166,21 +670,18 @@ User=root
 CapabilityBoundingSet=CAP_NET_ADMIN CAP_NET_BIND_SERVICE
 AmbientCapabilities=CAP_NET_ADMIN CAP_NET_BIND_SERVICE
 NoNewPrivileges=true
-ExecStart={self.install_dir}/v2ray run -config {self.config_file}
+ExecStart={self.install_dir}/v2ray run -config {config_file}
 Restart=on-failure
 RestartPreventExitStatus=23
 
 [Install]
 WantedBy=multi-user.target
 """
-        
-        with open(self.service_file, 'w') as f:
-            f.write(service_content)
-        
-        print(f"Systemd服务文件已创建: {self.service_file}")
 
     def generate_vmess_link(self, server_ip):
         """生成vmess链接"""
+        if "vmess" not in self.client_formats():
+            raise ValueError(f"vmess链接不支持传输方式 {self.transport}")
         vmess_config = {
             "v": "2",
             "ps": f"V2Ray-{server_ip}",
@@ -192,13 +693,62 @@ WantedBy=multi-user.target
             "type": "http",
             "host": "",
             "path": "",
-            "tls": ""
+            "tls": "tls" if self.tls_domain else ""
         }
+        if self.transport == "ws":
+            vmess_config.update({"net": "ws", "type": "none", "host": self.tls_domain or "",
+                                 "path": self.transport_path})
+        elif self.transport == "grpc":
+            vmess_config.update({"net": "grpc", "type": "gun", "path": self.grpc_service_name})
+        elif self.transport == "mkcp":
+            vmess_config.update({"net": "kcp", "type": KCP_SETTINGS["header"]["type"],
+                                 "path": self.kcp_seed or ""})
+        elif self.transport == "h2":
+            vmess_config.update({"net": "h2", "type": "none", "host": self.tls_domain or "",
+                                 "path": self.transport_path})
         
         json_str = json.dumps(vmess_config, separators=(',', ':'))
         encoded = base64.b64encode(json_str.encode()).decode()
         return f"vmess://{encoded}"
 
+    def clash_proxy(self, server_ip):
+        """Clash的代理设置"""
+        if "clash" not in self.client_formats():
+            raise ValueError(f"Clash不支持传输方式 {self.transport}")
+        proxy = {
+            "name": f"V2Ray-{server_ip}",
+            "type": "vmess",
+            "server": server_ip,
+            "port": self.port,
+            "uuid": self.user_uuid,
+            "alterId": self.alter_id,
+            "cipher": "auto"
+        }
+        if self.transport == "tcp-http":
+            proxy["network"] = "tcp"
+            proxy["http-opts"] = {
+                "method": "GET",
+                "path": ["/"],
+                "headers": {
+                    "Connection": ["keep-alive"]
+                }
+            }
+        elif self.transport == "ws":
+            proxy["network"] = "ws"
+            proxy["ws-opts"] = {"path": self.transport_path}
+            if self.tls_domain:
+                proxy["ws-opts"]["headers"] = {"Host": self.tls_domain}
+        elif self.transport == "grpc":
+            proxy["network"] = "grpc"
+            proxy["grpc-opts"] = {"grpc-service-name": self.grpc_service_name}
+        elif self.transport == "h2":
+            proxy["network"] = "h2"
+            proxy["h2-opts"] = {"host": [self.tls_domain], "path": self.transport_path}
+        if self.tls_domain:
+            proxy["tls"] = True
+            proxy["servername"] = self.tls_domain
+        return proxy
+
     def generate_clash_config(self, server_ip):
         """生成Clash配置"""
         clash_config = {
@@ -222,25 +772,7 @@ WantedBy=multi-user.target
                     "223.5.5.5"
                 ]
             },
-            "proxies": [
-                {
-                    "name": f"V2Ray-{server_ip}",
-                    "type": "vmess",
-                    "server": server_ip,
-                    "port": self.port,
-                    "uuid": self.user_uuid,
-                    "alterId": self.alter_id,
-                    "cipher": "auto",
-                    "network": "tcp",
-                    "http-opts": {
-                        "method": "GET",
-                        "path": ["/"],
-                        "headers": {
-                            "Connection": ["keep-alive"]
-                        }
-                    }
-                }
-            ],
+            "proxies": [self.clash_proxy(server_ip)],
             "proxy-groups": [
                 {
                     "name": "Proxy",
@@ -248,18 +780,65 @@ WantedBy=multi-user.target
                     "proxies": [f"V2Ray-{server_ip}", "DIRECT"]
                 }
             ],
-            "rules": [
-                "DOMAIN-SUFFIX,google.com,Proxy",
-                "DOMAIN-SUFFIX,youtube.com,Proxy",
-                "DOMAIN-SUFFIX,github.com,Proxy",
-                "DOMAIN-SUFFIX,twitter.com,Proxy",
-                "DOMAIN-SUFFIX,facebook.com,Proxy",
-                "GEOIP,CN,DIRECT",
-                "MATCH,Proxy"
-            ]
+            "rules": self.clash_rules
         }
         
-        return yaml.dump(clash_config, allow_unicode=True, default_flow_style=False)
+        providers = {}
+        rules = []
+        for compiled in self.compile_rule_sets():
+            for name, (behavior, _) in compiled.clash_providers().items():
+                providers[name] = self.rule_location(f"{name}.yaml", {"behavior": behavior})
+                rules.append(f"RULE-SET,{name},{compiled.policy}")
+        if providers:
+            clash_config["rule-providers"] = providers
+            clash_config["rules"] = rules + self.clash_rules
+        
+        return dump_yaml(clash_config, self.clash_fast_yaml,
+                         static_keys=("dns", "rules", "rule-providers"))
+
+    def compile_rule_sets(self):
+        """编译rule_sets中的规则列表, 列表文件未变化时复用编译结果"""
+        from rule_compiler import compile_rule_set, read_lines
+        results = []
+        for rule_set in self.rule_sets:
+            files = rule_set["files"]
+            policy = rule_set.get("policy", "Proxy")
+            key = (rule_set["name"], policy, tuple((f, os.stat(f).st_mtime_ns) for f in files))
+            if key not in self._compiled_rules:
+                compiled = compile_rule_set(rule_set["name"], read_lines(files), policy)
+                compiled.report()
+                self._compiled_rules[key] = compiled
+            results.append(self._compiled_rules[key])
+        return results
+
+    def rule_location(self, filename, provider=None):
+        """规则文件的位置: 设置了rule_base_url时为下载地址, 否则为相对于客户端配置的本地路径
+        
+        provider不为None时返回Clash rule-provider设置
+        """
+        if provider is None:
+            if self.rule_base_url:
+                return f"{self.rule_base_url.rstrip('/')}/{filename}"
+            return f"rules/{filename}"
+        provider = dict(provider, path=f"./rules/{filename}")
+        if self.rule_base_url:
+            provider.update(type="http", url=self.rule_location(filename), interval=86400)
+        else:
+            provider["type"] = "file"
+        return provider
+
+    def render_rule_files(self):
+        """渲染当前客户端支持的规则文件, 返回 相对路径 -> 内容"""
+        files = {}
+        formats = self.client_formats()
+        for compiled in self.compile_rule_sets():
+            if "clash" in formats:
+                for name, (_, text) in compiled.clash_providers().items():
+                    files[f"rules/{name}.yaml"] = text
+            if "surge" in formats:
+                for name, (_, text) in compiled.surge_sets().items():
+                    files[f"rules/{name}"] = text
+        return files
 
     def generate_v2rayng_config(self, server_ip):
         """生成V2RayNG配置"""
@@ -313,40 +892,15 @@ WantedBy=multi-user.target
                                     {
                                         "id": self.user_uuid,
                                         "alterId": self.alter_id,
-                                        "email": "t@t.tt",
+                                        "email": self.user_email,
                                         "security": "auto"
                                     }
                                 ]
                             }
                         ]
                     },
-                    "streamSettings": {
-                        "network": "tcp",
-                        "tcpSettings": {
-                            "header": {
-                                "type": "http",
-                                "request": {
-                                    "version": "1.1",
-                                    "method": "GET",
-                                    "path": ["/"],
-                                    "headers": {
-                                        "Host": ["www.cloudflare.com", "www.amazon.com"],
-                                        "User-Agent": [
-                                            "Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/55.0.2883.75 Safari/537.36",
-                                            "Mozilla/5.0 (iPhone; CPU iPhone OS 10_0_2 like Mac OS X) AppleWebKit/601.1 (KHTML, like Gecko) CriOS/53.0.2785.109 Mobile/14A456 Safari/601.1.46"
-                                        ],
-                                        "Accept-Encoding": ["gzip, deflate"],
-                                        "Connection": ["keep-alive"],
-                                        "Pragma": "no-cache"
-                                    }
-                                }
-                            }
-                        }
-                    },
-                    "mux": {
-                        "enabled": False,
-                        "concurrency": -1
-                    }
+                    "streamSettings": self.render_stream_settings(server=False),
+                    "mux": self.mux_settings()
                 },
                 {
                     "tag": "direct",
@@ -373,19 +927,32 @@ WantedBy=multi-user.target
 
     def generate_surge_config(self, server_ip):
         """生成Surge配置"""
+        if "surge" not in self.client_formats():
+            raise ValueError(f"Surge不支持传输方式 {self.transport}")
+        options = ""
+        if self.transport == "ws":
+            options += f", ws=true, ws-path={self.transport_path}"
+            if self.tls_domain:
+                options += f", ws-headers=Host:{self.tls_domain}"
+        if self.tls_domain:
+            options += f", tls=true, sni={self.tls_domain}"
+        rule_sets = ""
+        for compiled in self.compile_rule_sets():
+            for name, (kind, _) in compiled.surge_sets().items():
+                rule_sets += f"{kind},{self.rule_location(name)},{compiled.policy}\n"
         surge_config = f"""[General]
 loglevel = notify
 dns-server = 119.29.29.29, 223.5.5.5
 skip-proxy = 127.0.0.1, 192.168.0.0/16, 10.0.0.0/8, 172.16.0.0/12, 100.64.0.0/10, localhost, *.local
 
 [Proxy]
-V2Ray = vmess, {server_ip}, {self.port}, username={self.user_uuid}, alter-id={self.alter_id}, tfo=false
+V2Ray = vmess, {server_ip}, {self.port}, username={self.user_uuid}, alter-id={self.alter_id}, tfo=false{options}
 
 [Proxy Group]
 Proxy = select, V2Ray, DIRECT
 
 [Rule]
-DOMAIN-SUFFIX,google.com,Proxy
+{rule_sets}DOMAIN-SUFFIX,google.com,Proxy
 DOMAIN-SUFFIX,youtube.com,Proxy
 DOMAIN-SUFFIX,github.com,Proxy
 DOMAIN-SUFFIX,twitter.com,Proxy
@@ -395,70 +962,253 @@ FINAL,Proxy
 """
         return surge_config
 
-    def save_configs(self, server_ip):
-        """保存所有配置文件"""
-        configs_dir = "client_configs"
-        os.makedirs(configs_dir, exist_ok=True)
-        
-        # VMess链接
-        vmess_link = self.generate_vmess_link(server_ip)
-        with open(f"{configs_dir}/vmess_link.txt", 'w') as f:
-            f.write(vmess_link)
-        
-        # Clash配置
-        clash_config = self.generate_clash_config(server_ip)
-        with open(f"{configs_dir}/clash.yaml", 'w', encoding='utf-8') as f:
-            f.write(clash_config)
+    def client_view(self, shard=None):
+        """生成客户端配置用的部署副本, 端口为用户所在实例的端口"""
+        if shard is None:
+            return self
+        view = copy.copy(self)
+        view.port = self.instance_port(shard)
+        view.instances = 1
+        return view
+
+    def render_client_configs(self, server_ip):
+        """渲染所有客户端配置, 返回 文件名 -> 内容"""
+        client = self.client_view(self.user_shard())
+        configs_dir = self.client_configs_dir
+        vmess_link = client.generate_vmess_link(server_ip)
         
-        # V2RayNG配置
-        v2rayng_config = self.generate_v2rayng_config(server_ip)
-        with open(f"{configs_dir}/v2rayng.json", 'w', encoding='utf-8') as f:
-            f.write(v2rayng_config)
+        if self.transport == "tcp-http":
+            transport_info = "传输协议: TCP\n伪装类型: HTTP\n伪装域名: www.cloudflare.com"
+        else:
+            transport_info = f"传输协议: {get_transport(self.transport)['description']}"
+            if self.transport == "grpc":
+                transport_info += f"\nserviceName: {self.grpc_service_name}"
+            elif self.transport in ("ws", "h2"):
+                transport_info += f"\n路径: {self.transport_path}"
+        if self.tls_domain:
+            transport_info += f"\nTLS域名: {self.tls_domain}"
         
-        # Surge配置
-        surge_config = self.generate_surge_config(server_ip)
-        with open(f"{configs_dir}/surge.conf", 'w', encoding='utf-8') as f:
-            f.write(surge_config)
+        files = [
+            ("clash", "clash.yaml", "Clash配置文件", client.generate_clash_config),
+            ("v2rayng", "v2rayng.json", "V2RayNG配置文件", client.generate_v2rayng_config),
+            ("surge", "surge.conf", "Surge配置文件", client.generate_surge_config),
+        ]
+        files = [f for f in files if f[0] in self.client_formats()]
+        file_list = "".join(f"- {name} ({title})\n" for _, name, title, _ in files)
         
         # 连接信息
         info = f"""V2Ray服务器信息:
 服务器地址: {server_ip}
-端口: {self.port}
+端口: {client.port}
 用户ID(UUID): {self.user_uuid}
 额外ID: {self.alter_id}
-传输协议: TCP
-伪装类型: HTTP
-伪装域名: www.cloudflare.com
+{transport_info}
 
 VMess链接:
 {vmess_link}
 
-客户端配置文件已保存到 client_configs 目录:
+客户端配置文件已保存到 {configs_dir} 目录:
 - vmess_link.txt (VMess订阅链接)
-- clash.yaml (Clash配置文件)
-- v2rayng.json (V2RayNG配置文件)
-- surge.conf (Surge配置文件)
-"""
+{file_list}"""
         
-        with open(f"{configs_dir}/connection_info.txt", 'w', encoding='utf-8') as f:
-            f.write(info)
+        configs = {"vmess_link.txt": vmess_link}
+        for _, name, _, generate in files:
+            configs[name] = generate(server_ip)
+        configs["connection_info.txt"] = info
+        configs.update(self.render_rule_files())
+        return configs
+
+    def save_configs(self, server_ip, with_stats=False):
+        """保存所有配置文件
+        
+        with_stats为True时返回 (连接信息, 写入统计)
+        """
+        configs_dir = self.client_configs_dir
+        os.makedirs(configs_dir, exist_ok=True)
         
-        return info
+        configs = self.render_client_configs(server_ip)
+        for name in configs:
+            os.makedirs(os.path.dirname(os.path.join(configs_dir, name)), exist_ok=True)
+        stats = self.write_files({os.path.join(configs_dir, name): content
+                                  for name, content in configs.items()})
+        
+        info = configs["connection_info.txt"]
+        return (info, stats) if with_stats else info
+
+    def save_user_configs(self, server_ip, output_dir, clients=None, with_stats=False):
+        """为服务端配置中的所有用户批量生成客户端配置, 每个用户一个目录
+        
+        返回用户数; with_stats为True时返回 (用户数, 写入统计)
+        """
+        from batch_render import BatchRenderer, FORMAT_FILES, load_clients
+        if clients is None:
+            clients = []
+            for shard in self.shards():
+                clients += load_clients(self.host_path(self.instance_config_file(shard)))
+        
+        renderer = BatchRenderer(self, server_ip)
+        stats = {"files": {}, "files_written": 0, "bytes_written": 0, "elapsed": 0.0}
+        
+        def flush(files):
+            batch = self.write_files(files)
+            for key in ("files_written", "bytes_written", "elapsed"):
+                stats[key] += batch[key]
+            if with_stats:
+                stats["files"].update(batch["files"])
+        
+        # 按批并行写入, 不在内存中保留全部用户的配置
+        files = {}
+        for client, configs in renderer.render(clients):
+            user_dir = os.path.join(output_dir, client["id"])
+            os.makedirs(user_dir, exist_ok=True)
+            for name, content in configs.items():
+                files[os.path.join(user_dir, FORMAT_FILES[name])] = content
+            if len(files) >= 256:
+                flush(files)
+                files = {}
+        if files:
+            flush(files)
+        renderer.report()
+        print(f"写入 {stats['files_written']} 个文件, 共 {stats['bytes_written']} 字节")
+        return (renderer.rendered, stats) if with_stats else renderer.rendered
+
+    def write_files(self, files):
+        """并行写入多个文件 (路径 -> 内容), 返回每个文件的耗时和写入的字节数"""
+        def write(path, content):
+            started = time.perf_counter()
+            written = self.write_if_changed(path, content)
+            return {
+                "written": written,
+                "bytes": len(content.encode('utf-8')) if written else 0,
+                "seconds": time.perf_counter() - started
+            }
+        
+        started = time.perf_counter()
+        if len(files) > 1 and self.write_workers > 1:
+            with ThreadPoolExecutor(max_workers=min(self.write_workers, len(files))) as executor:
+                futures = {path: executor.submit(write, path, content)
+                           for path, content in files.items()}
+                results = {path: future.result() for path, future in futures.items()}
+        else:
+            results = {path: write(path, content) for path, content in files.items()}
+        
+        return {
+            "files": results,
+            "files_written": sum(1 for r in results.values() if r["written"]),
+            "bytes_written": sum(r["bytes"] for r in results.values()),
+            "elapsed": time.perf_counter() - started
+        }
+
+    def write_if_changed(self, path, content):
+        """内容与现有文件相同时跳过写入, 返回是否写入
+        
+        先写入同目录下的临时文件再重命名, 读取方不会看到写了一半的文件
+        """
+        data = content.encode('utf-8')
+        try:
+            current = os.stat(path)
+            if current.st_size == len(data):
+                with open(path, 'rb') as f:
+                    if f.read() == data:
+                        return False
+            mode = current.st_mode & 0o7777
+        except OSError:
+            mode = 0o644
+        
+        import tempfile
+        directory, name = os.path.split(path)
+        fd, tmp_file = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory or ".")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp_file, mode)
+            os.replace(tmp_file, path)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        return True
+
+    def state_file(self):
+        """部署状态清单路径"""
+        return self.host_path(os.path.join(self.config_dir, "deploy_state.json"))
 
-    def start_service(self):
-        """启动v2ray服务"""
+    def load_deploy_state(self):
+        """加载上次部署的状态清单"""
         try:
-            subprocess.run(['systemctl', 'daemon-reload'], check=True)
-            subprocess.run(['systemctl', 'enable', 'v2ray'], check=True)
-            subprocess.run(['systemctl', 'start', 'v2ray'], check=True)
+            with open(self.state_file(), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def restore_identity(self, state):
+        """重新部署时沿用已有的用户UUID, 保证生成的配置不变"""
+        if state.get("user_uuid"):
+            self.user_uuid = state["user_uuid"]
+            return
+        # 没有状态清单时从现有配置文件中读取
+        for shard in self.shards():
+            try:
+                with open(self.host_path(self.instance_config_file(shard)), 'r') as f:
+                    config = json.load(f)
+                self.user_uuid = config["inbounds"][0]["settings"]["clients"][0]["id"]
+                return
+            except (OSError, ValueError, KeyError, IndexError):
+                continue
+
+    def save_deploy_state(self, server_ip):
+        """记录已安装的二进制、服务端配置、服务文件和客户端配置的摘要"""
+        binary = self.host_path(os.path.join(self.install_dir, 'v2ray'))
+        files = {}
+        for shard in self.shards():
+            name = "config" if shard is None else f"config/{instance_name(shard)}"
+            files[name] = self.host_path(self.instance_config_file(shard))
+        files["service"] = self.host_path(
+            self.service_file if self.instances <= 1 else self.template_service_file())
+        for name in self.render_client_configs(server_ip):
+            files[name] = os.path.join(self.client_configs_dir, name)
+        
+        state = {
+            "v2ray_version": self.v2ray_version,
+            "user_uuid": self.user_uuid,
+            "port": self.port,
+            "instances": self.instances,
+            "server_ip": server_ip,
+            "binary": sha256_file(binary) if os.path.exists(binary) else None,
+            "files": {name: sha256_file(path) for name, path in files.items()
+                      if os.path.exists(path)},
+            "time": time.time()
+        }
+        state_file = self.state_file()
+        with open(f"{state_file}.tmp", 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(f"{state_file}.tmp", state_file)
+        return state
+
+    def start_service(self, restart=False):
+        """启动v2ray服务 (restart为True时重启已运行的服务)"""
+        try:
+            systemctl = self.service_command + ['systemctl']
+            units = self.service_units()
+            subprocess.run(systemctl + ['daemon-reload'], check=True)
+            if self.instances > 1:
+                # 从单实例切换到多实例时停用原来的服务, 避免端口冲突
+                subprocess.run(systemctl + ['disable', '--now', 'v2ray'],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            subprocess.run(systemctl + ['enable'] + units, check=True)
+            subprocess.run(systemctl + ['restart' if restart else 'start'] + units, check=True)
             
-            status = subprocess.run(['systemctl', 'is-active', 'v2ray'], 
-                                  capture_output=True, text=True)
-            if status.stdout.strip() == 'active':
+            failed = []
+            for unit in units:
+                status = subprocess.run(systemctl + ['is-active', unit],
+                                      capture_output=True, text=True)
+                if status.stdout.strip() != 'active':
+                    failed.append(unit)
+            if not failed:
                 print("V2Ray服务启动成功!")
                 return True
             else:
-                print("V2Ray服务启动失败!")
+                print(f"V2Ray服务启动失败: {', '.join(failed)}")
                 return False
         except subprocess.CalledProcessError as e:
             print(f"启动服务时出错: {e}")
@@ -474,36 +1224,128 @@ VMess链接:
             sys.exit(1)
         
         try:
-            # 安装v2ray
-            self.install_v2ray()
+            graph = self.build_deploy_graph()
+            started = time.time()
+            results = graph.run()
+            info = results["client_configs"]
             
-            # 生成配置文件
-            self.generate_config()
+            print("\n" + "="*50)
+            print("部署完成!")
+            print("="*50)
+            print(info)
+            print("="*50)
             
-            # 创建systemd服务
-            self.create_systemd_service()
+            for name, elapsed in graph.timings.items():
+                print(f"阶段 {name}: {elapsed:.2f}s")
+            print(f"总耗时: {time.time() - started:.2f}s "
+                  f"(各阶段合计 {sum(graph.timings.values()):.2f}s)")
             
-            # 启动服务
-            if self.start_service():
-                # 获取公网IP并生成客户端配置
-                server_ip = self.get_public_ip()
-                info = self.save_configs(server_ip)
-                
-                print("\n" + "="*50)
-                print("部署完成!")
-                print("="*50)
-                print(info)
-                print("="*50)
-                
-                return True
-            else:
-                print("服务启动失败，请检查日志!")
-                return False
+            return True
                 
         except Exception as e:
             print(f"部署过程中出错: {e}")
             return False
 
-if __name__ == "__main__":
+    def _install_stage(self, archive=None):
+        """安装阶段: 已安装的二进制与状态清单一致时跳过, 返回是否有变化"""
+        binary = self.host_path(os.path.join(self.install_dir, 'v2ray'))
+        if (self.deploy_state.get("v2ray_version") == self.v2ray_version
+                and self.deploy_state.get("binary")
+                and os.path.exists(binary)
+                and sha256_file(binary) == self.deploy_state["binary"]):
+            print(f"v2ray {self.v2ray_version} 已安装且未变化, 跳过下载")
+            return False
+        self.install_v2ray(archive)
+        return True
+
+    def _start_stage(self, *changes):
+        """启动服务阶段: 二进制、配置或服务文件有变化时重启, 否则只确保服务在运行"""
+        if not self.manage_service:
+            print("跳过服务启动")
+            return
+        restart = any(changes)
+        if not restart:
+            print("部署内容未变化, 跳过重启")
+        if not self.start_service(restart=restart):
+            raise Exception("服务启动失败，请检查日志!")
+
+    def build_deploy_graph(self, archive=None, server_ip=None):
+        """构建部署阶段依赖图: 下载安装、公网IP、配置生成互不依赖, 可并发执行"""
+        self.deploy_state = self.load_deploy_state() if self.incremental else {}
+        if self.incremental:
+            self.restore_identity(self.deploy_state)
+        
+        timeouts = self.stage_timeouts
+        graph = StageGraph()
+        graph.add("install", lambda: self._install_stage(archive), timeout=timeouts.get("install"))
+        graph.add("public_ip", (lambda: server_ip) if server_ip else self.get_public_ip,
+                  timeout=timeouts.get("public_ip"))
+        graph.add("config", self.generate_config, timeout=timeouts.get("config"))
+        graph.add("service", self.create_systemd_service, timeout=timeouts.get("service"))
+        graph.add("start", self._start_stage, deps=["install", "config", "service"],
+                  timeout=timeouts.get("start"))
+        graph.add("client_configs", lambda _, server_ip: self.save_configs(server_ip),
+                  deps=["start", "public_ip"], timeout=timeouts.get("client_configs"))
+        graph.add("state", lambda _, server_ip: self.save_deploy_state(server_ip),
+                  deps=["client_configs", "public_ip"])
+        return graph
+
+def main():
+    parser = argparse.ArgumentParser(description='V2Ray 自动部署工具')
+    parser.add_argument('--force', action='store_true',
+                        help='忽略上次部署状态, 重新下载并生成新的UUID')
+    parser.add_argument('--render-users', metavar='DIR',
+                        help='不部署, 为配置文件中的所有用户生成客户端配置到DIR')
+    parser.add_argument('--server-ip', help='客户端配置中使用的服务器地址 (默认自动获取)')
+    parser.add_argument('--profile', choices=list(PROFILES), default=DEFAULT_PROFILE,
+                        help='服务端性能配置')
+    parser.add_argument('--transport', choices=list(TRANSPORTS), default=DEFAULT_TRANSPORT,
+                        help='传输方式')
+    parser.add_argument('--tls-domain', help='开启TLS并使用该域名 (h2传输必须设置)')
+    parser.add_argument('--mux', type=int, metavar='N',
+                        help='客户端多路复用并发数, 0表示关闭 (默认由传输方式决定)')
+    parser.add_argument('--rule-set', nargs='+', action='append', default=[],
+                        metavar='NAME POLICY FILE',
+                        help='将规则列表编译为客户端规则文件, 例如 --rule-set ads REJECT ads.txt (可重复)')
+    parser.add_argument('--route-set', nargs='+', action='append', default=[],
+                        metavar='NAME POLICY FILE',
+                        help='将域名/IP列表编译为服务端路由规则, POLICY为 '
+                             f'{"/".join(ROUTE_POLICIES)}, 例如 --route-set ads block ads.txt (可重复)')
+    parser.add_argument('--rule-base-url', help='客户端下载规则文件的地址 (默认使用本地文件)')
+    parser.add_argument('--enable-stats', action='store_true',
+                        help='开启流量统计API (只监听127.0.0.1), 用于 manage.py stats')
+    parser.add_argument('--instances', type=int, default=1,
+                        help='v2ray实例数, 大于1时用户按UUID分片到 v2ray@shard<i>')
+    parser.add_argument('--cpu-affinity', nargs='?', const='auto',
+                        help='为每个实例绑定CPU: 不带参数时按实例序号轮流绑定, '
+                             '或逗号分隔的CPU列表 (例如 0,1,2-3)')
+    args = parser.parse_args()
+    
     deployer = V2rayDeployer()
-    deployer.deploy()
\ No newline at end of file
+    deployer.tuning_profile = args.profile
+    deployer.instances = args.instances
+    deployer.enable_stats = args.enable_stats
+    deployer.transport = args.transport
+    deployer.tls_domain = args.tls_domain
+    deployer.mux_concurrency = args.mux
+    for rule_set in args.rule_set:
+        if len(rule_set) < 3:
+            parser.error("--rule-set 需要 NAME POLICY FILE...")
+        deployer.rule_sets.append({"name": rule_set[0], "policy": rule_set[1], "files": rule_set[2:]})
+    deployer.rule_base_url = args.rule_base_url
+    for route_set in args.route_set:
+        if len(route_set) < 3 or route_set[1] not in ROUTE_POLICIES:
+            parser.error(f"--route-set 需要 NAME POLICY FILE..., POLICY为 {'/'.join(ROUTE_POLICIES)}")
+        deployer.route_sets.append({"name": route_set[0], "policy": route_set[1], "files": route_set[2:]})
+    if args.cpu_affinity:
+        deployer.cpu_affinity = (args.cpu_affinity if args.cpu_affinity == 'auto'
+                                 else args.cpu_affinity.split(','))
+    if args.render_users:
+        deployer.save_user_configs(args.server_ip or deployer.get_public_ip(), args.render_users)
+        return
+    
+    deployer.incremental = not args.force
+    deployer.deploy()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
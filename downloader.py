@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# 缓存默认容量上限 (字节)
+DEFAULT_CACHE_SIZE = 200 * 1024 * 1024
+
+# 分段下载默认参数
+DEFAULT_CHUNK_SIZE = 2 * 1024 * 1024
+DEFAULT_WORKERS = 4
+
+# 默认下载源, {url} 会被替换为GitHub release地址
+DEFAULT_MIRRORS = [
+    "{url}",
+    "https://ghproxy.com/{url}",
+]
+
+
+def sha256_file(path, chunk_size=1024 * 1024):
+    """计算文件的sha256摘要"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def extract_members(archive, dest_dir, members, optional=()):
+    """只解压需要的文件, 边解压边校验, 写入临时文件后原子替换, 返回各文件的sha256"""
+    import zipfile
+    digests = {}
+    with zipfile.ZipFile(archive, 'r') as zip_ref:
+        names = set(zip_ref.namelist())
+        missing = [name for name in members if name not in names]
+        if missing:
+            raise ValueError(f"压缩包中缺少文件: {', '.join(missing)}")
+
+        for name in list(members) + [n for n in optional if n in names]:
+            info = zip_ref.getinfo(name)
+            target = os.path.join(dest_dir, os.path.basename(name))
+            tmp_file = os.path.join(dest_dir, f".{os.path.basename(name)}.tmp")
+            digest = hashlib.sha256()
+            try:
+                # ZipExtFile读到末尾时会校验CRC32, 损坏的文件不会替换目标文件
+                with zip_ref.open(info) as src, open(tmp_file, 'wb') as dst:
+                    while True:
+                        data = src.read(1024 * 1024)
+                        if not data:
+                            break
+                        digest.update(data)
+                        dst.write(data)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                mode = (info.external_attr >> 16) & 0o777
+                os.chmod(tmp_file, mode or 0o644)
+                os.replace(tmp_file, target)
+            finally:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+            digests[name] = digest.hexdigest()
+    return digests
+
+
+def parse_dgst(text):
+    """解析release附带的.dgst摘要文件, 返回sha256 (不存在时返回None)"""
+    for line in text.splitlines():
+        if '=' not in line:
+            continue
+        name, value = line.split('=', 1)
+        if name.strip().upper() in ('SHA2-256', 'SHA256'):
+            return value.strip().lower()
+    return None
+
+
+class ArtifactCache:
+    """按 (版本, 架构, sha256) 索引的本地制品缓存, 超出容量时按LRU淘汰"""
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.index_file = os.path.join(cache_dir, "index.json")
+
+    def _key(self, version, arch, sha256):
+        return f"{version}/{arch}/{sha256}"
+
+    def _load_index(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"entries": {}}
+
+    def _save_index(self, index):
+        tmp_file = f"{self.index_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_file, self.index_file)
+
+    def object_path(self, sha256):
+        """返回摘要对应的缓存文件路径"""
+        return os.path.join(self.objects_dir, f"{sha256}.zip")
+
+    def owns(self, path):
+        """判断文件是否位于缓存目录中"""
+        objects_dir = os.path.abspath(self.objects_dir)
+        return os.path.dirname(os.path.abspath(path)) == objects_dir
+
+    def lookup(self, version, arch, sha256=None):
+        """查找已校验的缓存文件, 未提供sha256时使用最近一次记录的摘要"""
+        index = self._load_index()
+        entries = index["entries"]
+
+        if sha256:
+            key = self._key(version, arch, sha256)
+            candidates = [key] if key in entries else []
+        else:
+            candidates = sorted(
+                (k for k, e in entries.items()
+                 if e["version"] == version and e["arch"] == arch),
+                key=lambda k: entries[k]["last_used"], reverse=True)
+
+        for key in candidates:
+            entry = entries[key]
+            path = self.object_path(entry["sha256"])
+            if os.path.exists(path) and sha256_file(path) == entry["sha256"]:
+                entry["last_used"] = time.time()
+                self._save_index(index)
+                return path
+            # 缓存文件缺失或损坏, 删除该条目
+            del entries[key]
+            if os.path.exists(path):
+                os.remove(path)
+            self._save_index(index)
+        return None
+
+    def store(self, version, arch, src_path, sha256=None):
+        """校验并将文件移入缓存, 返回缓存中的路径"""
+        actual = sha256_file(src_path)
+        if sha256 and actual != sha256.lower():
+            raise ValueError(f"sha256校验失败: 期望 {sha256}, 实际 {actual}")
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+        path = self.object_path(actual)
+        tmp_path = f"{path}.tmp"
+        shutil.move(src_path, tmp_path)
+        os.replace(tmp_path, path)
+
+        index = self._load_index()
+        index["entries"][self._key(version, arch, actual)] = {
+            "version": version,
+            "arch": arch,
+            "sha256": actual,
+            "size": os.path.getsize(path),
+            "last_used": time.time()
+        }
+        self._save_index(index)
+        self.evict(keep=actual)
+        return path
+
+    def total_size(self):
+        """缓存中所有文件的总大小"""
+        entries = self._load_index()["entries"]
+        sizes = {e["sha256"]: e["size"] for e in entries.values()}
+        return sum(sizes.values())
+
+    def evict(self, keep=None):
+        """按最近使用时间淘汰旧版本, 直到总大小不超过上限"""
+        index = self._load_index()
+        entries = index["entries"]
+        removed = []
+
+        def total():
+            return sum({e["sha256"]: e["size"] for e in entries.values()}.values())
+
+        for key in sorted(entries, key=lambda k: entries[k]["last_used"]):
+            if total() <= self.max_bytes:
+                break
+            sha256 = entries[key]["sha256"]
+            if sha256 == keep:
+                continue
+            del entries[key]
+            # 同一文件可能被多个版本引用, 无引用时才删除
+            if not any(e["sha256"] == sha256 for e in entries.values()):
+                path = self.object_path(sha256)
+                if os.path.exists(path):
+                    os.remove(path)
+            removed.append(key)
+
+        if removed:
+            self._save_index(index)
+        return removed
+
+
+class RangedDownloader:
+    """基于HTTP Range的多线程分段下载, 中断后可从.part文件续传"""
+
+    def __init__(self, workers=DEFAULT_WORKERS, chunk_size=DEFAULT_CHUNK_SIZE,
+                 timeout=30, retries=3):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.retries = retries
+
+    def probe(self, url):
+        """探测文件大小以及服务器是否支持Range请求"""
+        import urllib.request
+        request = urllib.request.Request(url, headers={"Range": "bytes=0-0"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            content_range = response.headers.get("Content-Range", "")
+            if response.status == 206 and "/" in content_range:
+                total = content_range.rsplit("/", 1)[1]
+                if total.isdigit():
+                    return int(total), True
+            length = response.headers.get("Content-Length")
+            return (int(length) if length else None), False
+
+    def _load_state(self, state_file, size):
+        try:
+            with open(state_file, 'r') as f:
+                state = json.load(f)
+            if state["size"] == size and state["chunk_size"] == self.chunk_size:
+                return set(state["done"])
+        except (OSError, ValueError, KeyError):
+            pass
+        return set()
+
+    def _save_state(self, state_file, url, size, done):
+        tmp_file = f"{state_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({"url": url, "size": size, "chunk_size": self.chunk_size,
+                       "done": sorted(done)}, f)
+        os.replace(tmp_file, state_file)
+
+    def _get_range(self, url, start, end):
+        """下载单个分段, 失败时重试"""
+        import urllib.request
+        request = urllib.request.Request(url, headers={"Range": f"bytes={start}-{end}"})
+        last_error = None
+        for _ in range(self.retries):
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    if response.status != 206:
+                        raise IOError(f"服务器未返回分段内容: HTTP {response.status}")
+                    data = response.read()
+                if len(data) != end - start + 1:
+                    raise IOError(f"分段长度不符: {start}-{end}")
+                return data
+            except Exception as e:
+                last_error = e
+        raise last_error
+
+    def _fetch_chunk(self, url, part_file, start, end):
+        """下载单个分段并写入.part文件的对应位置"""
+        data = self._get_range(url, start, end)
+        with open(part_file, 'r+b') as f:
+            f.seek(start)
+            f.write(data)
+        return len(data)
+
+    def fetch_bytes(self, url, partial=None):
+        """分段并行下载到内存, 不落盘
+
+        partial为调用方保存的下载状态 (dict), 分段失败时已完成的分段保留在其中,
+        换源后以同一个partial再次调用只下载缺失的分段
+        """
+        import urllib.request
+        started = time.time()
+        size, ranged = self.probe(url)
+        if not ranged or not size:
+            with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                data = response.read()
+            self._report(len(data), 0, started)
+            return data
+
+        if partial is None:
+            partial = {}
+        if partial.get("size") != size or partial.get("chunk_size") != self.chunk_size:
+            partial.update(size=size, chunk_size=self.chunk_size, buffer=bytearray(size), done=set())
+        buffer, done = partial["buffer"], partial["done"]
+        view = memoryview(buffer)
+        chunks = [(start, min(start + self.chunk_size, size) - 1)
+                  for start in range(0, size, self.chunk_size)]
+        resumed = sum(end - start + 1 for i, (start, end) in enumerate(chunks) if i in done)
+        if resumed:
+            print(f"从断点续传: 已完成 {resumed}/{size} 字节")
+
+        errors = []
+
+        def worker(i):
+            start, end = chunks[i]
+            try:
+                view[start:end + 1] = self._get_range(url, start, end)
+            except Exception as e:
+                errors.append(e)
+                return 0
+            done.add(i)
+            return end - start + 1
+
+        pending = [i for i in range(len(chunks)) if i not in done]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            fetched = sum(pool.map(worker, pending))
+        if errors:
+            raise IOError(f"{len(errors)} 个分段下载失败, 换源后可继续: {errors[0]}")
+        self._report(fetched, resumed, started)
+        return bytes(buffer)
+
+    def _download_stream(self, url, part_file):
+        """服务器不支持Range时整体下载"""
+        import urllib.request
+        size = 0
+        with urllib.request.urlopen(url, timeout=self.timeout) as response, \
+                open(part_file, 'wb') as f:
+            while True:
+                data = response.read(64 * 1024)
+                if not data:
+                    break
+                f.write(data)
+                size += len(data)
+        return size
+
+    def download(self, url, dest):
+        """下载文件到dest, 返回下载统计信息"""
+        part_file = f"{dest}.part"
+        state_file = f"{dest}.part.json"
+        started = time.time()
+
+        size, ranged = self.probe(url)
+        if not ranged or not size:
+            fetched = self._download_stream(url, part_file)
+            os.replace(part_file, dest)
+            return self._report(fetched, 0, started)
+
+        chunks = [(start, min(start + self.chunk_size, size) - 1)
+                  for start in range(0, size, self.chunk_size)]
+        done = self._load_state(state_file, size)
+        if not done or not os.path.exists(part_file) or os.path.getsize(part_file) != size:
+            done = set()
+            with open(part_file, 'wb') as f:
+                f.truncate(size)
+        resumed = sum(end - start + 1 for i, (start, end) in enumerate(chunks) if i in done)
+        if resumed:
+            print(f"从断点续传: 已完成 {resumed}/{size} 字节")
+
+        lock = threading.Lock()
+        errors = []
+
+        def worker(i):
+            start, end = chunks[i]
+            try:
+                length = self._fetch_chunk(url, part_file, start, end)
+            except Exception as e:
+                errors.append(e)
+                return 0
+            with lock:
+                done.add(i)
+                self._save_state(state_file, url, size, done)
+            return length
+
+        pending = [i for i in range(len(chunks)) if i not in done]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            fetched = sum(pool.map(worker, pending))
+
+        if errors:
+            raise IOError(f"{len(errors)} 个分段下载失败, 可重新运行续传: {errors[0]}")
+
+        os.replace(part_file, dest)
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        return self._report(fetched, resumed, started)
+
+    def _report(self, fetched, resumed, started):
+        elapsed = max(time.time() - started, 1e-6)
+        stats = {
+            "bytes": fetched,
+            "resumed_bytes": resumed,
+            "elapsed": elapsed,
+            "throughput": fetched / elapsed
+        }
+        print(f"下载 {fetched} 字节, 耗时 {elapsed:.2f}s, "
+              f"速度 {stats['throughput'] / 1024 / 1024:.2f} MB/s")
+        return stats
+
+
+class MirrorSelector:
+    """并发探测所有下载源, 按首字节时间和带宽选出最快的源并记住结果
+
+    记住的结果超过ttl秒, 或用它下载时带宽低于min_bandwidth (字节/秒) 后作废, 下次重新探测
+    """
+
+    def __init__(self, mirrors=None, state_file=None, sample_bytes=256 * 1024,
+                 timeout=10, grace=0.5, expected_size=16 * 1024 * 1024,
+                 ttl=24 * 3600, min_bandwidth=256 * 1024):
+        self.mirrors = mirrors or DEFAULT_MIRRORS
+        self.state_file = state_file
+        self.sample_bytes = sample_bytes
+        self.timeout = timeout
+        self.grace = grace
+        self.expected_size = expected_size
+        self.ttl = ttl
+        self.min_bandwidth = min_bandwidth
+
+    def candidates(self, url):
+        """根据镜像模板生成所有候选地址"""
+        return [mirror.format(url=url) for mirror in self.mirrors]
+
+    def _load_state(self):
+        if not self.state_file:
+            return {}
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, state):
+        os.makedirs(os.path.dirname(self.state_file) or ".", exist_ok=True)
+        tmp_file = f"{self.state_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_file, self.state_file)
+
+    def remember(self, url, mirror):
+        """记录某个源站地址最快的镜像模板"""
+        if not self.state_file:
+            return
+        state = self._load_state()
+        state[urlparse(url).netloc] = {"mirror": mirror, "time": time.time()}
+        self._save_state(state)
+
+    def forget(self, url):
+        """删除某个源站地址的记录, 下次重新探测"""
+        state = self._load_state()
+        if state.pop(urlparse(url).netloc, None) is not None:
+            self._save_state(state)
+
+    def record_success(self, url, source_url, bandwidth=None):
+        """下载成功后记录实际使用的镜像, 记住的镜像失效时会被替换; 带宽过低时删除记录"""
+        if bandwidth is not None and bandwidth < self.min_bandwidth:
+            print(f"下载带宽 {bandwidth / 1024:.0f} KB/s 过低, 下次重新探测下载源")
+            self.forget(url)
+            return
+        for mirror in self.mirrors:
+            if mirror.format(url=url) == source_url:
+                if self.remembered(url) != mirror:
+                    self.remember(url, mirror)
+                return
+
+    def remembered(self, url):
+        """返回上次记录的最快镜像模板, 记录超过ttl秒时返回None"""
+        entry = self._load_state().get(urlparse(url).netloc)
+        if (entry and entry["mirror"] in self.mirrors
+                and time.time() - entry.get("time", 0) < self.ttl):
+            return entry["mirror"]
+        return None
+
+    def probe(self, url, cancel):
+        """下载一小段数据, 测量首字节时间和带宽"""
+        import urllib.request
+        started = time.time()
+        request = urllib.request.Request(
+            url, headers={"Range": f"bytes=0-{self.sample_bytes - 1}"})
+        received = 0
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            first = response.read(1)
+            ttfb = time.time() - started
+            received = len(first)
+            while received < self.sample_bytes and not cancel.is_set():
+                data = response.read(16 * 1024)
+                if not data:
+                    break
+                received += len(data)
+        if cancel.is_set() and received < self.sample_bytes:
+            raise IOError("探测已取消")
+        elapsed = max(time.time() - started - ttfb, 1e-6)
+        bandwidth = received / elapsed
+        return {
+            "url": url,
+            "ttfb": ttfb,
+            "bandwidth": bandwidth,
+            "score": ttfb + self.expected_size / max(bandwidth, 1.0)
+        }
+
+    def race(self, mirrors, url):
+        """并发探测所有镜像, 第一个完成后等待一小段时间并取消其余探测"""
+        cancel = threading.Event()
+        pool = ThreadPoolExecutor(max_workers=len(mirrors))
+        futures = {pool.submit(self.probe, m.format(url=url), cancel): m for m in mirrors}
+        results = {}
+        pending = set(futures)
+        deadline = time.time() + self.timeout
+        try:
+            while pending and time.time() < deadline:
+                timeout = deadline - time.time()
+                if results:
+                    timeout = min(timeout, self.grace)
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    try:
+                        results[futures[future]] = future.result()
+                    except Exception:
+                        continue
+        finally:
+            cancel.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+        return results
+
+    def select(self, url):
+        """返回排好序的候选地址列表, 最快的源排在最前"""
+        preferred = self.remembered(url)
+        if preferred:
+            others = [m for m in self.mirrors if m != preferred]
+            return [m.format(url=url) for m in [preferred] + others]
+
+        results = self.race(self.mirrors, url)
+        ranked = sorted(results, key=lambda m: results[m]["score"])
+        for mirror in ranked:
+            stats = results[mirror]
+            print(f"下载源 {stats['url']}: 首字节 {stats['ttfb'] * 1000:.0f}ms, "
+                  f"带宽 {stats['bandwidth'] / 1024 / 1024:.2f} MB/s")
+        if ranked:
+            self.remember(url, ranked[0])
+        failed = [m for m in self.mirrors if m not in results]
+        return [m.format(url=url) for m in ranked + failed]
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from deploy_v2ray import V2rayDeployer
+
+# 清单中可以按目标覆盖的部署参数
+TARGET_OPTIONS = ["port", "install_mode", "install_geodata", "manage_service",
+                  "service_command", "v2ray_version", "tuning_profile",
+                  "instances", "cpu_affinity", "enable_stats", "api_port",
+                  "transport", "tls_domain", "mux_concurrency",
+                  "rule_sets", "rule_base_url", "route_sets", "domain_strategy", "mirrors"]
+# 决定下载哪个压缩包的参数, 这些参数相同的目标共用一个压缩包
+ARTIFACT_OPTIONS = ["v2ray_version", "mirrors"]
+
+
+def load_inventory(path):
+    """加载批量部署清单 (YAML或JSON)"""
+    import yaml
+    with open(path, 'r', encoding='utf-8') as f:
+        inventory = yaml.safe_load(f) or {}
+
+    defaults = inventory.get("defaults", {})
+    targets = []
+    for i, target in enumerate(inventory.get("targets", [])):
+        merged = dict(defaults)
+        merged.update(target)
+        merged.setdefault("name", f"target-{i + 1}")
+        merged.setdefault("root", "/")
+        targets.append(merged)
+
+    names = [t["name"] for t in targets]
+    if len(names) != len(set(names)):
+        raise ValueError("清单中存在重复的目标名称")
+    return targets
+
+
+def artifact_key(target):
+    return json.dumps([target.get(option) for option in ARTIFACT_OPTIONS])
+
+
+class FleetDeployer:
+    """在有限的并发数下批量部署多个目标, v2ray版本和下载源相同的目标共用同一个下载的压缩包"""
+
+    def __init__(self, targets, workers=4, output_dir="fleet_configs"):
+        self.targets = targets
+        self.workers = workers
+        self.output_dir = output_dir
+        self.template = V2rayDeployer()
+
+    def make_deployer(self, target):
+        """根据清单条目创建部署器"""
+        deployer = V2rayDeployer(root=target["root"])
+        for option in TARGET_OPTIONS:
+            if option in target:
+                setattr(deployer, option, target[option])
+        # 本机根目录以外的目标默认不启动服务, 除非指定了服务管理命令
+        if "manage_service" not in target:
+            deployer.manage_service = target["root"] == "/" or bool(deployer.service_command)
+        deployer.client_configs_dir = os.path.join(self.output_dir, target["name"])
+        return deployer
+
+    def download_artifact(self, deployer):
+        archive = deployer.download_v2ray(to_memory=True)
+        if isinstance(archive, io.BytesIO):
+            return archive.getvalue()
+        return archive
+
+    def fetch_artifacts(self):
+        """每种 (v2ray版本, 下载源) 下载一次压缩包, 返回 {artifact_key: 压缩包}, 下载失败时为异常"""
+        archives = {}
+        for target in self.targets:
+            key = artifact_key(target)
+            if key in archives:
+                continue
+            deployer = V2rayDeployer()
+            for option in ARTIFACT_OPTIONS:
+                if option in target:
+                    setattr(deployer, option, target[option])
+            try:
+                archives[key] = self.download_artifact(deployer)
+            except Exception as e:
+                archives[key] = e
+        return archives
+
+    def deploy_target(self, target, archive, server_ip):
+        """部署单个目标, 返回结果摘要"""
+        started = time.time()
+        result = {"name": target["name"], "root": target["root"]}
+        try:
+            if isinstance(archive, Exception):
+                raise Exception(f"下载v2ray失败: {archive}")
+            deployer = self.make_deployer(target)
+            # 内存中的压缩包每个目标使用独立的文件对象
+            target_archive = io.BytesIO(archive) if isinstance(archive, bytes) else archive
+            graph = deployer.build_deploy_graph(target_archive, target.get("server_ip", server_ip))
+            graph.run()
+            result.update({
+                "success": True,
+                "uuid": deployer.user_uuid,
+                "port": deployer.port,
+                "timings": graph.timings
+            })
+        except Exception as e:
+            result.update({"success": False, "error": str(e)})
+        result["elapsed"] = time.time() - started
+        return result
+
+    def run(self, archive=None, server_ip=None):
+        """并发部署所有目标, 返回各目标的结果 (指定archive时所有目标使用该压缩包)"""
+        started = time.time()
+        archives = self.fetch_artifacts() if archive is None else None
+        if server_ip is None:
+            server_ip = self.template.get_public_ip()
+
+        def deploy(target):
+            return self.deploy_target(target, archives[artifact_key(target)] if archives else archive, server_ip)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(deploy, self.targets))
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        summary = {
+            "total": len(results),
+            "succeeded": sum(1 for r in results if r["success"]),
+            "elapsed": time.time() - started,
+            "results": results
+        }
+        with open(os.path.join(self.output_dir, "fleet_results.json"), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+        return summary
+
+
+def print_summary(summary):
+    """打印批量部署结果"""
+    print("=" * 60)
+    print(f"{'目标':<20} {'结果':<6} {'耗时':<8} 说明")
+    print("-" * 60)
+    for result in summary["results"]:
+        status = "成功" if result["success"] else "失败"
+        detail = f"端口 {result['port']}" if result["success"] else result["error"]
+        print(f"{result['name']:<20} {status:<6} {result['elapsed']:<8.2f} {detail}")
+    print("=" * 60)
+    print(f"完成 {summary['succeeded']}/{summary['total']}, 总耗时 {summary['elapsed']:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='V2Ray 批量部署工具')
+    parser.add_argument('inventory', help='部署清单文件 (YAML/JSON)')
+    parser.add_argument('--workers', type=int, default=4, help='并发部署的目标数')
+    parser.add_argument('--output', default='fleet_configs', help='客户端配置输出目录')
+    args = parser.parse_args()
+
+    fleet = FleetDeployer(load_inventory(args.inventory), args.workers, args.output)
+    summary = fleet.run()
+    print_summary(summary)
+    sys.exit(0 if summary["succeeded"] == summary["total"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import socket
+import struct
+
+# v2ray HandlerService的AlterInbound: 在运行中的进程里添加或删除入站用户, 不需要重启服务
+# 直接以gRPC (明文HTTP/2) 调用, 请求手工编码为protobuf, 不依赖grpcio
+ALTER_INBOUND = "/v2ray.core.app.proxyman.command.HandlerService/AlterInbound"
+ADD_USER_TYPE = "v2ray.core.app.proxyman.command.AddUserOperation"
+REMOVE_USER_TYPE = "v2ray.core.app.proxyman.command.RemoveUserOperation"
+VMESS_ACCOUNT_TYPE = "v2ray.core.proxy.vmess.Account"
+
+PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+FRAME_DATA, FRAME_HEADERS, FRAME_RST_STREAM, FRAME_SETTINGS = 0x0, 0x1, 0x3, 0x4
+FRAME_PING, FRAME_GOAWAY, FRAME_WINDOW_UPDATE = 0x6, 0x7, 0x8
+FLAG_END_STREAM, FLAG_ACK, FLAG_END_HEADERS = 0x1, 0x1, 0x4
+
+
+class HandlerError(RuntimeError):
+    """API拒绝了请求 (例如用户已存在或入站不存在)"""
+
+
+def encode_varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def encode_field(number, value):
+    """编码protobuf字段: int为varint, str/bytes为length-delimited, 值为空时省略"""
+    if not value:
+        return b""
+    if isinstance(value, int):
+        return encode_varint(number << 3) + encode_varint(value)
+    if isinstance(value, str):
+        value = value.encode()
+    return encode_varint(number << 3 | 2) + encode_varint(len(value)) + value
+
+
+def typed_message(type_name, value):
+    """v2ray.core.common.serial.TypedMessage"""
+    return encode_field(1, type_name) + encode_field(2, value)
+
+
+def add_user_request(tag, client):
+    """添加VMess用户的AlterInboundRequest"""
+    account = encode_field(1, client["id"]) + encode_field(2, client.get("alterId", 0))
+    user = (encode_field(1, client.get("level", 0)) + encode_field(2, client.get("email", ""))
+            + encode_field(3, typed_message(VMESS_ACCOUNT_TYPE, account)))
+    return encode_field(1, tag) + encode_field(2, typed_message(ADD_USER_TYPE, encode_field(1, user)))
+
+
+def remove_user_request(tag, email):
+    """按email删除用户的AlterInboundRequest"""
+    return encode_field(1, tag) + encode_field(2, typed_message(REMOVE_USER_TYPE, encode_field(1, email)))
+
+
+def encode_hpack_int(value, prefix_bits):
+    limit = (1 << prefix_bits) - 1
+    if value < limit:
+        return bytes([value])
+    out = bytearray([limit])
+    value -= limit
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def encode_header(name, value):
+    """HPACK不索引的字面量头部 (不使用Huffman编码)"""
+    def string(text):
+        data = text.encode()
+        return encode_hpack_int(len(data), 7) + data
+    return b"\x00" + string(name) + string(value)
+
+
+def frame(frame_type, flags, stream_id, payload=b""):
+    return struct.pack(">I", len(payload))[1:] + bytes([frame_type, flags]) + \
+        struct.pack(">I", stream_id) + payload
+
+
+class HandlerClient:
+    """HandlerService客户端, 多次调用复用同一个HTTP/2连接
+
+    只根据是否收到响应消息判断成功: 出错时v2ray只返回带grpc-status的trailers (没有DATA帧),
+    因此不需要解码服务端的HPACK头部
+    """
+
+    def __init__(self, server, timeout=5):
+        self.server = server
+        self.timeout = timeout
+        self.sock = None
+        self.stream_id = 1
+        self.buffer = b""
+
+    def connect(self):
+        host, _, port = self.server.rpartition(":")
+        self.sock = socket.create_connection((host, int(port)), timeout=self.timeout)
+        # 请求和流量窗口更新都是小包, 关闭Nagle避免每次调用等待延迟ACK
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(PREFACE + frame(FRAME_SETTINGS, 0, 0))
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read_frame(self):
+        while len(self.buffer) < 9 or len(self.buffer) < 9 + int.from_bytes(self.buffer[:3], 'big'):
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError(f"API连接已关闭 ({self.server})")
+            self.buffer += data
+        length = int.from_bytes(self.buffer[:3], 'big')
+        frame_type, flags = self.buffer[3], self.buffer[4]
+        stream_id = struct.unpack(">I", self.buffer[5:9])[0] & 0x7fffffff
+        payload, self.buffer = self.buffer[9:9 + length], self.buffer[9 + length:]
+        return frame_type, flags, stream_id, payload
+
+    def call(self, path, message):
+        """发送一元gRPC请求, 成功时返回响应消息, API拒绝时抛出HandlerError"""
+        if self.sock is None:
+            self.connect()
+        stream_id = self.stream_id
+        self.stream_id += 2
+        headers = b"".join(encode_header(name, value) for name, value in [
+            (":method", "POST"), (":scheme", "http"), (":path", path),
+            (":authority", self.server), ("content-type", "application/grpc"), ("te", "trailers")])
+        body = b"\x00" + struct.pack(">I", len(message)) + message
+        self.sock.sendall(frame(FRAME_HEADERS, FLAG_END_HEADERS, stream_id, headers)
+                          + frame(FRAME_DATA, FLAG_END_STREAM, stream_id, body))
+
+        response = None
+        while True:
+            frame_type, flags, sid, payload = self.read_frame()
+            if frame_type == FRAME_SETTINGS and not flags & FLAG_ACK:
+                self.sock.sendall(frame(FRAME_SETTINGS, FLAG_ACK, 0))
+            elif frame_type == FRAME_PING and not flags & FLAG_ACK:
+                self.sock.sendall(frame(FRAME_PING, FLAG_ACK, 0, payload))
+            elif frame_type == FRAME_GOAWAY:
+                self.close()
+                raise ConnectionError(f"API关闭了连接 ({self.server})")
+            elif sid != stream_id:
+                continue
+            elif frame_type == FRAME_RST_STREAM:
+                raise HandlerError(f"API重置了请求 ({self.server})")
+            else:
+                if frame_type == FRAME_DATA:
+                    response = (response or b"") + payload
+                    if payload:
+                        # 归还连接级流量窗口, 同一连接上可以连续发送大量请求
+                        self.sock.sendall(frame(FRAME_WINDOW_UPDATE, 0, 0, struct.pack(">I", len(payload))))
+                if flags & FLAG_END_STREAM:
+                    break
+        if response is None:
+            raise HandlerError(f"API拒绝了请求 ({self.server} {path})")
+        return response[5:]
+
+    def add_user(self, tag, client):
+        self.call(ALTER_INBOUND, add_user_request(tag, client))
+
+    def remove_user(self, tag, email):
+        self.call(ALTER_INBOUND, remove_user_request(tag, email))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import fcntl
+import tempfile
+import contextlib
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """在path上加排他锁 (flock), 多个manage.py进程之间互斥; 进程退出时锁自动释放"""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, content):
+    """写入同目录下的临时文件, fsync后重命名, 崩溃时不会留下写了一半的文件; 保留原文件的权限"""
+    data = content.encode('utf-8') if isinstance(content, str) else content
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except OSError:
+        mode = 0o644
+    directory, name = os.path.split(path)
+    directory = directory or "."
+    fd, tmp_file = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_file, mode)
+        os.replace(tmp_file, path)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    # 重命名本身也要落盘
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class Journal:
+    """只追加的用户变更日志 (JSONL), 记录已写入用户库但可能尚未渲染到config.json的变更
+
+    追加和截断使用单独的短锁, 不会等待正在渲染配置的进程; 应用后的记录会被删除, 日志保持很小
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+
+    def append(self, entries):
+        """追加记录并fsync"""
+        data = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries)
+        with file_lock(self.lock_path):
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def pending(self):
+        """返回 (未应用的记录, 读到的字节数)"""
+        with file_lock(self.lock_path):
+            try:
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                return [], 0
+        # 崩溃时可能留下不完整的最后一行, 留到下次再读
+        size = data.rfind(b"\n") + 1
+        entries = [json.loads(line) for line in data[:size].splitlines() if line.strip()]
+        return entries, size
+
+    def discard(self, size):
+        """删除前size字节 (已应用的记录), 保留之后追加的记录"""
+        with file_lock(self.lock_path):
+            try:
+                with open(self.path, 'rb') as f:
+                    rest = f.read()[size:]
+            except FileNotFoundError:
+                return
+            atomic_write(self.path, rest)
@@ -4,62 +4,363 @@
 import os
 import sys
 import json
-import uuid
-import subprocess
 import argparse
-from pathlib import Path
+# manage.py常被cron和监控脚本调用, uuid、subprocess等模块只在用到时导入
+from sharding import find_instances, instance_config_file, instance_name, shard_for, unit_name
+
+DEFAULT_SOCKET = "/run/v2ray-manage.sock"
+DEFAULT_RELOAD_WINDOW = 5.0
+# import_users中表示导入后的client需要从用户库读取
+UPDATED = object()
+
+def copy_config(config):
+    """复制配置用于修改, 用户列表 (只会被整体替换) 不复制"""
+    import copy
+    memo = {}
+    for inbound in config.get("inbounds", []):
+        clients = inbound.get("settings", {}).get("clients")
+        if clients is not None:
+            memo[id(clients)] = clients
+    return copy.deepcopy(config, memo)
 
 class V2rayManager:
-    def __init__(self):
-        self.config_file = "/etc/v2ray/config.json"
+    def __init__(self, config_file="/etc/v2ray/config.json"):
+        self.config_file = config_file
         self.service_name = "v2ray"
         self.log_dir = "/var/log/v2ray"
+        self.v2ray_binary = "/usr/local/v2ray/v2ray"
+        # 多实例部署 (配置目录下的shard<i>/config.json) 时为实例数, 单实例为0
+        self.instances = find_instances(os.path.dirname(config_file))
+        # 用户库 (SQLite) 是用户的唯一来源, config.json中的clients由它渲染; 不存在时从现有配置迁移
+        self.user_db = os.path.join(os.path.dirname(config_file), "users.db")
+        self._store = None
+        # 配置文件的读-改-写在锁文件的排他锁内进行; 用户变更先记入日志, 再批量渲染到config.json
+        self.lock_file = os.path.join(os.path.dirname(config_file), ".config.lock")
+        self.journal_file = os.path.join(os.path.dirname(config_file), "users.journal")
+        # 常驻进程 (manage.py daemon) 使用: cache_configs缓存解析后的配置 (文件变化时重新读取),
+        # defer_render时用户变更只记入日志, 由flush_journal批量渲染
+        self.cache_configs = False
+        self.defer_render = False
+        self._config_cache = {}
+        # 用户变更优先通过HandlerService推送到运行中的实例; 推送失败的实例记录在这里, 需要重启
+        self.api_timeout = 5
+        self.pending_restarts = set()
+        # 重启请求记录在状态文件中, reload_window秒内没有新请求时合并为一次重启 (多个进程共享);
+        # defer_reload时只登记请求, 由调用方 (守护进程) 到期后执行
+        self.reload_state = os.path.join(os.path.dirname(config_file), ".reload.pending")
+        self.reload_window = DEFAULT_RELOAD_WINDOW
+        self.defer_reload = False
+        # 平滑重启: 临时实例接收新连接, health_wait秒后仍在运行才重启主服务, 主服务恢复后两者并存overlap_time秒再停止临时实例
+        # v2ray停止时直接断开已有连接, 平滑重启只保证新连接不被拒绝, 主服务和临时实例上的已有连接都会断开
+        self.zero_downtime = False
+        self.health_wait = 2
+        self.overlap_time = 10
+        self.systemctl = "systemctl"
+        self.systemd_run = "systemd-run"
+
+    def shards(self):
+        """所有实例的分片序号, 单实例部署时为 [None]"""
+        return list(range(self.instances)) if self.instances else [None]
+
+    def shard_of(self, user_id):
+        """用户所在的实例, 单实例部署时为None"""
+        return shard_for(user_id, self.instances) if self.instances else None
+
+    def shard_config_file(self, shard=None):
+        if shard is None:
+            return self.config_file
+        return instance_config_file(os.path.dirname(self.config_file), shard)
+
+    def shard_log_dir(self, shard=None):
+        if shard is None:
+            return self.log_dir
+        return f"{self.log_dir}/{instance_name(shard)}"
+
+    def units(self, shard=None):
+        """要操作的服务: 指定实例时只有该实例, 否则为所有实例"""
+        if shard is not None:
+            return [unit_name(self.service_name, shard)]
+        return [unit_name(self.service_name, s) for s in self.shards()]
+
+    def restart_hint(self, shard=None):
+        """提示需要重启的服务 (多实例时只需重启用户所在的实例)"""
+        option = f" --shard {shard}" if shard is not None else ""
+        print(f"请重启服务以使配置生效: python3 manage.py reload{option} "
+              f"(或 systemctl restart {' '.join(self.units(shard))})")
+
+    def restart_pending(self, restart=False):
+        """重启 (restart为False时提示重启) 无法通过API更新的实例, 没有时返回False"""
+        if not self.pending_restarts:
+            return False
+        shards = sorted(self.pending_restarts, key=lambda s: -1 if s is None else s)
+        # 只涉及一个实例时只重启该实例, 否则一次重启所有实例
+        shard = shards[0] if len(shards) == 1 else None
+        self.pending_restarts.clear()
+        if restart:
+            self.schedule_restart(shards)
+            return True if self.defer_reload else self.reload()
+        self.restart_hint(shard)
+        return True
+
+    def reload_scheduler(self):
+        from reloader import ReloadScheduler
+        return ReloadScheduler(self.reload_state, self.reload_window)
 
-    def load_config(self):
-        """加载配置文件"""
+    def schedule_restart(self, shards):
+        """登记需要重启的实例, reload_window秒内的多次请求合并为一次重启"""
+        self.reload_scheduler().request(shards)
+        print(f"服务将在 {self.reload_window:g} 秒内没有新的变更后重启")
+
+    def reload(self, wait=True):
+        """执行合并后的重启
+
+        wait为True时等到截止时间不再被推迟, 请求已被其他进程执行时直接返回True;
+        wait为False时截止时间未到或没有请求则返回None
+        """
+        scheduler = self.reload_scheduler()
+        shards = scheduler.wait() if wait else scheduler.take_due()
+        if shards is None:
+            if wait:
+                print("待重启的服务已由其他进程重启")
+                return True
+            return None
+        if self.zero_downtime:
+            return all([self.handover(shard) for shard in shards])
+        # 只涉及一个实例时只重启该实例, 否则一次重启所有实例
+        return self.restart_service(shards[0] if len(shards) == 1 else None)
+
+    def handover(self, shard=None):
+        """平滑重启一个实例, 失败时退回普通重启
+
+        临时实例 (systemd-run启动) 以新配置通过SO_REUSEPORT监听同一端口, 确认健康后重启主服务,
+        主服务恢复后等待overlap_time秒再停止临时实例, 重启期间的新连接由临时实例接收, 不会被拒绝;
+        这不是连接排空: 主服务重启时和临时实例停止时, 各自的已有连接都会断开
+        """
+        import time
+        import subprocess
+        from locking import atomic_write
+        from reloader import enable_reuse_port, handover_config
+        unit = self.units(shard)[0]
+        handover_unit = f"{self.service_name}-handover"
+        if shard is not None:
+            handover_unit += f"-{instance_name(shard)}"
+        path = os.path.join(os.path.dirname(self.shard_config_file(shard)), "handover.json")
+
+        with self.config_lock():
+            config = self.load_config(shard)
+            if not config:
+                return False
+            if enable_reuse_port(config):
+                # 运行中的进程没有开启SO_REUSEPORT, 临时实例无法绑定同一端口
+                if not self.save_config(config, shard):
+                    print("保存配置失败!")
+                    return False
+                print("已为入站开启reusePort, 本次使用普通重启, 之后的重启可以平滑进行")
+                return self.restart_service(shard)
+            config = handover_config(config, self.shard_log_dir(shard))
+            atomic_write(path, json.dumps(config, indent=2, ensure_ascii=False))
+
+        started = False
+        try:
+            subprocess.run([self.v2ray_binary, "test", "-config", path],
+                           check=True, capture_output=True)
+            subprocess.run([self.systemd_run, f"--unit={handover_unit}", "--collect",
+                            self.v2ray_binary, "run", "-config", path], check=True, capture_output=True)
+            started = True
+            if not self.wait_active(handover_unit):
+                raise RuntimeError("临时实例启动失败")
+            subprocess.run([self.systemctl, "restart", unit], check=True)
+            if not self.wait_active(unit):
+                raise RuntimeError(f"{unit} 重启后没有运行")
+            time.sleep(self.overlap_time)
+            print(f"{unit} 已平滑重启 (没有拒绝新连接, 已有连接已断开)")
+            return True
+        except (OSError, subprocess.CalledProcessError, RuntimeError) as e:
+            print(f"平滑重启失败, 改为普通重启: {e}")
+            return self.restart_service(shard)
+        finally:
+            if started:
+                subprocess.run([self.systemctl, "stop", handover_unit], capture_output=True)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def wait_active(self, unit):
+        """等待health_wait秒后检查服务是否仍在运行 (绑定端口失败等启动错误会在此之前退出)"""
+        import time
+        import subprocess
+        time.sleep(self.health_wait)
+        result = subprocess.run([self.systemctl, 'is-active', unit], capture_output=True, text=True)
+        return result.stdout.strip() == "active"
+
+    def load_config(self, shard=None):
+        """加载配置文件 (shard为实例序号时加载该实例的配置)"""
+        path = self.shard_config_file(shard)
         try:
-            with open(self.config_file, 'r') as f:
-                return json.load(f)
+            if not self.cache_configs:
+                with open(path, 'r') as f:
+                    return json.load(f)
+            stat = os.stat(path)
+            key = (stat.st_mtime_ns, stat.st_size)
+            cached = self._config_cache.get(path)
+            if cached is None or cached[0] != key:
+                with open(path, 'r') as f:
+                    cached = (key, json.load(f))
+                self._config_cache[path] = cached
+            return copy_config(cached[1])
         except Exception as e:
             print(f"加载配置文件失败: {e}")
             return None
 
-    def save_config(self, config):
-        """保存配置文件"""
+    def save_config(self, config, shard=None):
+        """保存配置文件 (写入临时文件并fsync后重命名, 中途崩溃不会留下不完整的配置)"""
+        from locking import atomic_write
         try:
-            with open(self.config_file, 'w') as f:
-                json.dump(config, f, indent=2, ensure_ascii=False)
+            path = self.shard_config_file(shard)
+            atomic_write(path, json.dumps(config, indent=2, ensure_ascii=False))
+            if self.cache_configs:
+                stat = os.stat(path)
+                self._config_cache[path] = ((stat.st_mtime_ns, stat.st_size), copy_config(config))
             return True
         except Exception as e:
             print(f"保存配置文件失败: {e}")
             return False
 
-    def restart_service(self):
-        """重启服务"""
+    def config_lock(self):
+        """配置文件读-改-写期间持有的排他锁, 多个manage.py进程之间互斥"""
+        from locking import file_lock
+        return file_lock(self.lock_file)
+
+    def user_store(self):
+        """打开用户库, 第一次使用时从各实例的config.json迁移现有用户, 迁移失败时返回None"""
+        if self._store is None:
+            from user_store import UserStore
+            migrate = not os.path.exists(self.user_db)
+            self._store = UserStore(self.user_db)
+            if migrate and self.migrate_users() is None:
+                self._store.close()
+                self._store = None
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(self.user_db + suffix):
+                        os.remove(self.user_db + suffix)
+        return self._store
+
+    def migrate_users(self):
+        """将各实例config.json中的用户导入用户库 (已存在的UUID跳过), 返回导入的用户数"""
+        store = self.user_store()
+        imported = 0
+        for shard in self.shards():
+            config = self.load_config(shard)
+            if not config:
+                return None
+            for inbound in config.get("inbounds", [])[:1]:
+                imported += store.import_clients(inbound.get("settings", {}).get("clients", []), shard)
+        if imported:
+            print(f"已从配置文件迁移 {imported} 个用户到 {self.user_db}")
+        return imported
+
+    def commit_users(self, entries):
+        """记录已写入用户库的变更并渲染受影响的实例配置, 返回 {实例: 配置}, 失败时返回None
+
+        变更先追加到日志, 再在配置锁内一次渲染日志中所有待应用的变更: 并发的manage.py中拿到锁的
+        进程会顺带写入其他进程的变更, 其他进程拿到锁后不再重写配置文件。崩溃后留在日志中的变更在
+        下一次提交时渲染
+        """
+        from locking import Journal
+        Journal(self.journal_file).append(entries)
+        rendered = {} if self.defer_render else self.flush_journal()
+        if rendered is None:
+            return None
+
+        configs = {}
+        for shard in dict.fromkeys(entry["shard"] for entry in entries):
+            # 已由其他进程渲染或推迟渲染的实例只读取配置
+            configs[shard] = rendered.get(shard) or self.load_config(shard)
+            if not configs[shard]:
+                return None
+        return configs
+
+    def flush_journal(self):
+        """在配置锁内渲染日志中所有待写入的变更涉及的实例, 返回 {实例: 配置}, 失败时返回None"""
+        from locking import Journal
+        journal = Journal(self.journal_file)
+        with self.config_lock():
+            pending, size = journal.pending()
+            rendered = {}
+            for shard in dict.fromkeys(entry["shard"] for entry in pending):
+                config = self.render_users(shard)
+                if not config:
+                    return None
+                rendered[shard] = config
+            journal.discard(size)
+        return rendered
+
+    def render_users(self, shard=None):
+        """按用户库重新生成实例配置中的clients, 返回保存的配置, 失败时返回None (调用方持有配置锁)"""
+        config = self.load_config(shard)
+        if not config:
+            return None
+        if "inbounds" not in config or len(config["inbounds"]) == 0:
+            print("配置文件格式错误!")
+            return None
+        settings = config["inbounds"][0].setdefault("settings", {})
+        settings["clients"] = self.user_store().clients(shard)
+        if not self.save_config(config, shard):
+            print("保存配置失败!")
+            return None
+        return config
+
+    def push_users(self, config, shard=None, adds=(), removes=()):
+        """通过HandlerService把用户变更推送到运行中的实例, 不需要重启服务
+
+        adds为要添加的client, removes为要删除的用户的email (API按email删除用户)。
+        API不可用、被删除的用户没有email或推送失败时, 将实例记为需要重启并返回False
+        """
+        from stats import find_api_server, find_proxy_tag
+        server, tag = find_api_server(config), find_proxy_tag(config)
+        if server and tag and all(removes):
+            from handler_api import HandlerClient, HandlerError
+            try:
+                with HandlerClient(server, self.api_timeout) as client:
+                    for email in removes:
+                        client.remove_user(tag, email)
+                    for user in adds:
+                        client.add_user(tag, user)
+                return True
+            except (OSError, HandlerError) as e:
+                print(f"无法通过API更新运行中的服务: {e}")
+        self.pending_restarts.add(shard)
+        return False
+
+    def restart_service(self, shard=None):
+        """重启服务 (多实例时默认重启所有实例)"""
+        import subprocess
         try:
-            subprocess.run(['systemctl', 'restart', self.service_name], check=True)
+            subprocess.run([self.systemctl, 'restart'] + self.units(shard), check=True)
             print("服务重启成功!")
             return True
         except subprocess.CalledProcessError as e:
             print(f"服务重启失败: {e}")
             return False
 
-    def get_service_status(self):
+    def get_service_status(self, shard=None):
         """获取服务状态"""
+        import subprocess
         try:
-            result = subprocess.run(['systemctl', 'is-active', self.service_name],
+            result = subprocess.run([self.systemctl, 'is-active'] + self.units(shard),
                                   capture_output=True, text=True)
             return result.stdout.strip()
         except:
             return "unknown"
 
     def add_user(self, email=None):
-        """添加新用户"""
-        config = self.load_config()
-        if not config:
+        """添加新用户 (多实例时写入按UUID分配的实例)"""
+        import uuid
+        new_uuid = str(uuid.uuid4())
+        shard = self.shard_of(new_uuid)
+        store = self.user_store()
+        if store is None:
             return False
 
-        new_uuid = str(uuid.uuid4())
         new_user = {
             "id": new_uuid,
             "alterId": 0
@@ -68,102 +369,227 @@ class V2rayManager:
         if email:
             new_user["email"] = email
 
-        # 添加到第一个inbound的clients中
-        if "inbounds" in config and len(config["inbounds"]) > 0:
-            if "settings" not in config["inbounds"][0]:
-                config["inbounds"][0]["settings"] = {}
-            if "clients" not in config["inbounds"][0]["settings"]:
-                config["inbounds"][0]["settings"]["clients"] = []
-            
-            config["inbounds"][0]["settings"]["clients"].append(new_user)
-            
-            if self.save_config(config):
-                print(f"用户添加成功!")
-                print(f"UUID: {new_uuid}")
-                if email:
-                    print(f"Email: {email}")
-                return new_uuid
-            else:
-                print("保存配置失败!")
-                return False
-        else:
-            print("配置文件格式错误!")
+        store.add(new_user, shard)
+        configs = self.commit_users([{"op": "add", "uuid": new_uuid, "email": email, "shard": shard}])
+        if not configs:
+            store.remove(new_uuid)
             return False
+        config = configs[shard]
+
+        print(f"用户添加成功!")
+        print(f"UUID: {new_uuid}")
+        if email:
+            print(f"Email: {email}")
+        if shard is not None:
+            print(f"实例: {instance_name(shard)} (端口 {config['inbounds'][0].get('port')})")
+        if self.push_users(config, shard, adds=[new_user]):
+            print("已通过API生效, 无需重启服务")
+        return new_uuid
 
     def remove_user(self, user_id):
-        """删除用户"""
-        config = self.load_config()
-        if not config:
+        """删除用户 (多实例时从用户所在的实例删除)"""
+        store = self.user_store()
+        if store is None:
             return False
 
-        if "inbounds" in config and len(config["inbounds"]) > 0:
-            clients = config["inbounds"][0]["settings"].get("clients", [])
-            
-            # 查找并删除用户
-            original_count = len(clients)
-            config["inbounds"][0]["settings"]["clients"] = [
-                client for client in clients if client["id"] != user_id
-            ]
-            
-            if len(config["inbounds"][0]["settings"]["clients"]) < original_count:
-                if self.save_config(config):
-                    print(f"用户 {user_id} 删除成功!")
-                    return True
-                else:
-                    print("保存配置失败!")
-                    return False
-            else:
-                print("未找到指定的用户!")
-                return False
-        else:
-            print("配置文件格式错误!")
+        user = store.get(user_id)
+        if user is None:
+            print("未找到指定的用户!")
+            return False
+
+        shard, client = user
+        store.remove(user_id)
+        configs = self.commit_users([{"op": "remove", "uuid": client["id"],
+                                      "email": client.get("email"), "shard": shard}])
+        if not configs:
+            store.add(client, shard)
             return False
+        config = configs[shard]
+        print(f"用户 {user_id} 删除成功!")
+        if self.push_users(config, shard, removes=[client.get("email")]):
+            print("已通过API生效, 无需重启服务")
+        return True
+
+    def import_users(self, path, fmt=None):
+        """从CSV/JSONL文件批量添加、删除和更新用户
+
+        所有变更在一个事务中写入用户库, 每个受影响的实例只重写一次配置文件, 并通过API推送到运行中的实例;
+        UUID或email已存在的添加、找不到用户的删除和更新会被跳过。返回受影响的实例列表, 失败时返回None
+        """
+        import time
+        import uuid
+        import sqlite3
+        from user_store import read_records, record_format
+        store = self.user_store()
+        if store is None:
+            return None
+
+        started = time.perf_counter()
+        users = store.index()
+        emails = {email: user_id for user_id, (_, email) in users.items() if email}
+        # 按文件中的顺序执行的变更
+        ops = []
+        counts = {"add": 0, "remove": 0, "update": 0, "skip": 0}
+        touched = {}
+        # 变更涉及的用户导入前的 (所在实例, email) 和导入后的 (所在实例, client), 用于推送到运行中的实例;
+        # 导入后的client为None表示已删除, 为UPDATED时从用户库读取
+        before, after = {}, {}
+        try:
+            fmt = record_format(path, fmt)
+            with (sys.stdin if path == "-" else open(path, 'r', encoding='utf-8', newline='')) as f:
+                for record in read_records(f, fmt):
+                    action, email = record["action"], record["email"]
+                    user_id = (record["uuid"] or emails.get(email, "")).lower()
+                    if action == "add":
+                        client_id = record["uuid"] or str(uuid.uuid4())
+                        user_id = client_id.lower()
+                        if user_id in users or (email and email in emails):
+                            counts["skip"] += 1
+                            continue
+                        shard = self.shard_of(client_id)
+                        client = {"id": client_id, "alterId": record["alterId"] or 0}
+                        if email:
+                            client["email"] = email
+                            emails[email] = user_id
+                        before.setdefault(user_id, users.get(user_id))
+                        users[user_id] = (shard, email)
+                        ops.append(("add", client, shard))
+                        after[user_id] = (shard, client)
+                    elif user_id not in users:
+                        counts["skip"] += 1
+                        continue
+                    elif action == "remove":
+                        before.setdefault(user_id, users[user_id])
+                        shard, old_email = users.pop(user_id)
+                        emails.pop(old_email, None)
+                        ops.append(("remove", user_id))
+                        after[user_id] = (shard, None)
+                    else:
+                        shard, old_email = users[user_id]
+                        if email and emails.get(email, user_id) != user_id:
+                            counts["skip"] += 1
+                            continue
+                        before.setdefault(user_id, users[user_id])
+                        if email and email != old_email:
+                            emails.pop(old_email, None)
+                            emails[email] = user_id
+                            users[user_id] = (shard, email)
+                        ops.append(("update", user_id, email, record["alterId"]))
+                        after[user_id] = (shard, UPDATED)
+                    counts[action] += 1
+                    touched.setdefault(shard, {"add": 0, "remove": 0, "update": 0})[action] += 1
+        except (OSError, ValueError) as e:
+            print(f"读取导入文件失败: {e}")
+            return None
+
+        try:
+            store.apply(ops)
+        except sqlite3.Error as e:
+            print(f"写入用户库失败: {e}")
+            return None
+        # 每个实例要推送的 (添加的client, 删除的email): 先删除导入前的用户, 再添加导入后的用户
+        live = {shard: ([], []) for shard in touched}
+        for user_id, (shard, client) in after.items():
+            if before[user_id]:
+                live.setdefault(before[user_id][0], ([], []))[1].append(before[user_id][1])
+            if client is UPDATED:
+                found = store.get(user_id)
+                client = found[1] if found else None
+            if client is not None:
+                live.setdefault(shard, ([], []))[0].append(client)
+        # 日志中每个实例只记一条汇总
+        configs = self.commit_users([dict(op="import", shard=shard, **changes)
+                                     for shard, changes in touched.items()])
+        if configs is None:
+            return None
+        for shard, config in configs.items():
+            self.push_users(config, shard, *live[shard])
+
+        elapsed = time.perf_counter() - started
+        total = sum(counts.values())
+        print(f"导入 {total} 条记录: 添加 {counts['add']}, 删除 {counts['remove']}, "
+              f"更新 {counts['update']}, 跳过 {counts['skip']}")
+        print(f"耗时 {elapsed:.2f}s ({total / elapsed if elapsed else 0:.0f} 条/秒)")
+        return sorted(touched, key=lambda s: -1 if s is None else s)
+
+    def export_users(self, path, fmt=None):
+        """将所有用户逐条导出为CSV/JSONL文件 (path为 - 时输出到标准输出), 返回导出的用户数"""
+        from user_store import record_format, write_records
+        store = self.user_store()
+        if store is None:
+            return None
+        try:
+            fmt = record_format(path, fmt)
+            if path == "-":
+                return write_records(sys.stdout, store.iter_users(), fmt)
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                count = write_records(f, store.iter_users(), fmt)
+        except (OSError, ValueError) as e:
+            print(f"导出用户失败: {e}")
+            return None
+        print(f"已导出 {count} 个用户到 {path}")
+        return count
 
     def list_users(self):
-        """列出所有用户"""
-        config = self.load_config()
-        if not config:
+        """列出所有用户 (多实例时列出各实例的用户)"""
+        store = self.user_store()
+        if store is None:
             return
+        rows = store.users()
 
-        if "inbounds" in config and len(config["inbounds"]) > 0:
-            clients = config["inbounds"][0]["settings"].get("clients", [])
-            
-            if not clients:
-                print("没有找到用户")
-                return
+        if not rows:
+            print("没有找到用户")
+            return
 
+        if self.instances:
+            print(f"{'序号':<5} {'UUID':<38} {'Email':<20} {'实例':<8}")
+            print("-" * 75)
+        else:
             print(f"{'序号':<5} {'UUID':<38} {'Email':<20}")
             print("-" * 65)
-            
-            for i, client in enumerate(clients, 1):
-                email = client.get("email", "N/A")
-                print(f"{i:<5} {client['id']:<38} {email:<20}")
-        else:
-            print("配置文件格式错误!")
+
+        for i, (shard, client) in enumerate(rows, 1):
+            email = client.get("email", "N/A")
+            line = f"{i:<5} {client['id']:<38} {email:<20}"
+            if shard is not None:
+                line += f" {instance_name(shard):<8}"
+            print(line)
 
     def change_port(self, new_port):
-        """修改端口"""
-        config = self.load_config()
-        if not config:
-            return False
+        """修改端口 (多实例时实例i使用 new_port+i)"""
+        with self.config_lock():
+            if not self._change_port(new_port):
+                return False
+        print("请记得更新防火墙规则!")
+        return True
 
-        if "inbounds" in config and len(config["inbounds"]) > 0:
-            old_port = config["inbounds"][0].get("port", "unknown")
-            config["inbounds"][0]["port"] = int(new_port)
-            
-            if self.save_config(config):
-                print(f"端口已从 {old_port} 修改为 {new_port}")
-                print("请记得更新防火墙规则!")
-                return True
+    def _change_port(self, new_port):
+        for shard in self.shards():
+            config = self.load_config(shard)
+            if not config:
+                return False
+
+            if "inbounds" in config and len(config["inbounds"]) > 0:
+                port = int(new_port) + (shard or 0)
+                old_port = config["inbounds"][0].get("port", "unknown")
+                config["inbounds"][0]["port"] = port
+
+                if self.save_config(config, shard):
+                    name = f"{instance_name(shard)} " if shard is not None else ""
+                    print(f"{name}端口已从 {old_port} 修改为 {port}")
+                else:
+                    print("保存配置失败!")
+                    return False
             else:
-                print("保存配置失败!")
+                print("配置文件格式错误!")
                 return False
-        else:
-            print("配置文件格式错误!")
-            return False
+        return True
 
     def show_config(self):
         """显示当前配置"""
+        if self.instances:
+            self.show_instances()
+            return
         config = self.load_config()
         if not config:
             return
@@ -180,33 +606,141 @@ class V2rayManager:
             print(f"协议: {protocol}")
             print(f"端口: {port}")
             print(f"用户数量: {len(clients)}")
+            from tuning import detect_profile
+            print(f"性能配置: {detect_profile(config) or '自定义'}")
             print(f"服务状态: {self.get_service_status()}")
             print("="*50)
         else:
             print("配置文件格式错误!")
 
-    def show_logs(self, log_type="error", lines=50):
-        """显示日志"""
-        if log_type == "error":
-            log_file = f"{self.log_dir}/error.log"
-        elif log_type == "access":
-            log_file = f"{self.log_dir}/access.log"
-        else:
+    def show_instances(self):
+        """显示多实例部署中每个实例的端口、用户数和状态"""
+        from tuning import detect_profile
+        print("="*50)
+        print(f"V2Ray 服务器配置信息 ({self.instances} 个实例)")
+        print("="*50)
+        print(f"{'实例':<10} {'端口':<8} {'用户数':<8} {'状态':<10}")
+        print("-" * 50)
+        total = 0
+        profile = None
+        for shard in self.shards():
+            config = self.load_config(shard)
+            if not config:
+                return
+            inbound = config["inbounds"][0]
+            clients = inbound.get("settings", {}).get("clients", [])
+            total += len(clients)
+            profile = profile or detect_profile(config)
+            print(f"{instance_name(shard):<10} {inbound.get('port', 'N/A'):<8} "
+                  f"{len(clients):<8} {self.get_service_status(shard):<10}")
+        print("-" * 50)
+        print(f"用户总数: {total}")
+        print(f"性能配置: {profile or '自定义'}")
+        print("="*50)
+
+    def set_profile(self, name):
+        """切换服务端性能配置"""
+        with self.config_lock():
+            return self._set_profile(name)
+
+    def _set_profile(self, name):
+        from tuning import apply_profile, validate_config
+        configs = {}
+        for shard in self.shards():
+            config = self.load_config(shard)
+            if not config:
+                return False
+            try:
+                apply_profile(config, name, self.shard_log_dir(shard))
+                validate_config(config, name)
+            except ValueError as e:
+                print(f"切换性能配置失败: {e}")
+                return False
+            configs[shard] = config
+
+        for shard, config in configs.items():
+            if not self.save_config(config, shard):
+                print("保存配置失败!")
+                return False
+        print(f"性能配置已切换为 {name}")
+        return True
+
+    def show_logs(self, log_type="error", lines=50, shard=None):
+        """显示日志 (多实例时默认显示所有实例的日志)"""
+        import subprocess
+        if log_type not in ("error", "access"):
             print("日志类型错误! 支持: error, access")
             return
 
+        shards = [shard] if shard is not None else self.shards()
+        for shard in shards:
+            log_file = f"{self.shard_log_dir(shard)}/{log_type}.log"
+            if len(shards) > 1:
+                print(f"==> {instance_name(shard)}: {log_file}")
+            try:
+                if os.path.exists(log_file):
+                    subprocess.run(['tail', f'-{lines}', log_file])
+                else:
+                    print(f"日志文件 {log_file} 不存在")
+            except Exception as e:
+                print(f"读取日志失败: {e}")
+
+    def show_stats(self, reset=False, sort="total", top=None):
+        """显示各用户的上下行流量 (每个实例一次批量查询), 返回排序后的结果"""
+        from stats import StatsClient, find_api_server, format_bytes, merge_stats, sort_stats
+        client = StatsClient(self.v2ray_binary)
+        results = []
+        for shard in self.shards():
+            config = self.load_config(shard)
+            if not config:
+                return None
+            server = find_api_server(config)
+            if not server:
+                print("未开启流量统计, 请使用 deploy_v2ray.py --enable-stats 重新部署")
+                return None
+            try:
+                results.append(client.query(server, reset=reset))
+            except Exception as e:
+                print(f"查询流量统计失败: {e}")
+                return None
+
+        rows = sort_stats(merge_stats(*results), sort, top)
+        if not rows:
+            print("没有流量统计 (只统计设置了email的用户)")
+            return rows
+
+        print(f"{'Email':<30} {'上行':>10} {'下行':>10} {'合计':>10}")
+        print("-" * 63)
+        for email, uplink, downlink, total in rows:
+            print(f"{email:<30} {format_bytes(uplink):>10} {format_bytes(downlink):>10} "
+                  f"{format_bytes(total):>10}")
+        if reset:
+            print("流量统计已清零")
+        return rows
+
+    def serve_subscriptions(self, host, port, server_ip=None):
+        """启动订阅服务, 从当前配置文件 (多实例时为所有实例的配置) 渲染各用户的订阅"""
+        import asyncio
+        from deploy_v2ray import V2rayDeployer
+        from subscription_server import SubscriptionServer
+
+        if not server_ip:
+            server_ip = V2rayDeployer().get_public_ip()
+        server = SubscriptionServer([self.shard_config_file(s) for s in self.shards()], server_ip, host, port)
         try:
-            if os.path.exists(log_file):
-                subprocess.run(['tail', f'-{lines}', log_file])
-            else:
-                print(f"日志文件 {log_file} 不存在")
-        except Exception as e:
-            print(f"读取日志失败: {e}")
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            print("订阅服务已停止")
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            print(f"订阅服务启动失败: {e}")
 
-def main():
+def build_parser():
     parser = argparse.ArgumentParser(description='V2Ray 管理工具')
     parser.add_argument('action', choices=['status', 'add-user', 'remove-user', 'list-users', 
-                                          'change-port', 'config', 'logs', 'restart'],
+                                          'change-port', 'config', 'logs', 'restart',
+                                          'serve-subscriptions', 'set-profile', 'stats',
+                                          'migrate-users', 'import-users', 'export-users', 'daemon',
+                                          'reload'],
                        help='操作类型')
     parser.add_argument('--email', help='用户邮箱 (用于 add-user)')
     parser.add_argument('--uuid', help='用户UUID (用于 remove-user)')
@@ -214,29 +748,47 @@ def main():
     parser.add_argument('--type', choices=['error', 'access'], default='error',
                        help='日志类型 (用于 logs)')
     parser.add_argument('--lines', type=int, default=50, help='显示日志行数')
+    parser.add_argument('--config', default='/etc/v2ray/config.json', help='配置文件路径')
+    parser.add_argument('--listen', default='0.0.0.0', help='订阅服务监听地址 (用于 serve-subscriptions)')
+    parser.add_argument('--listen-port', type=int, default=8080,
+                       help='订阅服务监听端口 (用于 serve-subscriptions)')
+    parser.add_argument('--server-ip', help='订阅中使用的服务器地址, 默认自动获取')
+    parser.add_argument('--reset', action='store_true', help='查询后清零流量统计 (用于 stats)')
+    parser.add_argument('--sort', choices=['total', 'uplink', 'downlink', 'email'], default='total',
+                       help='排序方式 (用于 stats)')
+    parser.add_argument('--top', type=int, help='只显示流量最多的N个用户 (用于 stats)')
+    parser.add_argument('--shard', type=int,
+                       help='多实例部署时只操作指定实例 (用于 restart、reload、logs、config)')
+    parser.add_argument('--file', help='导入导出文件, - 表示标准输入/输出 (用于 import-users、export-users)')
+    parser.add_argument('--format', choices=['csv', 'jsonl'],
+                       help='导入导出文件格式, 默认按扩展名判断 (用于 import-users、export-users)')
+    parser.add_argument('--restart', action='store_true',
+                       help='导入后重启无法通过API更新的服务 (用于 import-users)')
+    parser.add_argument('--reload-window', type=float, default=DEFAULT_RELOAD_WINDOW,
+                       help='合并重启请求的时间窗口, 单位为秒 (用于 reload、import-users --restart、daemon)')
+    parser.add_argument('--zero-downtime', action='store_true',
+                       help='重启期间由临时实例接收新连接, 已有连接仍会断开 (用于 reload、import-users --restart、daemon)')
+    parser.add_argument('--profile', help='性能配置: default, throughput, low-latency, low-memory (用于 set-profile)')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                       help='管理守护进程的Unix socket (用于 daemon; 其他操作在守护进程运行时经它执行)')
+    parser.add_argument('--no-daemon', action='store_true', help='不经过守护进程, 直接操作配置文件')
+    return parser
 
-    args = parser.parse_args()
-    manager = V2rayManager()
-
-    # 检查权限
-    if os.geteuid() != 0:
-        print("请使用root权限运行此脚本!")
-        sys.exit(1)
-
+def run_action(manager, args):
+    """执行一个操作 (命令行和守护进程共用)"""
     if args.action == 'status':
         manager.show_config()
     
     elif args.action == 'add-user':
-        uuid = manager.add_user(args.email)
-        if uuid:
-            print("请重启服务以使配置生效: systemctl restart v2ray")
+        if manager.add_user(args.email):
+            manager.restart_pending()
     
     elif args.action == 'remove-user':
         if not args.uuid:
             print("请指定要删除的用户UUID: --uuid <uuid>")
         else:
             if manager.remove_user(args.uuid):
-                print("请重启服务以使配置生效: systemctl restart v2ray")
+                manager.restart_pending()
     
     elif args.action == 'list-users':
         manager.list_users()
@@ -246,18 +798,76 @@ def main():
             print("请指定新端口: --port <port>")
         else:
             if manager.change_port(args.port):
-                print("请重启服务以使配置生效: systemctl restart v2ray")
+                manager.restart_hint()
     
     elif args.action == 'config':
-        config = manager.load_config()
-        if config:
-            print(json.dumps(config, indent=2, ensure_ascii=False))
+        shards = [args.shard] if manager.instances and args.shard is not None else manager.shards()
+        for shard in shards:
+            config = manager.load_config(shard)
+            if config:
+                print(json.dumps(config, indent=2, ensure_ascii=False))
     
     elif args.action == 'logs':
-        manager.show_logs(args.type, args.lines)
+        manager.show_logs(args.type, args.lines, args.shard)
     
     elif args.action == 'restart':
-        manager.restart_service()
+        manager.restart_service(args.shard)
+    
+    elif args.action == 'reload':
+        shards = [args.shard] if manager.instances and args.shard is not None else manager.shards()
+        manager.schedule_restart(shards)
+        manager.reload()
+    
+    elif args.action == 'serve-subscriptions':
+        manager.serve_subscriptions(args.listen, args.listen_port, args.server_ip)
+    
+    elif args.action == 'stats':
+        manager.show_stats(args.reset, args.sort, args.top)
+    
+    elif args.action == 'migrate-users':
+        imported = manager.migrate_users()
+        if imported is not None:
+            print(f"用户库中共有 {manager.user_store().count()} 个用户")
+    
+    elif args.action == 'import-users':
+        if not args.file:
+            print("请指定导入文件: --file <path>")
+        else:
+            if manager.import_users(args.file, args.format):
+                manager.restart_pending(args.restart)
+    
+    elif args.action == 'export-users':
+        manager.export_users(args.file or '-', args.format)
+    
+    elif args.action == 'set-profile':
+        if not args.profile:
+            print("请指定性能配置: --profile <name>")
+        else:
+            if manager.set_profile(args.profile):
+                manager.restart_hint()
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    # 检查权限
+    if os.geteuid() != 0:
+        print("请使用root权限运行此脚本!")
+        sys.exit(1)
+
+    manager = V2rayManager(args.config)
+    manager.reload_window = args.reload_window
+    manager.zero_downtime = args.zero_downtime
+    if args.action == 'daemon':
+        from manage_daemon import serve
+        serve(manager, args.socket)
+        return
+    # 守护进程在运行时由它执行, 省去解析配置文件等开销; 不可用时在本进程执行
+    if not args.no_daemon:
+        from manage_daemon import forward
+        if forward(args):
+            return
+    run_action(manager, args)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
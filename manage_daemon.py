@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import socket
+
+# 守护进程执行的操作, 其余操作 (logs、serve-subscriptions等) 总是在命令行进程中执行
+FORWARDED_ACTIONS = {"status", "add-user", "remove-user", "list-users", "change-port", "config",
+                     "restart", "set-profile", "stats", "migrate-users", "import-users", "export-users"}
+# 只写入用户库和日志的操作, config.json在flush_delay内批量渲染
+DEFERRED_ACTIONS = {"add-user", "remove-user", "import-users"}
+DEFAULT_FLUSH_DELAY = 0.2
+
+# JSON-RPC 2.0错误码
+PARSE_ERROR = -32700
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+
+class DaemonError(RuntimeError):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class DaemonClient:
+    """管理守护进程的客户端: 每行一个JSON-RPC请求或响应"""
+
+    def __init__(self, socket_path, timeout=300):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.next_id = 1
+
+    def call(self, method, params):
+        """调用一个操作, 返回result, 守护进程返回错误时抛出DaemonError"""
+        request = {"jsonrpc": "2.0", "id": self.next_id, "method": method, "params": params}
+        self.next_id += 1
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps(request, ensure_ascii=False).encode() + b"\n")
+            with sock.makefile('rb') as f:
+                line = f.readline()
+        if not line:
+            raise ConnectionError("守护进程关闭了连接")
+        response = json.loads(line)
+        if "error" in response:
+            raise DaemonError(response["error"]["code"], response["error"]["message"])
+        return response["result"]
+
+
+def forward(args):
+    """把命令行操作交给守护进程执行并输出结果, 守护进程没有运行或不处理该操作时返回False"""
+    if args.action not in FORWARDED_ACTIONS or not os.path.exists(args.socket):
+        return False
+    # 标准输入输出的导入导出在本进程中流式处理
+    if args.action in ("import-users", "export-users") and args.file in (None, "-"):
+        return False
+    params = dict(vars(args))
+    params.pop("action")
+    params["config"] = os.path.abspath(args.config)
+    if args.file:
+        params["file"] = os.path.abspath(args.file)
+    try:
+        result = DaemonClient(args.socket).call(args.action, params)
+    except DaemonError as e:
+        if e.code == INVALID_PARAMS:
+            # 守护进程管理的是另一个配置文件
+            return False
+        print(f"守护进程执行失败: {e}")
+        return True
+    except OSError:
+        return False
+    sys.stdout.write(result["output"])
+    return True
+
+
+class ThreadOutput:
+    """代替sys.stdout: 执行操作的线程写入该操作的缓冲区, 其他线程 (到期的重启等) 写入原来的输出"""
+
+    def __init__(self, stream):
+        import threading
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        return (getattr(self.local, "buffer", None) or self.stream).write(text)
+
+    def flush(self):
+        (getattr(self.local, "buffer", None) or self.stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class ManageDaemon:
+    """常驻的管理进程: 配置和用户库保持在内存中, 通过Unix socket执行manage.py的操作
+
+    增删用户只写入用户库和日志, 在flush_delay内的多次变更合并为一次config.json写入;
+    其他操作执行前先写入待渲染的变更, 看到的配置总是最新的。
+    操作在单个工作线程中依次执行 (同时保证SQLite连接只在一个线程中使用), 到期的重启在另一个线程中执行,
+    事件循环不会被子进程、fsync或平滑重启阻塞, 其他连接的请求照常排队处理
+    """
+
+    def __init__(self, manager, socket_path, flush_delay=DEFAULT_FLUSH_DELAY):
+        from concurrent.futures import ThreadPoolExecutor
+        self.manager = manager
+        manager.cache_configs = True
+        manager.defer_render = True
+        manager.defer_reload = True
+        self.socket_path = socket_path
+        self.flush_delay = flush_delay
+        self.flush_handle = None
+        self.flushes = 0
+        self.reload_handle = None
+        self.reloading = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="manage")
+        self.reload_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reload")
+        self.output = None
+        self.server = None
+
+    async def call(self, method, params):
+        """执行一个操作, 返回其输出"""
+        import asyncio
+        if method not in FORWARDED_ACTIONS:
+            raise DaemonError(METHOD_NOT_FOUND, f"不支持的操作: {method}")
+        if os.path.abspath(params.get("config", "")) != os.path.abspath(self.manager.config_file):
+            raise DaemonError(INVALID_PARAMS, f"守护进程管理的配置文件为 {self.manager.config_file}")
+
+        output = await asyncio.get_running_loop().run_in_executor(self.executor, self.run, method, params)
+        if method in DEFERRED_ACTIONS:
+            self.schedule_flush()
+        self.schedule_reload()
+        return {"output": output}
+
+    def run(self, method, params):
+        """在工作线程中执行操作, 返回其输出"""
+        import io
+        import argparse
+        from manage import run_action
+        if method not in DEFERRED_ACTIONS:
+            self.flush()
+        buffer = io.StringIO()
+        self.output.local.buffer = buffer
+        try:
+            run_action(self.manager, argparse.Namespace(action=method, **params))
+        finally:
+            self.output.local.buffer = None
+        return buffer.getvalue()
+
+    async def dispatch(self, line):
+        """处理一行请求, 返回响应"""
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {"jsonrpc": "2.0", "id": None, "error": {"code": PARSE_ERROR, "message": "无效的JSON"}}
+        response = {"jsonrpc": "2.0", "id": request.get("id")}
+        try:
+            response["result"] = await self.call(request.get("method"), request.get("params") or {})
+        except DaemonError as e:
+            response["error"] = {"code": e.code, "message": str(e)}
+        except Exception as e:
+            response["error"] = {"code": INTERNAL_ERROR, "message": f"{type(e).__name__}: {e}"}
+        return response
+
+    def schedule_flush(self):
+        import asyncio
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.flush_delay, self.flush_later)
+
+    def flush_later(self):
+        import asyncio
+        self.flush_handle = None
+        asyncio.get_running_loop().run_in_executor(self.executor, self.flush)
+
+    def flush(self):
+        """把日志中待渲染的用户变更写入config.json (在工作线程中执行)"""
+        try:
+            rendered = self.manager.flush_journal()
+        except Exception as e:
+            print(f"写入配置文件失败: {e}")
+            return
+        if rendered is None:
+            print("写入配置文件失败, 变更保留在日志中")
+        elif rendered:
+            self.flushes += 1
+
+    def schedule_reload(self):
+        import asyncio
+        if self.reload_handle is not None or self.reloading is not None:
+            return
+        remaining = self.manager.reload_scheduler().remaining()
+        if remaining is not None:
+            self.reload_handle = asyncio.get_running_loop().call_later(remaining, self.reload)
+
+    def reload(self):
+        """在重启线程中执行到期的重启请求, 完成后检查是否有新的请求 (或截止时间被其他进程推迟)"""
+        import asyncio
+        self.reload_handle = None
+        self.reloading = asyncio.get_running_loop().run_in_executor(
+            self.reload_executor, self.manager.reload, False)
+        self.reloading.add_done_callback(self.reload_done)
+
+    def reload_done(self, future):
+        self.reloading = None
+        if future.exception() is not None:
+            print(f"重启服务失败: {future.exception()}")
+        self.schedule_reload()
+
+    async def handle(self, reader, writer):
+        """处理一个连接上的请求"""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = await self.dispatch(line)
+                writer.write(json.dumps(response, ensure_ascii=False).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        import asyncio
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.output = ThreadOutput(sys.stdout)
+        sys.stdout = self.output
+        self.server = await asyncio.start_unix_server(self.handle, self.socket_path)
+        # 只允许root (守护进程的用户) 连接
+        os.chmod(self.socket_path, 0o600)
+        return self.server
+
+    async def stop(self):
+        """停止监听并写入待渲染的变更"""
+        import asyncio
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.flush)
+        # 未执行的重启请求保留在状态文件中, 由之后的 manage.py reload 执行; 正在进行的重启会执行完
+        if self.reload_handle is not None:
+            self.reload_handle.cancel()
+            self.reload_handle = None
+        if self.reloading is not None:
+            await asyncio.wait([self.reloading])
+        if sys.stdout is self.output:
+            sys.stdout = self.output.stream
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    async def serve_forever(self):
+        import signal
+        import asyncio
+        await self.start()
+        print(f"管理守护进程已启动: {self.socket_path}")
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stopped.set)
+        await stopped.wait()
+        await self.stop()
+        print("管理守护进程已停止")
+
+
+def serve(manager, socket_path, flush_delay=DEFAULT_FLUSH_DELAY):
+    import asyncio
+    asyncio.run(ManageDaemon(manager, socket_path, flush_delay).serve_forever())
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+import threading
+
+
+class StageError(Exception):
+    """阶段执行失败"""
+
+    def __init__(self, stage, error):
+        super().__init__(f"阶段 {stage} 失败: {error}")
+        self.stage = stage
+        self.error = error
+
+
+class StageTimeout(StageError):
+    """阶段执行超时"""
+
+    def __init__(self, stage, timeout):
+        super().__init__(stage, f"超过 {timeout}s 未完成")
+        self.timeout = timeout
+
+
+class Stage:
+    """部署流程中的一个阶段"""
+
+    def __init__(self, name, func, deps=(), timeout=None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.timeout = timeout
+
+
+class StageGraph:
+    """按依赖关系并发执行各阶段, 总耗时由关键路径决定"""
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.stages = {}
+        self.timings = {}
+
+    def add(self, name, func, deps=(), timeout=None):
+        """添加阶段, func按deps顺序接收依赖阶段的返回值"""
+        if name in self.stages:
+            raise ValueError(f"阶段重复: {name}")
+        self.stages[name] = Stage(name, func, deps, timeout)
+        return self
+
+    def validate(self):
+        """检查依赖是否存在以及是否有循环依赖"""
+        for stage in self.stages.values():
+            for dep in stage.deps:
+                if dep not in self.stages:
+                    raise ValueError(f"阶段 {stage.name} 依赖不存在的阶段 {dep}")
+
+        visiting, visited = set(), set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f"存在循环依赖: {name}")
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                visit(dep)
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def critical_path(self):
+        """按本次各阶段耗时计算关键路径长度"""
+        finish = {}
+
+        def finish_time(name):
+            if name not in finish:
+                stage = self.stages[name]
+                start = max((finish_time(dep) for dep in stage.deps), default=0)
+                finish[name] = start + self.timings.get(name, 0)
+            return finish[name]
+
+        return max((finish_time(name) for name in self.stages), default=0)
+
+    def run(self):
+        """执行所有阶段, 返回各阶段的结果; 任一阶段失败或超时时抛出StageError"""
+        self.validate()
+        self.timings = {}
+        done_queue = queue.Queue()
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+
+        def execute(stage, args):
+            try:
+                done_queue.put((stage.name, True, stage.func(*args)))
+            except Exception as e:
+                done_queue.put((stage.name, False, e))
+
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if len(running) >= self.max_workers:
+                    break
+                if all(dep in results for dep in stage.deps):
+                    args = [results[dep] for dep in stage.deps]
+                    # 守护线程: 超时的阶段不会阻塞进程退出
+                    thread = threading.Thread(target=execute, args=(stage, args), daemon=True)
+                    running[name] = time.time()
+                    del pending[name]
+                    thread.start()
+
+            deadlines = [(running[name] + self.stages[name].timeout, name)
+                         for name in running if self.stages[name].timeout is not None]
+            wait = None
+            if deadlines:
+                wait = max(min(deadlines)[0] - time.time(), 0)
+
+            try:
+                name, ok, value = done_queue.get(timeout=wait)
+            except queue.Empty:
+                name = min(deadlines)[1]
+                raise StageTimeout(name, self.stages[name].timeout)
+
+            self.timings[name] = time.time() - running.pop(name)
+            if not ok:
+                raise StageError(name, value) from value
+            results[name] = value
+
+        return results
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+from locking import atomic_write, file_lock
+from tuning import tuned_inbounds
+
+# 平滑重启: 临时实例以新配置监听同一端口 (SO_REUSEPORT), 主服务重启期间由它接收新连接
+# 只保证新连接不被拒绝; v2ray没有优雅停止, 主服务和临时实例停止时已有连接都会断开
+# 旧进程也必须开启该选项, 否则临时实例无法绑定端口, 此时退回普通重启
+REUSE_PORT_SOCKOPT = {"reusePort": True}
+DEFAULT_WINDOW = 5.0
+
+
+def enable_reuse_port(config):
+    """为代理入站 (不包括本机的api入站) 开启SO_REUSEPORT (原地修改), 返回是否有修改"""
+    changed = False
+    for inbound in tuned_inbounds(config):
+        sockopt = inbound.setdefault("streamSettings", {}).setdefault("sockopt", {})
+        for key, value in REUSE_PORT_SOCKOPT.items():
+            if sockopt.get(key) != value:
+                sockopt[key] = value
+                changed = True
+    return changed
+
+
+def handover_config(config, log_dir):
+    """临时实例的配置: 与新配置相同, 但不开启api和统计 (api端口不能与主服务共用), 日志单独存放"""
+    config = json.loads(json.dumps(config))
+    config["inbounds"] = tuned_inbounds(config)
+    enable_reuse_port(config)
+    for key in ("api", "stats"):
+        config.pop(key, None)
+    routing = config.get("routing")
+    if routing:
+        routing["rules"] = [r for r in routing.get("rules", []) if r.get("outboundTag") != "api"]
+    log = config.setdefault("log", {})
+    log["error"] = f"{log_dir}/handover-error.log"
+    if log.get("access", "none") != "none":
+        log["access"] = f"{log_dir}/handover-access.log"
+    return config
+
+
+class ReloadScheduler:
+    """合并重启请求: 请求记录在状态文件中, 每次请求把截止时间推迟window秒
+
+    多个manage.py进程的请求合并为截止时间之后的一次重启, 由第一个取走请求的进程执行
+    """
+
+    def __init__(self, state_file, window=DEFAULT_WINDOW):
+        self.state_file = state_file
+        self.lock_file = f"{state_file}.lock"
+        self.window = window
+
+    def _load(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def request(self, shards):
+        """登记需要重启的实例 (None表示单实例部署), 返回新的截止时间"""
+        with file_lock(self.lock_file):
+            state = self._load() or {"shards": []}
+            for shard in shards:
+                if shard not in state["shards"]:
+                    state["shards"].append(shard)
+            state["deadline"] = time.time() + self.window
+            atomic_write(self.state_file, json.dumps(state))
+        return state["deadline"]
+
+    def remaining(self):
+        """距离截止时间的秒数, 没有待重启的请求时返回None"""
+        state = self._load()
+        if state is None:
+            return None
+        return max(0.0, state["deadline"] - time.time())
+
+    def take_due(self):
+        """截止时间已过时取走所有待重启的实例, 否则 (或已被其他进程取走) 返回None"""
+        with file_lock(self.lock_file):
+            state = self._load()
+            if state is None or time.time() < state["deadline"]:
+                return None
+            os.remove(self.state_file)
+        return state["shards"]
+
+    def wait(self):
+        """等到截止时间不再被推迟后取走请求, 已被其他进程取走时返回None"""
+        while True:
+            remaining = self.remaining()
+            if remaining is None:
+                return None
+            if remaining > 0:
+                time.sleep(remaining)
+                continue
+            shards = self.take_due()
+            if shards is not None:
+                return shards
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from rule_compiler import compile_rule_set
+
+# 服务端路由: 域名和IP列表编译为routing.rules, 按策略转到对应出站
+DIRECT_TAG = "direct"
+BLOCK_TAG = "block"
+ROUTE_POLICIES = {"direct": DIRECT_TAG, "block": BLOCK_TAG}
+# AsIs不为路由解析域名, IP规则只匹配以IP访问的连接; IPIfNonMatch在域名规则都不匹配时解析后再匹配IP规则
+DOMAIN_STRATEGIES = ["AsIs", "IPIfNonMatch", "IPOnDemand"]
+DEFAULT_DOMAIN_STRATEGY = "AsIs"
+
+GEO_PREFIXES = ("geosite", "geoip")
+
+
+def parse_geo(line):
+    """解析geosite/geoip引用, 返回 (geosite|geoip, 引用), 不是引用时返回None
+
+    支持 geosite:cn / geoip:private 以及Clash的 GEOSITE,cn / GEOIP,CN,no-resolve
+    """
+    line = line.split("#", 1)[0].strip()
+    if "," in line:
+        parts = [p.strip() for p in line.split(",")]
+        kind, value = parts[0].lower(), parts[1] if len(parts) > 1 else ""
+    elif ":" in line:
+        kind, _, value = line.partition(":")
+        kind = kind.lower()
+    else:
+        return None
+    if kind not in GEO_PREFIXES or not value:
+        return None
+    return kind, f"{kind}:{value.lower()}"
+
+
+def split_geo(lines, refs):
+    """依次返回不是geosite/geoip引用的行, 引用按类型加入refs"""
+    for line in lines:
+        geo = parse_geo(line)
+        if geo is None:
+            yield line
+        else:
+            refs[geo[0]].add(geo[1])
+
+
+def compile_route_set(name, policy, lines, use_geodata=True):
+    """编译路由列表, 返回 (routing规则列表, CompiledRuleSet)
+
+    域名使用 domain:/full:/keyword: 写法, 网段合并后写入ip规则; geosite/geoip引用原样保留
+    (由v2ray从geosite.dat/geoip.dat加载), use_geodata为False时出现引用会抛出ValueError
+    """
+    if policy not in ROUTE_POLICIES:
+        raise ValueError(f"未知的路由策略: {policy} (可选: {', '.join(ROUTE_POLICIES)})")
+    refs = {"geosite": set(), "geoip": set()}
+    compiled = compile_rule_set(name, split_geo(lines, refs), policy)
+    if not use_geodata and (refs["geosite"] or refs["geoip"]):
+        raise ValueError(f"路由列表 {name} 引用了geosite/geoip, 但未安装geosite.dat/geoip.dat")
+
+    domains = sorted(refs["geosite"])
+    domains += [f"domain:{d}" for d in compiled.suffixes]
+    domains += [f"full:{d}" for d in compiled.domains]
+    domains += [f"keyword:{k}" for k in compiled.keywords]
+    ips = sorted(refs["geoip"]) + [str(n) for n in compiled.networks]
+
+    outbound = ROUTE_POLICIES[policy]
+    rules = []
+    if domains:
+        rules.append({"type": "field", "domain": domains, "outboundTag": outbound})
+    if ips:
+        rules.append({"type": "field", "ip": ips, "outboundTag": outbound})
+    return rules, compiled
+
+
+def apply_routing(config, rules, domain_strategy=DEFAULT_DOMAIN_STRATEGY):
+    """为服务端配置加入路由规则和blackhole出站 (原地修改), 返回config
+
+    rules为空时不修改配置; 第一个freedom出站标记为direct, 作为默认出站
+    """
+    if not rules:
+        return config
+    if domain_strategy not in DOMAIN_STRATEGIES:
+        raise ValueError(f"未知的domainStrategy: {domain_strategy} (可选: {', '.join(DOMAIN_STRATEGIES)})")
+
+    outbounds = config.setdefault("outbounds", [])
+    tags = {o.get("tag") for o in outbounds}
+    if DIRECT_TAG not in tags:
+        for outbound in outbounds:
+            if outbound.get("protocol") == "freedom" and not outbound.get("tag"):
+                outbound["tag"] = DIRECT_TAG
+                break
+    if any(r["outboundTag"] == BLOCK_TAG for r in rules) and BLOCK_TAG not in tags:
+        outbounds.append({"tag": BLOCK_TAG, "protocol": "blackhole",
+                          "settings": {"response": {"type": "none"}}})
+
+    routing = config.setdefault("routing", {})
+    routing["domainStrategy"] = domain_strategy
+    routing["rules"] = routing.get("rules", []) + list(rules)
+    return config
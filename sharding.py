@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+
+# 多实例部署: 实例i使用 <配置目录>/shard<i>/config.json, 由 v2ray@shard<i>.service 运行
+SHARD_PREFIX = "shard"
+TEMPLATE_UNIT = "v2ray@.service"
+
+
+def shard_for(user_id, instances):
+    """按UUID的哈希将用户分配到实例, 实例数不变时结果固定"""
+    if instances <= 1:
+        return 0
+    digest = hashlib.sha256(user_id.lower().encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % instances
+
+
+def instance_name(shard):
+    return f"{SHARD_PREFIX}{shard}"
+
+
+def instance_config_file(config_dir, shard):
+    return os.path.join(config_dir, instance_name(shard), "config.json")
+
+
+def unit_name(service_name, shard=None):
+    """单实例为 v2ray, 多实例为 v2ray@shard<i>"""
+    if shard is None:
+        return service_name
+    return f"{service_name}@{instance_name(shard)}"
+
+
+def find_instances(config_dir):
+    """返回已部署的实例数 (从shard0开始连续存在的实例配置), 未分片时返回0"""
+    count = 0
+    while os.path.exists(instance_config_file(config_dir, count)):
+        count += 1
+    return count
+
+
+def cpu_affinity_for(affinity, shard, cpu_count=None):
+    """实例的CPUAffinity设置: "auto" 按实例序号轮流绑定CPU, 列表按序号循环取用"""
+    if not affinity:
+        return None
+    if affinity == "auto":
+        return str(shard % (cpu_count or os.cpu_count() or 1))
+    return str(affinity[shard % len(affinity)])
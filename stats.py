@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+
+# 流量统计API: 只监听本机回环地址的dokodemo-door入站, 路由到api出站
+API_TAG = "api"
+API_LISTEN = "127.0.0.1"
+DEFAULT_API_PORT = 10085
+USER_PATTERN = "user>>>"
+# HandlerService用于不重启服务增删用户 (manage.py), 需要代理入站带有tag
+API_SERVICES = ("StatsService", "HandlerService")
+PROXY_TAG = "proxy"
+
+SORT_KEYS = ["total", "uplink", "downlink", "email"]
+
+
+def enable_stats(config, api_port, services=API_SERVICES):
+    """为服务端配置开启stats和api (原地修改), 返回config
+
+    各用户的流量按email统计, 没有email的用户不会出现在统计中; 没有tag的入站标记为PROXY_TAG
+    """
+    config["stats"] = {}
+    config["api"] = {"tag": API_TAG, "services": list(services)}
+
+    policy = config.setdefault("policy", {})
+    level = policy.setdefault("levels", {}).setdefault("0", {})
+    level["statsUserUplink"] = True
+    level["statsUserDownlink"] = True
+    policy["system"] = {"statsInboundUplink": True, "statsInboundDownlink": True}
+
+    inbounds = [i for i in config.get("inbounds", []) if i.get("tag") != API_TAG]
+    for inbound in inbounds:
+        inbound.setdefault("tag", PROXY_TAG)
+    inbounds.append({
+        "tag": API_TAG,
+        "listen": API_LISTEN,
+        "port": api_port,
+        "protocol": "dokodemo-door",
+        "settings": {"address": API_LISTEN}
+    })
+    config["inbounds"] = inbounds
+
+    routing = config.setdefault("routing", {})
+    rules = [r for r in routing.get("rules", []) if r.get("outboundTag") != API_TAG]
+    rules.insert(0, {"type": "field", "inboundTag": [API_TAG], "outboundTag": API_TAG})
+    routing["rules"] = rules
+    return config
+
+
+def find_api_server(config):
+    """从服务端配置中找到api入站的地址, 没有开启时返回None"""
+    for inbound in config.get("inbounds", []):
+        if inbound.get("tag") == API_TAG and inbound.get("port"):
+            return f"{inbound.get('listen', API_LISTEN)}:{inbound['port']}"
+    return None
+
+
+def find_proxy_tag(config):
+    """第一个入站 (用户所在的入站) 的tag, 没有tag或没有开启HandlerService时返回None"""
+    if "HandlerService" not in config.get("api", {}).get("services", []):
+        return None
+    inbounds = config.get("inbounds", [])
+    return inbounds[0].get("tag") if inbounds else None
+
+
+def parse_stats(output):
+    """解析 `v2ray api stats -json` 的输出, 返回 email -> {uplink, downlink}"""
+    data = json.loads(output or "{}")
+    users = {}
+    for stat in data.get("stat", []):
+        # 名称格式: user>>>[email]>>>traffic>>>[uplink|downlink]
+        parts = stat.get("name", "").split(">>>")
+        if len(parts) != 4 or parts[0] != "user" or parts[3] not in ("uplink", "downlink"):
+            continue
+        counters = users.setdefault(parts[1], {"uplink": 0, "downlink": 0})
+        # protojson将int64输出为字符串
+        counters[parts[3]] += int(stat.get("value", 0))
+    return users
+
+
+def merge_stats(*results):
+    """合并多个实例的统计结果"""
+    users = {}
+    for result in results:
+        for email, counters in result.items():
+            merged = users.setdefault(email, {"uplink": 0, "downlink": 0})
+            merged["uplink"] += counters["uplink"]
+            merged["downlink"] += counters["downlink"]
+    return users
+
+
+def sort_stats(users, key="total", top=None):
+    """按流量 (从大到小) 或email排序, 返回 [(email, uplink, downlink, total)]"""
+    rows = [(email, c["uplink"], c["downlink"], c["uplink"] + c["downlink"])
+            for email, c in users.items()]
+    if key == "email":
+        rows.sort(key=lambda row: row[0])
+    else:
+        index = {"uplink": 1, "downlink": 2, "total": 3}[key]
+        rows.sort(key=lambda row: (-row[index], row[0]))
+    return rows[:top] if top else rows
+
+
+def format_bytes(value):
+    for unit in ("B", "KB", "MB", "GB"):
+        if value < 1024:
+            return f"{value:.0f}{unit}" if unit == "B" else f"{value:.1f}{unit}"
+        value /= 1024
+    return f"{value:.1f}TB"
+
+
+class StatsClient:
+    """通过v2ray命令行查询统计API, 所有用户的计数器在一次调用中取回"""
+
+    def __init__(self, binary="/usr/local/v2ray/v2ray", timeout=10):
+        self.binary = binary
+        self.timeout = timeout
+
+    def query(self, server, pattern=USER_PATTERN, reset=False):
+        """查询匹配pattern的计数器; reset为True时取值后清零"""
+        import subprocess
+        cmd = [self.binary, "api", "stats", f"--server={server}",
+               f"-timeout={self.timeout}", "-json"]
+        if reset:
+            cmd.append("-reset")
+        cmd.append(pattern)
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=self.timeout + 5)
+        if result.returncode != 0:
+            raise RuntimeError(f"查询统计失败 ({server}): {result.stderr.strip() or result.stdout.strip()}")
+        return parse_stats(result.stdout)
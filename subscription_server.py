@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import gzip
+import base64
+import asyncio
+import hashlib
+from deploy_v2ray import V2rayDeployer
+from batch_render import BatchRenderer
+from transport import detect_transport
+
+# 路径前缀 -> (渲染格式, Content-Type)
+ROUTES = {
+    "sub": ("vmess", "text/plain; charset=utf-8"),
+    "clash": ("clash", "text/yaml; charset=utf-8"),
+    "v2rayng": ("v2rayng", "application/json; charset=utf-8"),
+    "surge": ("surge", "text/plain; charset=utf-8"),
+}
+
+REASONS = {200: "OK", 304: "Not Modified", 400: "Bad Request",
+           404: "Not Found", 405: "Method Not Allowed"}
+
+
+class CachedBody:
+    """渲染好的响应: 原始内容、预压缩的gzip内容和ETag"""
+
+    def __init__(self, body, content_type):
+        self.body = body
+        self.gzip_body = gzip.compress(body, compresslevel=6, mtime=0)
+        self.etag = '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+        self.content_type = content_type
+
+
+class SubscriptionServer:
+    """从config.json渲染各用户的订阅内容, 缓存在内存中并按用户失效
+
+    config_file可以是多个配置文件 (多实例部署时每个实例一个), 用户的订阅使用所在实例的端口
+    """
+
+    def __init__(self, config_file, server_ip, host="0.0.0.0", port=8080, poll_interval=2.0):
+        self.config_files = [config_file] if isinstance(config_file, str) else list(config_file)
+        self.server_ip = server_ip
+        self.host = host
+        self.port = port
+        self.poll_interval = poll_interval
+        # 用户UUID -> (所在实例的渲染器, client)
+        self.clients = {}
+        self.fingerprints = {}
+        # 配置文件 -> (所有用户共用字段的指纹, 渲染器)
+        self.renderers = {}
+        self.cache = {}
+        self.mtimes = None
+        self.renders = 0
+        self.watcher = None
+        self.server = None
+
+    def load(self):
+        """重新读取配置文件, 只清除有变化的用户的缓存"""
+        mtimes, clients, fingerprints = [], {}, {}
+        for config_file in self.config_files:
+            with open(config_file, 'r') as f:
+                config = json.load(f)
+            mtimes.append(os.stat(config_file).st_mtime_ns)
+
+            inbound = config["inbounds"][0]
+            shared = {k: v for k, v in inbound.items() if k != "settings"}
+            global_fingerprint = json.dumps([shared, self.server_ip], sort_keys=True)
+            if self.renderers.get(config_file, (None,))[0] != global_fingerprint:
+                # 端口等所有用户共用的字段有变化, 重建该实例的模板
+                deployer = V2rayDeployer()
+                deployer.port = inbound.get("port", deployer.port)
+                for name, value in detect_transport(inbound.get("streamSettings", {})).items():
+                    setattr(deployer, name, value)
+                self.renderers[config_file] = (global_fingerprint, BatchRenderer(deployer, self.server_ip))
+            renderer = self.renderers[config_file][1]
+
+            for client in inbound.get("settings", {}).get("clients", []):
+                # 共用字段有变化时该实例所有用户的指纹都变化
+                fingerprints[client["id"]] = json.dumps([global_fingerprint, client], sort_keys=True)
+                clients[client["id"]] = (renderer, client)
+
+        for user_id, fingerprint in self.fingerprints.items():
+            if fingerprints.get(user_id) != fingerprint:
+                self.cache.pop(user_id, None)
+        self.mtimes = mtimes
+        self.fingerprints = fingerprints
+        self.clients = clients
+
+    def reload_if_changed(self):
+        """配置文件修改时间变化时重新加载"""
+        try:
+            mtimes = [os.stat(config_file).st_mtime_ns for config_file in self.config_files]
+        except OSError:
+            return False
+        if mtimes == self.mtimes:
+            return False
+        try:
+            self.load()
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            # 配置文件正在写入或格式错误时继续使用旧的缓存
+            print(f"重新加载配置失败: {e}")
+            return False
+        return True
+
+    def get(self, user_id, route):
+        """获取用户的订阅内容, 未缓存时渲染"""
+        if user_id not in self.clients or route not in ROUTES:
+            return None
+        renderer, client = self.clients[user_id]
+        fmt, content_type = ROUTES[route]
+        if fmt not in renderer.formats:
+            # 当前传输方式不支持该客户端
+            return None
+        entries = self.cache.setdefault(user_id, {})
+        if route not in entries:
+            text = renderer.render_user(client)[fmt]
+            if fmt == "vmess":
+                # 订阅格式: 分享链接按行拼接后再base64编码
+                text = base64.b64encode(f"{text}\n".encode()).decode()
+            entries[route] = CachedBody(text.encode('utf-8'), content_type)
+            self.renders += 1
+        return entries[route]
+
+    def respond(self, method, path, headers):
+        """根据请求返回 (状态码, 响应头, 响应体)"""
+        if method not in ("GET", "HEAD"):
+            return 405, {}, b""
+        parts = path.split("?", 1)[0].strip("/").split("/")
+        if len(parts) != 2:
+            return 404, {}, b""
+
+        entry = self.get(parts[1], parts[0])
+        if entry is None:
+            return 404, {}, b""
+
+        response_headers = {
+            "ETag": entry.etag,
+            "Cache-Control": "no-cache",
+            "Vary": "Accept-Encoding",
+            "Content-Type": entry.content_type,
+        }
+        if entry.etag in [tag.strip() for tag in headers.get("if-none-match", "").split(",")]:
+            return 304, response_headers, b""
+
+        body = entry.body
+        if "gzip" in headers.get("accept-encoding", ""):
+            body = entry.gzip_body
+            response_headers["Content-Encoding"] = "gzip"
+        return 200, response_headers, body
+
+    async def handle(self, reader, writer):
+        """处理一个连接上的请求 (支持keep-alive)"""
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                lines = head.decode('latin-1').split("\r\n")
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                try:
+                    method, path, version = lines[0].split(" ", 2)
+                except ValueError:
+                    method, version = "GET", "HTTP/1.0"
+                    status, response_headers, body = 400, {}, b""
+                else:
+                    status, response_headers, body = self.respond(method, path, headers)
+
+                keep_alive = (version == "HTTP/1.1"
+                              and headers.get("connection", "").lower() != "close")
+                response_headers["Content-Length"] = str(len(body))
+                response_headers["Connection"] = "keep-alive" if keep_alive else "close"
+                out = [f"HTTP/1.1 {status} {REASONS[status]}"]
+                out += [f"{name}: {value}" for name, value in response_headers.items()]
+                writer.write(("\r\n".join(out) + "\r\n\r\n").encode('latin-1'))
+                if method != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def watch(self):
+        """定期检查配置文件是否有变化"""
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if self.reload_if_changed():
+                print("配置文件已更新, 已清除变化用户的缓存")
+
+    async def start(self):
+        """加载配置并开始监听, 返回asyncio.Server"""
+        self.load()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.watcher = asyncio.ensure_future(self.watch())
+        return self.server
+
+    async def stop(self):
+        """停止监听和配置文件检查"""
+        if self.watcher:
+            self.watcher.cancel()
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def serve_forever(self):
+        server = await self.start()
+        print(f"订阅服务已启动: http://{self.host}:{self.port}/<sub|clash|v2rayng|surge>/<uuid>")
+        async with server:
+            await server.serve_forever()
@@ -3,10 +3,28 @@
 
 import sys
 import os
+import io
 import json
+import uuid
 import tempfile
 import shutil
+import contextlib
+import threading
+import time
+import zipfile
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from deploy_v2ray import V2rayDeployer
+from pipeline import StageGraph, StageError, StageTimeout
+from fleet import FleetDeployer, load_inventory
+from batch_render import BatchRenderer
+from sharding import shard_for
+from transport import TRANSPORTS, detect_transport
+from rule_compiler import compile_rule_set
+from routing import compile_route_set
+from tuning import PROFILES, apply_profile, detect_profile, validate_config
+from downloader import (ArtifactCache, MirrorSelector, RangedDownloader,
+                        extract_members, parse_dgst, sha256_file)
 
 def test_config_generation():
     """测试配置文件生成"""
@@ -119,6 +137,48 @@ def test_client_configs():
                 print("✗ V2RayNG配置文件格式错误")
                 all_files_exist = False
         
+        # 内容未变化时不重写文件
+        _, stats = deployer.save_configs(test_ip, with_stats=True)
+        if stats["files_written"] != 0 or stats["bytes_written"] != 0 \
+                or len(stats["files"]) != len(expected_files):
+            print(f"✗ 内容未变化时仍写入了文件: {stats['files_written']}")
+            all_files_exist = False
+        else:
+            print("✓ 内容未变化时跳过写入")
+        
+        # 重写时读取方只能看到完整的旧文件或新文件
+        with open('client_configs/clash.yaml', 'r') as f:
+            versions = {f.read()}
+        deployer.port = 20000
+        versions.add(deployer.generate_clash_config(test_ip))
+        torn = []
+        stop = threading.Event()
+        def reader():
+            while not stop.is_set():
+                with open('client_configs/clash.yaml', 'r') as f:
+                    content = f.read()
+                if content not in versions:
+                    torn.append(content)
+        thread = threading.Thread(target=reader)
+        thread.start()
+        for port in (20000, 10086) * 20:
+            deployer.port = port
+            deployer.save_configs(test_ip)
+        deployer.port = 20000
+        _, stats = deployer.save_configs(test_ip, with_stats=True)
+        stop.set()
+        thread.join()
+        leftovers = [name for name in os.listdir('client_configs') if name.endswith('.tmp')]
+        if torn or leftovers:
+            print(f"✗ 读取到不完整的文件或残留临时文件: {len(torn)} {leftovers}")
+            all_files_exist = False
+        elif stats["bytes_written"] != sum(os.path.getsize(path) for path in expected_files) \
+                or stats["files"]['client_configs/clash.yaml']["seconds"] <= 0:
+            print("✗ 写入统计错误")
+            all_files_exist = False
+        else:
+            print(f"✓ 原子写入, 共写入 {stats['bytes_written']} 字节")
+        
         if all_files_exist:
             print("✓ 所有客户端配置文件生成成功")
             return True
@@ -200,6 +260,1155 @@ def test_service_file_generation():
         if os.path.exists(test_file):
             os.remove(test_file)
 
+def test_artifact_cache():
+    """测试制品缓存的校验与LRU淘汰"""
+    print("\n测试制品缓存...")
+    
+    test_dir = tempfile.mkdtemp()
+    
+    try:
+        cache = ArtifactCache(os.path.join(test_dir, "cache"), max_bytes=2048)
+        
+        def make_zip(name, size):
+            path = os.path.join(test_dir, name)
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size))
+            return path
+        
+        # 解析.dgst摘要
+        first = make_zip("v1.zip", 1024)
+        digest = sha256_file(first)
+        dgst = f"MD5= 00\nSHA1= 11\nSHA2-256= {digest}\nSHA2-512= 22\n"
+        if parse_dgst(dgst) != digest:
+            print("✗ .dgst摘要解析错误")
+            return False
+        print("✓ .dgst摘要解析正确")
+        
+        # 摘要不匹配时拒绝入库
+        try:
+            cache.store("v1", "linux-64", first, "0" * 64)
+            print("✗ 摘要不匹配时未拒绝入库")
+            return False
+        except ValueError:
+            print("✓ 摘要不匹配时拒绝入库")
+        
+        cached = cache.store("v1", "linux-64", first, digest)
+        if cache.lookup("v1", "linux-64", digest) != cached or not cache.owns(cached):
+            print("✗ 缓存命中失败")
+            return False
+        if cache.lookup("v1", "linux-64") != cached:
+            print("✗ 无摘要时未使用缓存记录")
+            return False
+        print("✓ 缓存命中")
+        
+        # 超出容量后淘汰最久未使用的版本
+        cache.store("v2", "linux-64", make_zip("v2.zip", 1024))
+        cache.lookup("v1", "linux-64", digest)
+        cache.store("v3", "linux-64", make_zip("v3.zip", 1024))
+        if cache.lookup("v2", "linux-64") is not None or cache.lookup("v1", "linux-64") is None:
+            print("✗ LRU淘汰顺序错误")
+            return False
+        print("✓ LRU淘汰正确")
+        
+        # 缓存文件损坏时不再命中
+        with open(cached, 'ab') as f:
+            f.write(b"corrupted")
+        if cache.lookup("v1", "linux-64", digest) is not None:
+            print("✗ 损坏的缓存文件被复用")
+            return False
+        print("✓ 损坏的缓存文件被丢弃")
+        
+        return True
+        
+    except Exception as e:
+        print(f"✗ 制品缓存测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def start_range_server(payload, fail_ranges=(), delay=0):
+    """启动支持Range请求的本地HTTP服务, 用于模拟release下载"""
+    requested = []
+    
+    class RangeHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+        
+        def do_GET(self):
+            header = self.headers.get("Range")
+            if not header:
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                return
+            start, end = (int(x) for x in header[len("bytes="):].split("-"))
+            requested.append(start)
+            time.sleep(delay)
+            if start in fail_ranges:
+                self.send_error(500)
+                return
+            body = payload[start:end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(payload)}")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, requested
+
+def test_ranged_download():
+    """测试分段并行下载与断点续传"""
+    print("\n测试分段下载...")
+    
+    test_dir = tempfile.mkdtemp()
+    payload = os.urandom(10 * 1024 + 123)
+    fail_ranges = {4096}
+    server, requested = start_range_server(payload, fail_ranges)
+    
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/v2ray-linux-64.zip"
+        dest = os.path.join(test_dir, "v2ray-linux-64.zip")
+        downloader = RangedDownloader(workers=3, chunk_size=2048, retries=1)
+        
+        # 第一次下载时一个分段失败, 其余分段应保留
+        try:
+            downloader.download(url, dest)
+            print("✗ 分段失败时未报错")
+            return False
+        except IOError:
+            print("✓ 分段失败时保留已下载内容")
+        
+        # 恢复后只下载缺失的分段
+        fail_ranges.clear()
+        del requested[:]
+        stats = downloader.download(url, dest)
+        if [start for start in requested if start != 0] != [4096]:
+            print(f"✗ 续传时重复下载了分段: {requested}")
+            return False
+        print("✓ 断点续传只下载缺失分段")
+        
+        with open(dest, 'rb') as f:
+            if f.read() != payload:
+                print("✗ 下载内容不一致")
+                return False
+        if stats["resumed_bytes"] != len(payload) - 2048 or stats["throughput"] <= 0:
+            print(f"✗ 下载统计错误: {stats}")
+            return False
+        if os.path.exists(f"{dest}.part") or os.path.exists(f"{dest}.part.json"):
+            print("✗ 未清理临时文件")
+            return False
+        print("✓ 下载内容与统计正确")
+        
+        # 下载到内存时已完成的分段保留在partial中, 换源后只下载缺失的分段
+        fail_ranges.add(4096)
+        partial = {}
+        try:
+            downloader.fetch_bytes(url, partial)
+            print("✗ 内存下载分段失败时未报错")
+            return False
+        except IOError:
+            pass
+        other, other_requested = start_range_server(payload)
+        try:
+            other_url = f"http://127.0.0.1:{other.server_address[1]}/v2ray-linux-64.zip"
+            data = downloader.fetch_bytes(other_url, partial)
+        finally:
+            other.shutdown()
+        if data != payload or [start for start in other_requested if start != 0] != [4096]:
+            print(f"✗ 换源后重复下载了分段: {other_requested}")
+            return False
+        print("✓ 内存下载换源后只下载缺失分段")
+        return True
+        
+    except Exception as e:
+        print(f"✗ 分段下载测试失败: {e}")
+        return False
+    finally:
+        server.shutdown()
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_mirror_racing():
+    """测试并发探测下载源并记住最快的源"""
+    print("\n测试下载源竞速...")
+    
+    test_dir = tempfile.mkdtemp()
+    payload = os.urandom(64 * 1024)
+    slow, slow_requests = start_range_server(payload, delay=3)
+    fast, fast_requests = start_range_server(payload)
+    
+    try:
+        mirrors = [f"http://127.0.0.1:{server.server_address[1]}/{{url}}"
+                   for server in (slow, fast)]
+        state_file = os.path.join(test_dir, "mirrors.json")
+        url = "https://github.com/v2fly/v2ray-core/releases/download/v5.20.0/v2ray-linux-64.zip"
+        selector = MirrorSelector(mirrors, state_file, sample_bytes=32 * 1024,
+                                  timeout=10, grace=0.2)
+        
+        started = time.time()
+        ordered = selector.select(url)
+        elapsed = time.time() - started
+        if ordered[0] != mirrors[1].format(url=url):
+            print(f"✗ 未选中最快的下载源: {ordered}")
+            return False
+        if elapsed >= 3:
+            print(f"✗ 未取消较慢的探测: {elapsed:.2f}s")
+            return False
+        print(f"✓ 选中最快的下载源, 耗时 {elapsed:.2f}s")
+        
+        # 下次运行直接使用记住的源, 不再探测
+        del fast_requests[:]
+        selector = MirrorSelector(mirrors, state_file)
+        if selector.select(url)[0] != ordered[0] or fast_requests:
+            print("✗ 未复用记住的下载源")
+            return False
+        print("✓ 复用记住的下载源")
+        
+        # 实际下载改用其他源时更新记录
+        selector.record_success(url, mirrors[0].format(url=url))
+        if selector.remembered(url) != mirrors[0]:
+            print("✗ 下载源记录未更新")
+            return False
+        print("✓ 下载源记录已更新")
+        
+        # 记录过期后重新探测
+        del fast_requests[:]
+        selector = MirrorSelector(mirrors, state_file, sample_bytes=32 * 1024, grace=0.2, ttl=0)
+        if selector.remembered(url) is not None or selector.select(url)[0] != ordered[0] or not fast_requests:
+            print("✗ 下载源记录过期后未重新探测")
+            return False
+        print("✓ 下载源记录过期后重新探测")
+        
+        # 用记住的源下载过慢时删除记录
+        selector = MirrorSelector(mirrors, state_file, min_bandwidth=1024 * 1024)
+        selector.record_success(url, ordered[0], bandwidth=100 * 1024)
+        if selector.remembered(url) is not None:
+            print("✗ 下载过慢时未删除下载源记录")
+            return False
+        print("✓ 下载过慢时删除下载源记录")
+        
+        # .dgst摘要并发获取, 排在前面的源不可达时不等待它超时
+        digest = "ab" * 32
+        def start_dgst_server(delay):
+            class DgstHandler(BaseHTTPRequestHandler):
+                def log_message(self, *args):
+                    pass
+                def do_GET(self):
+                    time.sleep(delay)
+                    body = f"SHA2-256= {digest}\n".encode()
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+            server = ThreadingHTTPServer(("127.0.0.1", 0), DgstHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            return server
+        dgst_servers = [start_dgst_server(3), start_dgst_server(0)]
+        deployer = V2rayDeployer()
+        started = time.time()
+        sha256 = deployer.fetch_release_digest(
+            [f"http://127.0.0.1:{server.server_address[1]}/v2ray-linux-64.zip" for server in dgst_servers])
+        elapsed = time.time() - started
+        for server in dgst_servers:
+            server.shutdown()
+        if sha256 != digest or elapsed >= 3:
+            print(f"✗ 未并发获取摘要: {sha256} {elapsed:.2f}s")
+            return False
+        print(f"✓ 并发获取摘要, 不等待较慢的源 ({elapsed:.2f}s)")
+        return True
+        
+    except Exception as e:
+        print(f"✗ 下载源竞速测试失败: {e}")
+        return False
+    finally:
+        slow.shutdown()
+        fast.shutdown()
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_selective_extraction():
+    """测试只解压所需文件并校验内容"""
+    print("\n测试选择性解压...")
+    
+    test_dir = tempfile.mkdtemp()
+    binary = os.urandom(8192)
+    archive = os.path.join(test_dir, "v2ray-linux-64.zip")
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zip_ref:
+        info = zipfile.ZipInfo("v2ray")
+        info.external_attr = 0o755 << 16
+        zip_ref.writestr(info, binary)
+        zip_ref.writestr("geoip.dat", b"geoip")
+        zip_ref.writestr("config.json", b"{}")
+    server, _ = start_range_server(open(archive, 'rb').read())
+    
+    try:
+        # 从内存中的压缩包解压, 压缩包不落盘
+        url = f"http://127.0.0.1:{server.server_address[1]}/v2ray-linux-64.zip"
+        data = RangedDownloader(workers=2, chunk_size=1024).fetch_bytes(url)
+        install_dir = os.path.join(test_dir, "install")
+        os.makedirs(install_dir)
+        digests = extract_members(io.BytesIO(data), install_dir, ["v2ray"],
+                                  ["geoip.dat", "geosite.dat"])
+        
+        if sorted(os.listdir(install_dir)) != ["geoip.dat", "v2ray"]:
+            print(f"✗ 解压了多余的文件: {os.listdir(install_dir)}")
+            return False
+        print("✓ 只解压了所需文件")
+        
+        v2ray_bin = os.path.join(install_dir, "v2ray")
+        if digests["v2ray"] != sha256_file(v2ray_bin) or not os.access(v2ray_bin, os.X_OK):
+            print("✗ 解压文件摘要或权限错误")
+            return False
+        print("✓ 解压文件摘要与权限正确")
+        
+        # 内容损坏时不替换已安装的文件
+        corrupted = bytearray(open(archive, 'rb').read())
+        offset = corrupted.find(binary[:64])
+        corrupted[offset + 100] ^= 0xFF
+        try:
+            extract_members(io.BytesIO(bytes(corrupted)), install_dir, ["v2ray"])
+            print("✗ 未检测到损坏的文件")
+            return False
+        except zipfile.BadZipFile:
+            pass
+        if open(v2ray_bin, 'rb').read() != binary or len(os.listdir(install_dir)) != 2:
+            print("✗ 损坏的文件覆盖了已安装的文件")
+            return False
+        print("✓ 损坏的文件未被安装")
+        return True
+        
+    except Exception as e:
+        print(f"✗ 选择性解压测试失败: {e}")
+        return False
+    finally:
+        server.shutdown()
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def start_ip_server(ip, delay=0):
+    """启动返回固定IP的本地HTTP服务, 用于模拟公网IP查询接口"""
+    hits = []
+    
+    class IpHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+        
+        def do_GET(self):
+            hits.append(self.path)
+            time.sleep(delay)
+            body = f"{ip}\n".encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    
+    server = ThreadingHTTPServer(("127.0.0.1", 0), IpHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, hits
+
+def test_public_ip_discovery():
+    """测试并发探测公网IP及磁盘缓存"""
+    print("\n测试公网IP探测...")
+    
+    test_dir = tempfile.mkdtemp()
+    servers = [start_ip_server("203.0.113.7"), start_ip_server("203.0.113.7"),
+               start_ip_server("198.51.100.1", delay=3)]
+    
+    try:
+        deployer = V2rayDeployer()
+        deployer.cache_dir = test_dir
+        deployer.ip_use_interfaces = False
+        deployer.ip_endpoints = [f"http://127.0.0.1:{server.server_address[1]}/ip"
+                                 for server, _ in servers]
+        
+        started = time.time()
+        ip = deployer.get_public_ip()
+        elapsed = time.time() - started
+        if ip != "203.0.113.7" or elapsed >= 3:
+            print(f"✗ 未取第一个一致的结果: {ip}, {elapsed:.2f}s")
+            return False
+        print(f"✓ 得到一致的公网IP: {ip}, 耗时 {elapsed:.2f}s")
+        
+        # 缓存有效期内不再查询
+        for _, hits in servers:
+            del hits[:]
+        if deployer.get_public_ip() != ip or any(hits for _, hits in servers):
+            print("✗ 未使用缓存的公网IP")
+            return False
+        print("✓ 使用缓存的公网IP")
+        
+        # 缓存过期后重新查询
+        deployer.ip_cache_ttl = 0
+        deployer.ip_endpoints = deployer.ip_endpoints[:1]
+        if deployer.get_public_ip() != ip or not servers[0][1]:
+            print("✗ 缓存过期后未重新查询")
+            return False
+        print("✓ 缓存过期后重新查询")
+        
+        # 所有接口都失败时使用占位符
+        deployer.ip_endpoints = ["http://127.0.0.1:1/ip"]
+        if deployer.get_public_ip() != "YOUR_SERVER_IP":
+            print("✗ 查询失败时未使用占位符")
+            return False
+        print("✓ 查询失败时使用占位符")
+        return True
+        
+    except Exception as e:
+        print(f"✗ 公网IP探测测试失败: {e}")
+        return False
+    finally:
+        for server, _ in servers:
+            server.shutdown()
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_deploy_graph():
+    """测试部署阶段按依赖关系并发执行"""
+    print("\n测试部署阶段依赖图...")
+    
+    test_dir = tempfile.mkdtemp()
+    
+    try:
+        deployer = V2rayDeployer(root=test_dir)
+        order = []
+        
+        def stage(name, delay, result=None):
+            def run(*_):
+                time.sleep(delay)
+                order.append(name)
+                return result
+            return run
+        
+        # 用耗时相同的桩函数替换各阶段
+        deployer.install_v2ray = stage("install", 0.3)
+        deployer.get_public_ip = stage("public_ip", 0.3, "1.2.3.4")
+        deployer.generate_config = stage("config", 0.3)
+        deployer.create_systemd_service = stage("service", 0.3)
+        deployer.start_service = lambda restart=False: order.append("start") or True
+        deployer.save_configs = lambda server_ip: f"info {server_ip}"
+        deployer.save_deploy_state = lambda server_ip: None
+        
+        graph = deployer.build_deploy_graph()
+        started = time.time()
+        results = graph.run()
+        elapsed = time.time() - started
+        
+        if results["client_configs"] != "info 1.2.3.4":
+            print("✗ 依赖阶段的结果未正确传递")
+            return False
+        if order[-1] != "start" or set(order[:4]) != {"install", "public_ip", "config", "service"}:
+            print(f"✗ 阶段执行顺序错误: {order}")
+            return False
+        if elapsed >= 0.9:
+            print(f"✗ 独立阶段未并发执行: {elapsed:.2f}s")
+            return False
+        print(f"✓ 独立阶段并发执行, 耗时 {elapsed:.2f}s (关键路径 {graph.critical_path():.2f}s)")
+        
+        # 服务启动失败时中止后续阶段
+        deployer.start_service = lambda restart=False: False
+        try:
+            deployer.build_deploy_graph().run()
+            print("✗ 服务启动失败时未中止")
+            return False
+        except StageError as e:
+            if e.stage != "start":
+                print(f"✗ 失败阶段错误: {e.stage}")
+                return False
+        print("✓ 服务启动失败时中止部署")
+        
+        # 阶段超时
+        graph = StageGraph().add("slow", stage("slow", 2), timeout=0.2)
+        started = time.time()
+        try:
+            graph.run()
+            print("✗ 阶段超时未报错")
+            return False
+        except StageTimeout:
+            if time.time() - started >= 1:
+                print("✗ 超时后仍在等待阶段完成")
+                return False
+        print("✓ 阶段超时后立即中止")
+        
+        # 循环依赖
+        graph = StageGraph().add("a", stage("a", 0), deps=["b"]).add("b", stage("b", 0), deps=["a"])
+        try:
+            graph.run()
+            print("✗ 未检测到循环依赖")
+            return False
+        except ValueError:
+            print("✓ 检测到循环依赖")
+        return True
+        
+    except Exception as e:
+        print(f"✗ 部署阶段依赖图测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_fleet_deploy():
+    """测试批量部署多个目标根目录"""
+    print("\n测试批量部署...")
+    
+    test_dir = tempfile.mkdtemp()
+    
+    try:
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zip_ref:
+            zip_ref.writestr("v2ray", b"#!/bin/sh\n")
+            zip_ref.writestr("geoip.dat", b"geoip")
+        
+        # 第三个目标的根目录是普通文件, 应部署失败且不影响其他目标
+        blocked = os.path.join(test_dir, "blocked")
+        open(blocked, 'w').close()
+        inventory = os.path.join(test_dir, "inventory.yaml")
+        with open(inventory, 'w') as f:
+            f.write(f"""defaults:
+  port: 20000
+targets:
+  - name: box1
+    root: {test_dir}/box1
+  - name: box2
+    root: {test_dir}/box2
+    port: 20001
+  - name: box3
+    root: {blocked}
+""")
+        targets = load_inventory(inventory)
+        fleet = FleetDeployer(targets, workers=2, output_dir=os.path.join(test_dir, "out"))
+        summary = fleet.run(archive=archive.getvalue(), server_ip="1.2.3.4")
+        
+        results = {r["name"]: r for r in summary["results"]}
+        if summary["succeeded"] != 2 or results["box3"]["success"]:
+            print(f"✗ 批量部署结果错误: {summary}")
+            return False
+        print("✓ 汇总了各目标的部署结果")
+        
+        for name, port in [("box1", 20000), ("box2", 20001)]:
+            root = os.path.join(test_dir, name)
+            with open(os.path.join(root, "etc/v2ray/config.json")) as f:
+                config = json.load(f)
+            with open(os.path.join(root, "etc/systemd/system/v2ray.service")) as f:
+                service = f.read()
+            if (config["inbounds"][0]["port"] != port
+                    or not os.path.exists(os.path.join(root, "usr/local/v2ray/v2ray"))
+                    or "ExecStart=/usr/local/v2ray/v2ray run -config /etc/v2ray/config.json" not in service
+                    or not os.path.exists(os.path.join(test_dir, "out", name, "clash.yaml"))):
+                print(f"✗ 目标 {name} 的文件不正确")
+                return False
+        print("✓ 各目标的文件写入对应的根目录")
+        
+        if not os.path.exists(os.path.join(test_dir, "out", "fleet_results.json")):
+            print("✗ 未保存批量部署结果")
+            return False
+        print("✓ 保存了批量部署结果")
+        
+        # 不指定压缩包时按清单中的v2ray版本下载, 相同版本只下载一次
+        with open(inventory, 'w') as f:
+            f.write(f"""defaults:
+  v2ray_version: v5.1.0
+targets:
+  - name: box4
+    root: {test_dir}/box4
+  - name: box5
+    root: {test_dir}/box5
+  - name: box6
+    root: {test_dir}/box6
+    v2ray_version: v5.2.0
+""")
+        downloads = []
+        
+        def download_artifact(deployer):
+            downloads.append(deployer.v2ray_version)
+            return archive.getvalue()
+        
+        fleet = FleetDeployer(load_inventory(inventory), workers=2, output_dir=os.path.join(test_dir, "out"))
+        fleet.download_artifact = download_artifact
+        summary = fleet.run(server_ip="1.2.3.4")
+        if summary["succeeded"] != 3 or sorted(downloads) != ["v5.1.0", "v5.2.0"]:
+            print(f"✗ 压缩包未按版本下载: {downloads}, {summary}")
+            return False
+        for name, version in [("box4", "v5.1.0"), ("box5", "v5.1.0"), ("box6", "v5.2.0")]:
+            with open(os.path.join(test_dir, name, "etc/v2ray/deploy_state.json")) as f:
+                if json.load(f)["v2ray_version"] != version:
+                    print(f"✗ 目标 {name} 记录的版本错误")
+                    return False
+        print("✓ 每个v2ray版本下载一次压缩包, 部署状态记录对应的版本")
+        return True
+        
+    except Exception as e:
+        print(f"✗ 批量部署测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_incremental_redeploy():
+    """测试重复部署时跳过未变化的阶段"""
+    print("\n测试增量部署...")
+    
+    test_dir = tempfile.mkdtemp()
+    
+    try:
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zip_ref:
+            zip_ref.writestr("v2ray", b"#!/bin/sh\n")
+        
+        restarts = []
+        
+        def run_deploy(port=10086, archive=None):
+            deployer = V2rayDeployer(root=test_dir)
+            deployer.port = port
+            deployer.client_configs_dir = os.path.join(test_dir, "client_configs")
+            deployer.start_service = lambda restart=False: restarts.append(restart) or True
+            if archive is None:
+                def fail_install(*_):
+                    raise Exception("不应重新安装")
+                deployer.install_v2ray = fail_install
+            deployer.build_deploy_graph(archive, "1.2.3.4").run()
+            return deployer
+        
+        first = run_deploy(archive=io.BytesIO(archive.getvalue()))
+        config_file = os.path.join(test_dir, "etc/v2ray/config.json")
+        mtime = os.stat(config_file).st_mtime_ns
+        
+        # 输入未变化: 不重新安装, 沿用UUID, 不重写文件, 不重启
+        second = run_deploy()
+        if second.user_uuid != first.user_uuid:
+            print("✗ 重新部署时生成了新的UUID")
+            return False
+        if os.stat(config_file).st_mtime_ns != mtime or restarts[-1]:
+            print("✗ 配置未变化时仍重写文件或重启服务")
+            return False
+        print("✓ 输入未变化时跳过安装、写入和重启")
+
+        # manage.py添加的用户在重新部署后保留
+        from manage import V2rayManager
+        manager = V2rayManager(config_file)
+        with contextlib.redirect_stdout(io.StringIO()):
+            added = [manager.add_user(f"u{i}@example.com") for i in range(2)]
+        with open(config_file, 'rb') as f:
+            content = f.read()
+        run_deploy()
+        with open(config_file, 'rb') as f:
+            redeployed = f.read()
+        users = [c["id"] for c in json.loads(redeployed)["inbounds"][0]["settings"]["clients"]]
+        if redeployed != content or users != [first.user_uuid] + added or restarts[-1]:
+            print(f"✗ 重新部署删除了manage.py添加的用户: {len(users)} 个用户")
+            return False
+        print("✓ 重新部署保留manage.py添加的用户, 不重写配置、不重启")
+
+        # 端口变化: 只重写配置并重启
+        run_deploy(port=20000)
+        with open(config_file) as f:
+            if json.load(f)["inbounds"][0]["port"] != 20000 or not restarts[-1]:
+                print("✗ 配置变化时未重写或未重启")
+                return False
+        with open(os.path.join(test_dir, "etc/v2ray/deploy_state.json")) as f:
+            state = json.load(f)
+        if state["port"] != 20000 or "clash.yaml" not in state["files"]:
+            print("✗ 状态清单未更新")
+            return False
+        print("✓ 配置变化时只重写配置并重启")
+        return True
+        
+    except Exception as e:
+        print(f"✗ 增量部署测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_fast_startup():
+    """测试重模块延迟导入以及zipapp打包"""
+    print("\n测试启动优化...")
+    
+    test_dir = tempfile.mkdtemp()
+    root = os.path.dirname(os.path.abspath(__file__))
+    
+    try:
+        heavy = {"deploy_v2ray": ["yaml", "zipfile", "tarfile", "urllib.request"],
+                 "manage": ["uuid", "subprocess", "pathlib"]}
+        for module, names in heavy.items():
+            code = f"import sys, {module}; print(','.join(n for n in {names!r} if n in sys.modules))"
+            result = subprocess.run([sys.executable, "-c", code], cwd=root,
+                                    capture_output=True, text=True)
+            if result.returncode != 0 or result.stdout.strip():
+                print(f"✗ {module} 启动时导入了: {result.stdout.strip() or result.stderr}")
+                return False
+        print("✓ 启动时未导入重模块")
+        
+        import build_zipapp
+        outputs = build_zipapp.build(test_dir)
+        for path in outputs:
+            with zipfile.ZipFile(path) as zip_ref:
+                names = zip_ref.namelist()
+            if "__main__.py" not in names or "manage.pyc" not in names:
+                print(f"✗ zipapp内容不完整: {names}")
+                return False
+            result = subprocess.run([sys.executable, path, "--help"], capture_output=True, text=True)
+            if result.returncode != 0 or "usage" not in result.stdout:
+                print(f"✗ zipapp无法运行: {result.stderr}")
+                return False
+        print("✓ zipapp包含预编译字节码且可以运行")
+        return True
+        
+    except Exception as e:
+        print(f"✗ 启动优化测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_batch_render():
+    """测试批量渲染结果与逐个生成的结果一致"""
+    print("\n测试批量渲染客户端配置...")
+    
+    test_dir = tempfile.mkdtemp()
+    
+    try:
+        deployer = V2rayDeployer()
+        deployer.port = 12345
+        server_ip = "1.2.3.4"
+        clients = [{"id": str(uuid.uuid4()), "alterId": 0, "email": f"user{i}@example.com"}
+                   for i in range(50)]
+        clients.append({"id": str(uuid.uuid4()), "alterId": 4})
+        
+        renderer = BatchRenderer(deployer, server_ip)
+        for client, configs in renderer.render(clients):
+            expected = V2rayDeployer()
+            expected.port = deployer.port
+            expected.user_uuid = client["id"]
+            expected.alter_id = client["alterId"]
+            expected.user_email = client.get("email", deployer.user_email)
+            if (configs["vmess"] != expected.generate_vmess_link(server_ip)
+                    or configs["clash"] != expected.generate_clash_config(server_ip)
+                    or configs["v2rayng"] != expected.generate_v2rayng_config(server_ip)
+                    or configs["surge"] != expected.generate_surge_config(server_ip)):
+                print(f"✗ 用户 {client['id']} 的批量渲染结果不一致")
+                return False
+        print("✓ 批量渲染结果与逐个生成一致")
+        
+        if renderer.rendered != len(clients) or renderer.users_per_second() <= 0:
+            print("✗ 渲染统计错误")
+            return False
+        print(f"✓ 渲染速度: {renderer.users_per_second():.0f} 用户/秒")
+        
+        count = deployer.save_user_configs(server_ip, test_dir, clients)
+        user_dir = os.path.join(test_dir, clients[0]["id"])
+        if count != len(clients) or sorted(os.listdir(user_dir)) != [
+                "clash.yaml", "surge.conf", "v2rayng.json", "vmess_link.txt"]:
+            print("✗ 用户配置文件保存错误")
+            return False
+        print("✓ 每个用户的配置文件已保存")
+        
+        count, stats = deployer.save_user_configs(server_ip, test_dir, clients, with_stats=True)
+        if stats["files_written"] != 0 or len(stats["files"]) != len(clients) * 4:
+            print("✗ 重复生成时仍写入了未变化的文件")
+            return False
+        print("✓ 重复生成时跳过未变化的文件")
+        return True
+        
+    except Exception as e:
+        print(f"✗ 批量渲染测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_clash_yaml_fast_path():
+    """测试快速YAML输出与yaml.dump逐字节一致"""
+    print("\n测试Clash配置快速序列化...")
+    
+    try:
+        deployer = V2rayDeployer()
+        server_ip = "1.2.3.4"
+        rule_sets = [
+            list(deployer.clash_rules),
+            [f"DOMAIN-SUFFIX,站点{i}.example.com,Proxy" for i in range(1000)] + ["MATCH,Proxy"],
+        ]
+        for rules in rule_sets:
+            deployer.clash_rules = rules
+            deployer.clash_fast_yaml = False
+            expected = deployer.generate_clash_config(server_ip)
+            deployer.clash_fast_yaml = True
+            # 第二次调用命中已序列化的静态段落
+            for _ in range(2):
+                if deployer.generate_clash_config(server_ip) != expected:
+                    print(f"✗ {len(rules)} 条规则时快速输出与yaml.dump不一致")
+                    return False
+        print("✓ 快速输出与yaml.dump逐字节一致")
+        
+        # 静态段落复用时, 用户字段的变化仍然生效
+        deployer.user_uuid = str(uuid.uuid4())
+        if deployer.user_uuid not in deployer.generate_clash_config(server_ip):
+            print("✗ 复用静态段落后用户字段未更新")
+            return False
+        print("✓ 复用静态段落时用户字段正确更新")
+        return True
+        
+    except Exception as e:
+        print(f"✗ Clash快速序列化测试失败: {e}")
+        return False
+
+def test_tuning_profiles():
+    """测试服务端性能配置的渲染和校验"""
+    print("\n测试性能配置...")
+    
+    test_dir = tempfile.mkdtemp()
+    
+    try:
+        deployer = V2rayDeployer()
+        deployer.config_dir = test_dir
+        deployer.config_file = os.path.join(test_dir, "config.json")
+        default_config = deployer.render_config()
+        
+        for name in PROFILES:
+            deployer.tuning_profile = name
+            deployer.generate_config()
+            with open(deployer.config_file, 'r') as f:
+                config = json.load(f)
+            validate_config(config, name)
+            if detect_profile(config) != name:
+                print(f"✗ 无法识别性能配置 {name}")
+                return False
+        print(f"✓ {len(PROFILES)} 个性能配置均通过校验")
+        
+        deployer.tuning_profile = "throughput"
+        config = json.loads(deployer.render_config())
+        if config["policy"]["levels"]["0"]["bufferSize"] != 512 \
+                or config["inbounds"][0]["streamSettings"]["sockopt"]["tcpcongestion"] != "bbr" \
+                or config["outbounds"][0]["streamSettings"]["sockopt"]["tcpFastOpen"] is not True \
+                or config["log"]["access"] != "none":
+            print("✗ throughput配置内容错误")
+            return False
+        print("✓ throughput配置包含policy、sockopt并关闭访问日志")
+        
+        # 切换回默认配置时移除policy和sockopt
+        apply_profile(config, "default", deployer.log_dir)
+        if json.dumps(config, indent=2, ensure_ascii=False) != default_config:
+            print("✗ 切换回默认配置后仍有残留设置")
+            return False
+        print("✓ 切换回默认配置后与原配置一致")
+        
+        config = json.loads(deployer.render_config())
+        config["policy"]["levels"]["0"]["connIdle"] = -1
+        for name, bad in (("throughput", config), ("low-memory", json.loads(deployer.render_config()))):
+            try:
+                validate_config(bad, name)
+                print(f"✗ 不符合 {name} 的配置通过了校验")
+                return False
+            except ValueError:
+                pass
+        deployer.tuning_profile = "turbo"
+        try:
+            deployer.generate_config()
+            print("✗ 未知的性能配置未报错")
+            return False
+        except ValueError:
+            pass
+        print("✓ 拒绝不符合性能配置的内容和未知配置")
+        return True
+        
+    except Exception as e:
+        print(f"✗ 性能配置测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_sharded_deploy():
+    """测试多实例分片部署"""
+    print("\n测试多实例部署...")
+    
+    test_dir = tempfile.mkdtemp()
+    
+    try:
+        # 用记录参数的假systemctl代替真实的服务管理
+        bin_dir = os.path.join(test_dir, "bin")
+        os.makedirs(bin_dir)
+        calls_file = os.path.join(test_dir, "systemctl.log")
+        with open(os.path.join(bin_dir, "systemctl"), 'w') as f:
+            f.write(f'#!/bin/sh\necho "$@" >> {calls_file}\n'
+                    '[ "$1" = is-active ] && echo active\nexit 0\n')
+        os.chmod(os.path.join(bin_dir, "systemctl"), 0o755)
+        
+        root = os.path.join(test_dir, "root")
+        deployer = V2rayDeployer(root=root)
+        deployer.instances = 3
+        deployer.cpu_affinity = "auto"
+        deployer.client_configs_dir = os.path.join(test_dir, "client_configs")
+        deployer.install_v2ray = lambda archive=None: None
+        deployer.service_command = ["env", f"PATH={bin_dir}:{os.environ['PATH']}"]
+        results = deployer.build_deploy_graph(None, "1.2.3.4").run()
+        
+        owner = shard_for(deployer.user_uuid, 3)
+        for shard in range(3):
+            with open(os.path.join(root, f"etc/v2ray/shard{shard}/config.json")) as f:
+                config = json.load(f)
+            inbound = config["inbounds"][0]
+            users = [c["id"] for c in inbound["settings"]["clients"]]
+            if inbound["port"] != 10086 + shard or users != ([deployer.user_uuid] if shard == owner else []) \
+                    or not config["log"]["error"].startswith(f"/var/log/v2ray/shard{shard}/"):
+                print(f"✗ 实例 shard{shard} 的配置错误")
+                return False
+        print("✓ 每个实例有独立的端口、配置和日志目录, 用户只在所属实例中")
+        
+        with open(os.path.join(root, "etc/systemd/system/v2ray@.service")) as f:
+            unit = f.read()
+        with open(os.path.join(root, "etc/systemd/system/v2ray@shard1.service.d/cpu-affinity.conf")) as f:
+            affinity = f.read()
+        if "-config /etc/v2ray/%i/config.json" not in unit \
+                or affinity != f"[Service]\nCPUAffinity={1 % os.cpu_count()}\n" \
+                or os.path.exists(os.path.join(root, "etc/systemd/system/v2ray.service")):
+            print("✗ 服务模板或CPUAffinity配置错误")
+            return False
+        print("✓ 生成v2ray@.service模板和各实例的CPUAffinity")
+        
+        with open(calls_file) as f:
+            calls = f.read().splitlines()
+        units = "v2ray@shard0 v2ray@shard1 v2ray@shard2"
+        if f"enable {units}" not in calls or f"restart {units}" not in calls:
+            print(f"✗ 未启动所有实例: {calls}")
+            return False
+        print("✓ 启动所有实例")
+        
+        if f"端口: {10086 + owner}" not in results["client_configs"]:
+            print("✗ 客户端配置未使用所属实例的端口")
+            return False
+        clients = [{"id": str(uuid.uuid4()), "alterId": 0} for _ in range(20)]
+        renderer = BatchRenderer(deployer, "1.2.3.4")
+        for client, configs in renderer.render(clients):
+            port = 10086 + shard_for(client["id"], 3)
+            if json.loads(configs["v2rayng"])["outbounds"][0]["settings"]["vnext"][0]["port"] != port:
+                print("✗ 批量渲染未使用用户所属实例的端口")
+                return False
+        print("✓ 客户端配置使用用户所属实例的端口")
+        return True
+        
+    except Exception as e:
+        print(f"✗ 多实例部署测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_transport_profiles():
+    """测试各传输方式的服务端和客户端配置一致"""
+    print("\n测试传输方式...")
+    
+    try:
+        import yaml
+        import base64
+        server_ip = "1.2.3.4"
+        for name in TRANSPORTS:
+            deployer = V2rayDeployer()
+            deployer.transport = name
+            deployer.tls_domain = "v2.example.com" if name == "h2" else None
+            server = json.loads(deployer.render_config())["inbounds"][0]["streamSettings"]
+            client = json.loads(deployer.generate_v2rayng_config(server_ip))["outbounds"][0]
+            # 除TLS证书外, 服务端与V2RayNG的传输设置相同
+            stripped = {k: v for k, v in server.items() if k not in ("tlsSettings", "sockopt")}
+            if stripped != {k: v for k, v in client["streamSettings"].items() if k != "tlsSettings"}:
+                print(f"✗ {name}: 服务端与V2RayNG的传输设置不一致")
+                return False
+            if detect_transport(server)["transport"] != name:
+                print(f"✗ {name}: 无法从服务端配置识别传输方式")
+                return False
+            
+            link = json.loads(base64.b64decode(deployer.generate_vmess_link(server_ip)[8:]))
+            expected_net = {"tcp-http": "tcp", "ws": "ws", "grpc": "grpc", "mkcp": "kcp", "h2": "h2"}[name]
+            if link["net"] != expected_net or link["tls"] != ("tls" if deployer.tls_domain else ""):
+                print(f"✗ {name}: vmess链接传输参数错误 {link}")
+                return False
+            
+            configs = deployer.render_client_configs(server_ip)
+            if "clash" in deployer.client_formats():
+                proxy = yaml.safe_load(configs["clash.yaml"])["proxies"][0]
+                if proxy["network"] != ("tcp" if name == "tcp-http" else expected_net):
+                    print(f"✗ {name}: Clash传输参数错误")
+                    return False
+            elif "clash.yaml" in configs:
+                print(f"✗ {name}: 生成了不支持的Clash配置")
+                return False
+            if ("surge.conf" in configs) != ("surge" in deployer.client_formats()):
+                print(f"✗ {name}: Surge配置与支持情况不符")
+                return False
+        print(f"✓ {len(TRANSPORTS)} 种传输方式的服务端与客户端配置一致")
+        
+        deployer = V2rayDeployer()
+        deployer.transport = "ws"
+        deployer.tls_domain = "v2.example.com"
+        surge = deployer.generate_surge_config(server_ip)
+        mux = json.loads(deployer.generate_v2rayng_config(server_ip))["outbounds"][0]["mux"]
+        if "ws=true, ws-path=/ray" not in surge or "sni=v2.example.com" not in surge \
+                or mux != {"enabled": True, "concurrency": 8}:
+            print("✗ ws传输的Surge或mux设置错误")
+            return False
+        deployer.mux_concurrency = 0
+        if json.loads(deployer.generate_v2rayng_config(server_ip))["outbounds"][0]["mux"]["enabled"]:
+            print("✗ 无法关闭mux")
+            return False
+        print("✓ Surge ws参数和mux并发数设置正确")
+        
+        clients = [{"id": str(uuid.uuid4()), "alterId": 0, "email": "a@example.com"}]
+        for name in ("grpc", "mkcp"):
+            deployer.transport = name
+            renderer = BatchRenderer(deployer, server_ip)
+            _, configs = next(renderer.render(clients))
+            deployer.user_uuid = clients[0]["id"]
+            deployer.user_email = clients[0]["email"]
+            if set(configs) != set(deployer.client_formats()) \
+                    or configs["v2rayng"] != deployer.generate_v2rayng_config(server_ip):
+                print(f"✗ {name}: 批量渲染结果与逐个生成不一致")
+                return False
+        print("✓ 批量渲染只生成支持的客户端格式")
+        
+        deployer.transport = "h2"
+        deployer.tls_domain = None
+        try:
+            deployer.render_config()
+            print("✗ h2传输未开启TLS时未报错")
+            return False
+        except ValueError:
+            pass
+        print("✓ h2传输要求开启TLS")
+        return True
+        
+    except Exception as e:
+        print(f"✗ 传输方式测试失败: {e}")
+        return False
+
+def test_rule_compiler():
+    """测试规则列表编译和Clash/Surge规则文件"""
+    print("\n测试规则编译...")
+    
+    test_dir = tempfile.mkdtemp()
+    
+    try:
+        lines = [
+            "# 注释", "", "example.com", "a.example.com", "DOMAIN-SUFFIX,B.Example.com",
+            "full:c.example.com", "full:only.org", "DOMAIN,only.org", "+.deep.x.net", "x.net",
+            "keyword:tracker", "tracker.cdn.io", "10.0.0.0/25", "10.0.0.128/25",
+            "IP-CIDR,10.0.1.0/24,no-resolve", "192.168.1.1", "2001:db8::/33",
+            "IP-CIDR6,2001:db8:8000::/33", "not a rule!"
+        ]
+        compiled = compile_rule_set("ads", lines, "REJECT")
+        if compiled.suffixes != ["example.com", "x.net"] or compiled.domains != ["only.org"] \
+                or compiled.keywords != ["tracker"] or compiled.skipped != 1 \
+                or [str(n) for n in compiled.networks] != ["10.0.0.0/23", "192.168.1.1/32", "2001:db8::/32"]:
+            print(f"✗ 编译结果错误: {compiled.suffixes} {compiled.domains} {compiled.networks}")
+            return False
+        if compiled.input_count != 17 or compiled.output_count != 7:
+            print(f"✗ 条目统计错误: {compiled.input_count} -> {compiled.output_count}")
+            return False
+        print(f"✓ 去重、后缀合并和网段合并正确 (减少 {compiled.reduction():.0%})")
+        
+        # 编译后的规则与原列表匹配同样的域名
+        import random
+        rng = random.Random(7)
+        domains = [f"{rng.choice(['a', 'b', 'www'])}.s{rng.randrange(300)}.com" for _ in range(3000)]
+        suffixes = [f"s{i}.com" for i in range(0, 300, 3)]
+        big = compile_rule_set("big", domains + suffixes)
+        matched = set(big.suffixes)
+        for domain in domains + suffixes:
+            labels = domain.split(".")
+            if not any(".".join(labels[i:]) in matched for i in range(len(labels))):
+                print(f"✗ 编译后未覆盖 {domain}")
+                return False
+        if len(big.suffixes) >= len(set(domains + suffixes)):
+            print("✗ 后缀树未减少条目")
+            return False
+        print(f"✓ {big.input_count} 条规则编译为 {big.output_count} 条且覆盖范围不变")
+        
+        list_file = os.path.join(test_dir, "ads.txt")
+        with open(list_file, 'w') as f:
+            f.write("\n".join(lines))
+        deployer = V2rayDeployer()
+        deployer.client_configs_dir = os.path.join(test_dir, "client_configs")
+        deployer.rule_sets = [{"name": "ads", "files": [list_file], "policy": "REJECT"}]
+        deployer.save_configs("1.2.3.4")
+        
+        import yaml
+        with open(os.path.join(deployer.client_configs_dir, "clash.yaml")) as f:
+            clash = yaml.safe_load(f)
+        with open(os.path.join(deployer.client_configs_dir, "rules/ads-domain.yaml")) as f:
+            payload = yaml.safe_load(f)["payload"]
+        with open(os.path.join(deployer.client_configs_dir, "surge.conf")) as f:
+            surge = f.read()
+        if clash["rules"][0] != "RULE-SET,ads-domain,REJECT" \
+                or clash["rule-providers"]["ads-ipcidr"]["behavior"] != "ipcidr" \
+                or payload != ["+.example.com", "+.x.net", "only.org"] \
+                or "DOMAIN-SET,rules/ads-domain.txt,REJECT" not in surge \
+                or not os.path.exists(os.path.join(deployer.client_configs_dir, "rules/ads-rules.list")):
+            print("✗ 规则文件或客户端配置中的引用错误")
+            return False
+        
+        deployer.rule_base_url = "https://example.com/rules/"
+        provider = yaml.safe_load(deployer.generate_clash_config("1.2.3.4"))["rule-providers"]["ads-domain"]
+        if provider["type"] != "http" or provider["url"] != "https://example.com/rules/ads-domain.yaml":
+            print("✗ 规则下载地址错误")
+            return False
+        print("✓ 生成Clash rule-provider和Surge规则集文件")
+        return True
+        
+    except Exception as e:
+        print(f"✗ 规则编译测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_server_routing():
+    """测试服务端路由规则和blackhole出站"""
+    print("\n测试服务端路由...")
+    
+    test_dir = tempfile.mkdtemp()
+    
+    try:
+        lines = ["geosite:Category-Ads-All", "GEOSITE,category-ads-all", "ads.example.com",
+                 "example.com", "full:track.io", "keyword:adserver", "GEOIP,private,no-resolve",
+                 "10.0.0.0/25", "10.0.0.128/25"]
+        rules, compiled = compile_route_set("ads", "block", lines)
+        if rules != [
+                {"type": "field", "outboundTag": "block",
+                 "domain": ["geosite:category-ads-all", "domain:example.com", "full:track.io",
+                            "keyword:adserver"]},
+                {"type": "field", "outboundTag": "block", "ip": ["geoip:private", "10.0.0.0/24"]}]:
+            print(f"✗ 路由规则错误: {rules}")
+            return False
+        try:
+            compile_route_set("ads", "block", lines, use_geodata=False)
+            print("✗ 未安装geodata时应拒绝geosite引用")
+            return False
+        except ValueError:
+            pass
+        print("✓ 路由列表编译为去重后的domain/ip规则并保留geosite/geoip引用")
+        
+        block_file = os.path.join(test_dir, "block.txt")
+        direct_file = os.path.join(test_dir, "direct.txt")
+        with open(block_file, 'w') as f:
+            f.write("\n".join(lines))
+        with open(direct_file, 'w') as f:
+            f.write("ok.example.com\n")
+        deployer = V2rayDeployer()
+        deployer.enable_stats = True
+        deployer.route_sets = [{"name": "allow", "files": [direct_file], "policy": "direct"},
+                               {"name": "ads", "files": [block_file], "policy": "block"}]
+        config = json.loads(deployer.render_config())
+        tags = [o.get("tag") for o in config["outbounds"]]
+        routing = config["routing"]
+        if tags != ["direct", "block"] or config["outbounds"][1]["protocol"] != "blackhole" \
+                or routing["domainStrategy"] != "AsIs" \
+                or [r["outboundTag"] for r in routing["rules"]] != ["api", "direct", "block", "block"]:
+            print(f"✗ 服务端配置中的路由错误: {tags} {routing}")
+            return False
+        validate_config(config, deployer.tuning_profile)
+        
+        plain = json.loads(V2rayDeployer().render_config())
+        if "routing" in plain or "tag" in plain["outbounds"][0]:
+            print("✗ 未设置路由列表时不应修改配置")
+            return False
+        print("✓ 服务端配置包含路由规则和blackhole出站")
+        return True
+        
+    except Exception as e:
+        print(f"✗ 服务端路由测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
 def main():
     """运行所有测试"""
     print("V2Ray部署脚本功能测试")
@@ -210,6 +1419,22 @@ def main():
         test_config_generation,
         test_service_file_generation,
         test_client_configs,
+        test_artifact_cache,
+        test_ranged_download,
+        test_mirror_racing,
+        test_selective_extraction,
+        test_public_ip_discovery,
+        test_deploy_graph,
+        test_fleet_deploy,
+        test_incremental_redeploy,
+        test_fast_startup,
+        test_batch_render,
+        test_clash_yaml_fast_path,
+        test_tuning_profiles,
+        test_sharded_deploy,
+        test_transport_profiles,
+        test_rule_compiler,
+        test_server_routing,
     ]
     
     passed = 0
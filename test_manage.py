@@ -0,0 +1,934 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import json
+import io
+import gzip
+import time
+import uuid
+import asyncio
+import tempfile
+import contextlib
+import shutil
+import socket
+import struct
+import threading
+import subprocess
+import http.client
+from subscription_server import SubscriptionServer
+from manage import V2rayManager, build_parser
+from manage_daemon import DaemonClient, ManageDaemon, forward
+from tuning import detect_profile, validate_config
+from sharding import instance_config_file, shard_for
+from deploy_v2ray import V2rayDeployer
+from locking import Journal, atomic_write
+from reloader import handover_config
+from stats import enable_stats
+
+# 代替v2ray命令行的统计API: 从JSON文件读取计数器, 记录每次调用的参数
+STATS_STUB = """#!{python}
+import sys, json
+counters_file, calls_file = {counters!r}, {calls!r}
+with open(calls_file, 'a') as f:
+    f.write(json.dumps(sys.argv[1:]) + "\\n")
+server = [a for a in sys.argv if a.startswith("--server=")][0].split("=", 1)[1]
+with open(counters_file) as f:
+    counters = json.load(f)
+stats = counters.get(server, {{}})
+print(json.dumps({{"stat": [{{"name": name, "value": str(value)}} for name, value in stats.items()]}}))
+if "-reset" in sys.argv:
+    counters[server] = {{name: 0 for name in stats}}
+    with open(counters_file, 'w') as f:
+        json.dump(counters, f)
+"""
+
+SERVICE_STUB = """#!{python}
+import os, sys, json
+with open({calls!r}, 'a') as f:
+    f.write(json.dumps([os.path.basename(sys.argv[0])] + sys.argv[1:]) + "\\n")
+if "is-active" in sys.argv:
+    print("failed" if os.path.exists({failed!r}) and "handover" in sys.argv[-1] else "active")
+"""
+
+class HandlerStub:
+    """代替v2ray HandlerService的gRPC (明文HTTP/2) 服务, 记录每次AlterInbound请求
+
+    只解析HandlerClient发送的不索引字面量头部; reject为True时以trailers返回错误
+    """
+
+    def __init__(self, reject=False):
+        self.reject = reject
+        self.calls = []
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen()
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    @staticmethod
+    def frame(frame_type, flags, stream_id, payload=b""):
+        return struct.pack(">I", len(payload))[1:] + bytes([frame_type, flags]) + \
+            struct.pack(">I", stream_id) + payload
+
+    @staticmethod
+    def headers(*pairs):
+        return b"".join(b"\x00" + bytes([len(n)]) + n.encode() + bytes([len(v)]) + v.encode()
+                        for n, v in pairs)
+
+    def handle(self, conn):
+        with conn:
+            f = conn.makefile('rb')
+            f.read(24)
+            conn.sendall(self.frame(4, 0, 0))
+            paths = {}
+            while True:
+                header = f.read(9)
+                if len(header) < 9:
+                    return
+                length = int.from_bytes(header[:3], 'big')
+                frame_type, flags = header[3], header[4]
+                stream_id = struct.unpack(">I", header[5:])[0]
+                payload = f.read(length)
+                if frame_type == 1:
+                    fields, pos = {}, 0
+                    while pos < len(payload):
+                        name_len = payload[pos + 1]
+                        name = payload[pos + 2:pos + 2 + name_len].decode()
+                        pos += 2 + name_len
+                        value_len = payload[pos]
+                        fields[name] = payload[pos + 1:pos + 1 + value_len].decode()
+                        pos += 1 + value_len
+                    paths[stream_id] = fields[":path"]
+                elif frame_type == 0 and stream_id:
+                    self.calls.append((paths[stream_id], payload[5:]))
+                    if self.reject:
+                        conn.sendall(self.frame(1, 0x5, stream_id, self.headers(
+                            (":status", "200"), ("grpc-status", "2"))))
+                        continue
+                    conn.sendall(self.frame(1, 0x4, stream_id, self.headers((":status", "200")))
+                                 + self.frame(0, 0, stream_id, b"\x00" * 5)
+                                 + self.frame(1, 0x5, stream_id, self.headers(("grpc-status", "0"))))
+
+def write_config(path, clients, port=10086):
+    """写入测试用的服务端配置"""
+    config = {
+        "inbounds": [{
+            "port": port,
+            "protocol": "vmess",
+            "settings": {"clients": clients}
+        }],
+        "outbounds": [{"protocol": "freedom", "settings": {}}]
+    }
+    with open(path, 'w') as f:
+        json.dump(config, f, indent=2)
+
+def start_event_loop():
+    """在后台线程中运行事件循环"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def test_subscription_server():
+    """测试订阅服务的缓存、ETag、gzip和按用户失效"""
+    print("测试订阅服务...")
+
+    test_dir = tempfile.mkdtemp()
+    loop = start_event_loop()
+
+    try:
+        config_file = os.path.join(test_dir, "config.json")
+        alice = {"id": str(uuid.uuid4()), "alterId": 0, "email": "alice@example.com"}
+        bob = {"id": str(uuid.uuid4()), "alterId": 0, "email": "bob@example.com"}
+        write_config(config_file, [alice, bob])
+
+        server = SubscriptionServer(config_file, "1.2.3.4", "127.0.0.1", 0, poll_interval=3600)
+        asyncio.run_coroutine_threadsafe(server.start(), loop).result(5)
+        conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+
+        def get(path, headers=None):
+            conn.request("GET", path, headers=headers or {})
+            response = conn.getresponse()
+            return response, response.read()
+
+        response, body = get(f"/clash/{alice['id']}")
+        if response.status != 200 or alice["id"].encode() not in body:
+            print(f"✗ Clash订阅返回错误: {response.status}")
+            return False
+        etag = response.getheader("ETag")
+        print("✓ 返回Clash订阅")
+
+        response, body = get(f"/clash/{alice['id']}", {"If-None-Match": etag})
+        if response.status != 304 or body:
+            print(f"✗ ETag未命中: {response.status}")
+            return False
+        print("✓ If-None-Match返回304")
+
+        response, body = get(f"/v2rayng/{alice['id']}", {"Accept-Encoding": "gzip"})
+        if response.getheader("Content-Encoding") != "gzip" or \
+                json.loads(gzip.decompress(body))["outbounds"][0]["settings"]["vnext"][0]["users"][0]["id"] != alice["id"]:
+            print("✗ gzip响应错误")
+            return False
+        print("✓ 返回预压缩的gzip响应")
+
+        response, _ = get(f"/sub/{uuid.uuid4()}")
+        if response.status != 404:
+            print("✗ 未知用户未返回404")
+            return False
+        print("✓ 未知用户返回404")
+
+        # 只修改bob, alice的缓存应保留
+        get(f"/clash/{bob['id']}")
+        alice_entry = server.cache[alice["id"]]["clash"]
+        bob["alterId"] = 4
+        write_config(config_file, [alice, bob])
+        os.utime(config_file, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+        if not server.reload_if_changed():
+            print("✗ 未检测到配置变化")
+            return False
+        if server.cache[alice["id"]]["clash"] is not alice_entry or bob["id"] in server.cache:
+            print("✗ 配置变化后缓存失效范围错误")
+            return False
+        response, body = get(f"/clash/{bob['id']}")
+        if b"alterId: 4" not in body:
+            print("✗ 变化用户的订阅未更新")
+            return False
+        print("✓ 只清除了变化用户的缓存")
+
+        conn.close()
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result(5)
+
+        # 多实例部署: 没有顶层config.json, 每个用户使用所在实例的端口
+        sharded_dir = os.path.join(test_dir, "sharded")
+        users = [alice, bob]
+        for shard, user in enumerate(users):
+            path = instance_config_file(sharded_dir, shard)
+            os.makedirs(os.path.dirname(path))
+            write_config(path, [user], port=10086 + shard)
+        manager = V2rayManager(os.path.join(sharded_dir, "config.json"))
+        server = SubscriptionServer([manager.shard_config_file(s) for s in manager.shards()],
+                                    "1.2.3.4", "127.0.0.1", 0, poll_interval=3600)
+        asyncio.run_coroutine_threadsafe(server.start(), loop).result(5)
+        conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+        for shard, user in enumerate(users):
+            response, body = get(f"/v2rayng/{user['id']}")
+            vnext = json.loads(body)["outbounds"][0]["settings"]["vnext"][0]
+            if response.status != 200 or vnext["port"] != 10086 + shard or vnext["users"][0]["id"] != user["id"]:
+                print(f"✗ 多实例订阅未使用所在实例的端口: {response.status}")
+                return False
+        conn.close()
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result(5)
+        print("✓ 多实例部署时读取所有实例的配置, 订阅使用所在实例的端口")
+        return True
+
+    except Exception as e:
+        print(f"✗ 订阅服务测试失败: {e}")
+        return False
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_set_profile():
+    """测试切换性能配置"""
+    print("\n测试切换性能配置...")
+
+    test_dir = tempfile.mkdtemp()
+
+    try:
+        manager = V2rayManager(os.path.join(test_dir, "config.json"))
+        alice = {"id": str(uuid.uuid4()), "alterId": 0}
+        write_config(manager.config_file, [alice])
+
+        for name in ("low-latency", "low-memory", "default"):
+            if not manager.set_profile(name):
+                print(f"✗ 切换到 {name} 失败")
+                return False
+            config = manager.load_config()
+            if detect_profile(config) != name:
+                print(f"✗ 切换后的配置不符合 {name}")
+                return False
+            if config["inbounds"][0]["settings"]["clients"] != [alice]:
+                print("✗ 切换性能配置时改动了用户")
+                return False
+        print("✓ 切换性能配置并保留用户")
+
+        if manager.set_profile("turbo"):
+            print("✗ 未知的性能配置未报错")
+            return False
+        print("✓ 拒绝未知的性能配置")
+        return True
+
+    except Exception as e:
+        print(f"✗ 切换性能配置测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_sharded_users():
+    """测试多实例部署时按UUID分片管理用户"""
+    print("\n测试多实例用户管理...")
+
+    test_dir = tempfile.mkdtemp()
+
+    try:
+        for shard in range(3):
+            path = instance_config_file(test_dir, shard)
+            os.makedirs(os.path.dirname(path))
+            write_config(path, [], port=10086 + shard)
+        manager = V2rayManager(os.path.join(test_dir, "config.json"))
+        if manager.instances != 3:
+            print(f"✗ 实例数识别错误: {manager.instances}")
+            return False
+
+        added = [manager.add_user(f"user{i}@example.com") for i in range(12)]
+        for user_id in added:
+            shard = shard_for(user_id, 3)
+            for other in range(3):
+                ids = [c["id"] for c in manager.load_config(other)["inbounds"][0]["settings"]["clients"]]
+                if (user_id in ids) != (other == shard):
+                    print(f"✗ 用户 {user_id} 未写入所属实例 shard{shard}")
+                    return False
+        print("✓ 新用户按UUID写入所属实例")
+
+        if not manager.remove_user(added[0]) or manager.remove_user(added[0]):
+            print("✗ 删除用户失败")
+            return False
+        remaining = sum(len(manager.load_config(s)["inbounds"][0]["settings"]["clients"])
+                        for s in manager.shards())
+        if remaining != len(added) - 1:
+            print("✗ 删除用户后用户数错误")
+            return False
+        print("✓ 从所属实例删除用户")
+
+        if manager.units(shard_for(added[1], 3)) != [f"v2ray@shard{shard_for(added[1], 3)}"] \
+                or len(manager.units()) != 3:
+            print("✗ 服务实例名称错误")
+            return False
+
+        manager.change_port(20000)
+        ports = [manager.load_config(s)["inbounds"][0]["port"] for s in manager.shards()]
+        if ports != [20000, 20001, 20002]:
+            print(f"✗ 多实例端口修改错误: {ports}")
+            return False
+        print("✓ 多实例端口按序号递增")
+        return True
+
+    except Exception as e:
+        print(f"✗ 多实例用户管理测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_stats():
+    """测试流量统计的配置和查询"""
+    print("\n测试流量统计...")
+
+    test_dir = tempfile.mkdtemp()
+
+    try:
+        # 两个实例, 配置由部署脚本生成
+        deployer = V2rayDeployer()
+        deployer.instances = 2
+        deployer.enable_stats = True
+        deployer.tuning_profile = "throughput"
+        deployer.config_dir = test_dir
+        for shard in range(2):
+            config = json.loads(deployer.render_config(shard))
+            validate_config(config, "throughput")
+            api = [i for i in config["inbounds"] if i.get("tag") == "api"]
+            level = config["policy"]["levels"]["0"]
+            if not api or api[0]["listen"] != "127.0.0.1" or api[0]["port"] != 10085 - shard \
+                    or not level["statsUserUplink"] or "stats" not in config \
+                    or config["routing"]["rules"][0]["outboundTag"] != "api":
+                print("✗ 统计API配置错误")
+                return False
+            path = instance_config_file(test_dir, shard)
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                json.dump(config, f)
+        print("✓ 开启stats、api和policy统计, api只监听127.0.0.1")
+
+        def counter(email, direction):
+            return f"user>>>{email}>>>traffic>>>{direction}"
+        counters = {
+            "127.0.0.1:10085": {counter("a@x", "uplink"): 100, counter("a@x", "downlink"): 5000,
+                                counter("b@x", "uplink"): 10, counter("b@x", "downlink"): 20},
+            "127.0.0.1:10084": {counter("c@x", "uplink"): 3000, counter("c@x", "downlink"): 1},
+        }
+        counters_file = os.path.join(test_dir, "counters.json")
+        calls_file = os.path.join(test_dir, "calls.log")
+        with open(counters_file, 'w') as f:
+            json.dump(counters, f)
+        binary = os.path.join(test_dir, "v2ray")
+        with open(binary, 'w') as f:
+            f.write(STATS_STUB.format(python=sys.executable, counters=counters_file, calls=calls_file))
+        os.chmod(binary, 0o755)
+
+        manager = V2rayManager(os.path.join(test_dir, "config.json"))
+        manager.v2ray_binary = binary
+        rows = manager.show_stats()
+        if [row[0] for row in rows] != ["a@x", "c@x", "b@x"] or rows[0][1:] != (100, 5000, 5100):
+            print(f"✗ 流量统计结果错误: {rows}")
+            return False
+        with open(calls_file) as f:
+            calls = [json.loads(line) for line in f]
+        if len(calls) != 2 or calls[0][:2] != ["api", "stats"] or calls[0][-1] != "user>>>":
+            print(f"✗ 未按实例批量查询: {calls}")
+            return False
+        print("✓ 每个实例一次批量查询并按总流量排序")
+
+        rows = manager.show_stats(sort="uplink", top=1)
+        if rows != [("c@x", 3000, 1, 3001)]:
+            print(f"✗ 排序或top-N错误: {rows}")
+            return False
+        print("✓ 按上行排序并只显示前N个用户")
+
+        manager.show_stats(reset=True)
+        rows = manager.show_stats()
+        if any(row[3] for row in rows):
+            print("✗ 清零后仍有流量")
+            return False
+        print("✓ 查询后清零")
+        return True
+
+    except Exception as e:
+        print(f"✗ 流量统计测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_user_store():
+    """测试用户库迁移以及由用户库渲染config.json"""
+    print("\n测试用户库...")
+
+    test_dir = tempfile.mkdtemp()
+
+    try:
+        manager = V2rayManager(os.path.join(test_dir, "config.json"))
+        if manager.user_store() is not None or os.path.exists(manager.user_db):
+            print("✗ 配置文件不存在时不应创建用户库")
+            return False
+
+        alice = {"id": str(uuid.uuid4()), "alterId": 0, "email": "alice@example.com", "level": 1}
+        bob = {"id": str(uuid.uuid4()).upper(), "alterId": 4}
+        write_config(manager.config_file, [alice, bob])
+        store = manager.user_store()
+        if store.count() != 2 or store.get(bob["id"].lower()) != (None, bob) \
+                or store.find_email("alice@example.com") != [alice]:
+            print("✗ 从配置文件迁移用户失败")
+            return False
+        print("✓ 首次使用时从配置文件迁移用户并保留其他字段")
+
+        carol = manager.add_user("carol@example.com")
+        if not manager.remove_user(alice["id"]) or manager.remove_user(alice["id"]):
+            print("✗ 删除用户失败")
+            return False
+        clients = manager.load_config()["inbounds"][0]["settings"]["clients"]
+        if [c["id"] for c in clients] != [bob["id"], carol] or clients[1]["email"] != "carol@example.com":
+            print(f"✗ config.json未按用户库渲染: {clients}")
+            return False
+        print("✓ 增删用户后由用户库渲染config.json")
+
+        # 重新打开时使用已有的用户库, 不再从配置文件迁移
+        write_config(manager.config_file, [])
+        reopened = V2rayManager(manager.config_file)
+        if reopened.user_store().count() != 2 or reopened.migrate_users() != 0:
+            print("✗ 重新打开用户库失败")
+            return False
+        print("✓ 用户库是用户的唯一来源")
+        return True
+
+    except Exception as e:
+        print(f"✗ 用户库测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_bulk_import():
+    """测试批量导入导出用户: 一次事务、每个实例只写一次配置"""
+    print("\n测试批量导入导出...")
+
+    test_dir = tempfile.mkdtemp()
+
+    try:
+        for shard in range(2):
+            path = instance_config_file(test_dir, shard)
+            os.makedirs(os.path.dirname(path))
+            write_config(path, [], port=10086 + shard)
+        manager = V2rayManager(os.path.join(test_dir, "config.json"))
+        saved = []
+        save_config = manager.save_config
+        manager.save_config = lambda config, shard=None: saved.append(shard) or save_config(config, shard)
+
+        ids = [str(uuid.uuid4()) for _ in range(2000)]
+        csv_file = os.path.join(test_dir, "users.csv")
+        with open(csv_file, 'w') as f:
+            f.write("uuid,email,alterId\n")
+            for i, user_id in enumerate(ids):
+                f.write(f"{user_id},user{i}@example.com,0\n")
+            # 重复的UUID和email
+            f.write(f"{ids[0]},other@example.com,0\n")
+            f.write(f"{uuid.uuid4()},user1@example.com,0\n")
+            f.write(",new@example.com,\n")
+        touched = manager.import_users(csv_file)
+        store = manager.user_store()
+        if touched != [0, 1] or sorted(saved) != [0, 1] or store.count() != 2001:
+            print(f"✗ 批量添加错误: 实例 {touched}, 写入 {saved}, 用户数 {store.count()}")
+            return False
+        on_disk = sum(len(manager.load_config(s)["inbounds"][0]["settings"]["clients"]) for s in range(2))
+        if on_disk != 2001 or len(store.find_email("new@example.com")) != 1:
+            print("✗ 配置文件中的用户数错误")
+            return False
+        print("✓ 2003条记录一次导入, 跳过重复项, 每个实例只写一次配置")
+
+        jsonl_file = os.path.join(test_dir, "changes.jsonl")
+        with open(jsonl_file, 'w') as f:
+            f.write(json.dumps({"action": "remove", "uuid": ids[0]}) + "\n")
+            f.write(json.dumps({"action": "remove", "email": "user2@example.com"}) + "\n")
+            f.write(json.dumps({"action": "update", "uuid": ids[3], "alterId": 4}) + "\n")
+            f.write(json.dumps({"action": "update", "uuid": ids[4], "email": "user5@example.com"}) + "\n")
+            f.write(json.dumps({"action": "remove", "uuid": str(uuid.uuid4())}) + "\n")
+        saved.clear()
+        manager.import_users(jsonl_file)
+        if store.count() != 1999 or store.get(ids[3])[1]["alterId"] != 4 \
+                or store.get(ids[4])[1]["email"] != "user4@example.com" or len(saved) > 2:
+            print("✗ 批量删除和更新错误")
+            return False
+        print("✓ 批量删除和更新, email冲突和不存在的用户被跳过")
+
+        # 同一用户的多条记录按文件中的顺序执行
+        with open(jsonl_file, 'w') as f:
+            f.write(json.dumps({"action": "update", "uuid": ids[5], "alterId": 2}) + "\n")
+            f.write(json.dumps({"action": "remove", "uuid": ids[5]}) + "\n")
+            f.write(json.dumps({"action": "remove", "uuid": ids[6]}) + "\n")
+            f.write(json.dumps({"action": "add", "uuid": ids[6], "email": "back@example.com"}) + "\n")
+        if manager.import_users(jsonl_file) is None:
+            print("✗ 先更新后删除、先删除后添加的导入失败")
+            return False
+        clients = {c["id"]: c for s in range(2)
+                   for c in manager.load_config(s)["inbounds"][0]["settings"]["clients"]}
+        if store.get(ids[5]) or ids[5] in clients or store.get(ids[6])[1]["email"] != "back@example.com" \
+                or clients[ids[6]]["email"] != "back@example.com" or len(clients) != 1998 or store.count() != 1998:
+            print("✗ 同一用户的多条记录执行顺序错误")
+            return False
+        print("✓ 先更新后删除、先删除后添加按记录顺序执行, 用户库与配置文件一致")
+
+        export_file = os.path.join(test_dir, "export.jsonl")
+        if manager.export_users(export_file) != 1998:
+            print("✗ 导出用户数错误")
+            return False
+        other = V2rayManager(os.path.join(test_dir, "other", "config.json"))
+        os.makedirs(os.path.dirname(other.config_file))
+        write_config(other.config_file, [])
+        other.import_users(export_file)
+        if sorted(c["id"] for _, c in other.user_store().users()) != \
+                sorted(c["id"] for _, c in store.users()):
+            print("✗ 导出的文件无法重新导入")
+            return False
+        print("✓ 导出的用户可以重新导入")
+        return True
+
+    except Exception as e:
+        print(f"✗ 批量导入导出测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_hot_users():
+    """测试通过HandlerService增删用户, API不可用时退回重启"""
+    print("\n测试不重启增删用户...")
+
+    test_dir = tempfile.mkdtemp()
+    stub = HandlerStub()
+
+    try:
+        deployer = V2rayDeployer()
+        deployer.enable_stats = True
+        deployer.api_port = stub.port
+        config = json.loads(deployer.render_config())
+        if config["inbounds"][0]["tag"] != "proxy" or "HandlerService" not in config["api"]["services"]:
+            print("✗ 部署的配置未开启HandlerService")
+            return False
+        config["inbounds"][0]["settings"]["clients"] = []
+        manager = V2rayManager(os.path.join(test_dir, "config.json"))
+        with open(manager.config_file, 'w') as f:
+            json.dump(config, f)
+
+        user_id = manager.add_user("hot@example.com")
+        if manager.pending_restarts or len(stub.calls) != 1:
+            print("✗ 添加用户未通过API生效")
+            return False
+        path, message = stub.calls[0]
+        if not path.endswith("HandlerService/AlterInbound") or b"proxy" not in message \
+                or b"AddUserOperation" not in message or user_id.encode() not in message \
+                or b"hot@example.com" not in message:
+            print(f"✗ AlterInbound请求内容错误: {path} {message!r}")
+            return False
+        if user_id not in [c["id"] for c in manager.load_config()["inbounds"][0]["settings"]["clients"]]:
+            print("✗ 用户未写入config.json")
+            return False
+        print("✓ 添加用户通过AlterInbound生效并写入config.json")
+
+        jsonl_file = os.path.join(test_dir, "users.jsonl")
+        with open(jsonl_file, 'w') as f:
+            for i in range(50):
+                f.write(json.dumps({"email": f"bulk{i}@example.com"}) + "\n")
+            f.write(json.dumps({"action": "remove", "uuid": user_id}) + "\n")
+        manager.import_users(jsonl_file)
+        if not manager.remove_user(manager.user_store().find_email("bulk0@example.com")[0]["id"]) \
+                or manager.pending_restarts or len(stub.calls) != 53 \
+                or b"RemoveUserOperation" not in stub.calls[1][1]:
+            print(f"✗ 批量导入或删除用户未通过API生效: {len(stub.calls)}")
+            return False
+        print("✓ 批量导入和删除用户通过同一个API连接生效")
+
+        stub.reject = True
+        manager.add_user("rejected@example.com")
+        manager.add_user()
+        if manager.pending_restarts != {None}:
+            print("✗ API拒绝请求时未退回重启")
+            return False
+        manager.pending_restarts.clear()
+        # api入站指向没有监听的端口
+        unused = socket.socket()
+        unused.bind(("127.0.0.1", 0))
+        config = manager.load_config()
+        config["inbounds"][-1]["port"] = unused.getsockname()[1]
+        unused.close()
+        manager.save_config(config)
+        manager.add_user("offline@example.com")
+        if manager.pending_restarts != {None}:
+            print("✗ API不可用时未退回重启")
+            return False
+        print("✓ API拒绝请求或不可用时提示重启")
+        return True
+
+    except Exception as e:
+        print(f"✗ 不重启增删用户测试失败: {e}")
+        return False
+    finally:
+        stub.close()
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_concurrent_writes():
+    """测试配置文件的原子写入、日志批量渲染和多进程并发修改"""
+    print("\n测试并发安全的配置写入...")
+
+    test_dir = tempfile.mkdtemp()
+
+    try:
+        manager = V2rayManager(os.path.join(test_dir, "config.json"))
+        write_config(manager.config_file, [])
+        with open(manager.config_file) as f:
+            original = f.read()
+        replace = os.replace
+        def fail(*args):
+            raise OSError("模拟写入中途崩溃")
+        os.replace = fail
+        try:
+            atomic_write(manager.config_file, "{")
+        except OSError:
+            pass
+        finally:
+            os.replace = replace
+        with open(manager.config_file) as f:
+            if f.read() != original or any(n.endswith(".tmp") for n in os.listdir(test_dir)):
+                print("✗ 写入失败时破坏了配置文件或留下了临时文件")
+                return False
+        print("✓ 写入失败时原配置文件保持不变")
+
+        # 其他进程已写入用户库并记入日志, 但还没有渲染配置
+        store = manager.user_store()
+        others = [{"id": str(uuid.uuid4()), "alterId": 0} for _ in range(3)]
+        for client in others:
+            store.add(client)
+        Journal(manager.journal_file).append(
+            [{"op": "add", "uuid": c["id"], "email": None, "shard": None} for c in others])
+        saved = []
+        save_config = manager.save_config
+        manager.save_config = lambda config, shard=None: saved.append(shard) or save_config(config, shard)
+        user_id = manager.add_user("batch@example.com")
+        clients = [c["id"] for c in manager.load_config()["inbounds"][0]["settings"]["clients"]]
+        if saved != [None] or clients != [c["id"] for c in others] + [user_id] \
+                or Journal(manager.journal_file).pending() != ([], 0):
+            print(f"✗ 日志中的变更未批量渲染: 写入 {saved}, 用户 {len(clients)}")
+            return False
+        print("✓ 日志中其他进程的变更与本次变更一次写入")
+
+        code = ("import sys, contextlib; sys.path.insert(0, sys.argv[1]); from manage import V2rayManager\n"
+                "with contextlib.redirect_stdout(None):\n"
+                "    m = V2rayManager(sys.argv[2])\n"
+                "    ids = [m.add_user(f'p{i}@example.com') for i in range(5)]\n"
+                "    m.remove_user(ids[0])\n")
+        root = os.path.dirname(os.path.abspath(__file__))
+        processes = [subprocess.Popen([sys.executable, "-c", code, root, manager.config_file])
+                     for _ in range(6)]
+        if any(p.wait(60) != 0 for p in processes):
+            print("✗ 并发进程执行失败")
+            return False
+        clients = manager.load_config()["inbounds"][0]["settings"]["clients"]
+        if len(clients) != 4 + 6 * 4 or len({c["id"] for c in clients}) != len(clients) \
+                or manager.user_store().count() != len(clients):
+            print(f"✗ 并发修改丢失了更新: {len(clients)} 个用户")
+            return False
+        print("✓ 6个进程并发增删用户, 没有丢失更新")
+        return True
+
+    except Exception as e:
+        print(f"✗ 并发安全的配置写入测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_manage_daemon():
+    """测试管理守护进程: Unix socket上的JSON-RPC、合并写入和命令行转发"""
+    print("\n测试管理守护进程...")
+
+    test_dir = tempfile.mkdtemp()
+    loop = start_event_loop()
+
+    try:
+        config_file = os.path.join(test_dir, "config.json")
+        write_config(config_file, [])
+        socket_path = os.path.join(test_dir, "manage.sock")
+        daemon = ManageDaemon(V2rayManager(config_file), socket_path, flush_delay=0.3)
+        asyncio.run_coroutine_threadsafe(daemon.start(), loop).result(5)
+        saved = []
+        save_config = daemon.manager.save_config
+        daemon.manager.save_config = lambda config, shard=None: saved.append(shard) or save_config(config, shard)
+
+        def run(*argv):
+            args = build_parser().parse_args(list(argv) + ["--config", config_file, "--socket", socket_path])
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                handled = forward(args)
+            return handled, output.getvalue()
+
+        started = time.perf_counter()
+        outputs = [run("add-user", "--email", f"d{i}@example.com") for i in range(20)]
+        elapsed = (time.perf_counter() - started) / 20
+        if not all(handled and "用户添加成功" in text for handled, text in outputs):
+            print(f"✗ 守护进程未执行add-user: {outputs[0]}")
+            return False
+        print(f"✓ 通过守护进程添加用户 (平均 {elapsed * 1000:.2f}ms/次)")
+
+        handled, text = run("list-users")
+        clients = V2rayManager(config_file).load_config()["inbounds"][0]["settings"]["clients"]
+        if not handled or text.count("@example.com") != 20 or len(clients) != 20 or len(saved) > 2:
+            print(f"✗ 合并写入错误: 写入 {len(saved)} 次, 配置中 {len(clients)} 个用户")
+            return False
+        print(f"✓ 20次添加合并为 {len(saved)} 次配置写入, 读操作前写入待渲染的变更")
+
+        handled, text = run("config")
+        if not handled or len(json.loads(text)["inbounds"][0]["settings"]["clients"]) != 20:
+            print("✗ config操作结果错误")
+            return False
+
+        # 请求其他配置文件或不转发的操作时由命令行进程执行
+        args = build_parser().parse_args(["status", "--config", "/tmp/other.json", "--socket", socket_path])
+        if forward(args) or forward(build_parser().parse_args(["logs", "--socket", socket_path])):
+            print("✗ 不应转发给守护进程")
+            return False
+        try:
+            DaemonClient(socket_path).call("daemon", {"config": config_file})
+            print("✗ 未知操作未报错")
+            return False
+        except Exception as e:
+            if getattr(e, "code", None) != -32601:
+                raise
+        print("✓ 其他配置文件和本地操作不经过守护进程")
+
+        # 平滑重启等耗时的重启在另一个线程中执行, 不阻塞其他请求
+        reloads = []
+        def slow_reload(wait=True):
+            reloads.append(daemon.manager.reload_scheduler().take_due())
+            time.sleep(1)
+        daemon.manager.reload = slow_reload
+        daemon.manager.reload_window = 0
+        daemon.manager.reload_scheduler().request([None])
+        run("list-users")
+        time.sleep(0.1)
+        started = time.perf_counter()
+        handled, text = run("list-users")
+        elapsed = time.perf_counter() - started
+        if reloads != [[None]] or not handled or text.count("@example.com") != 20 or elapsed > 0.5:
+            print(f"✗ 重启阻塞了其他请求: {elapsed:.2f}s")
+            return False
+        print(f"✓ 执行重启期间其他请求照常处理 ({elapsed * 1000:.2f}ms)")
+
+        run("add-user", "--email", "last@example.com")
+        asyncio.run_coroutine_threadsafe(daemon.stop(), loop).result(5)
+        clients = V2rayManager(config_file).load_config()["inbounds"][0]["settings"]["clients"]
+        if len(clients) != 21 or os.path.exists(socket_path) or run("status")[0]:
+            print("✗ 停止时未写入待渲染的变更")
+            return False
+        print("✓ 停止时写入待渲染的变更并删除socket")
+        return True
+
+    except Exception as e:
+        print(f"✗ 管理守护进程测试失败: {e}")
+        return False
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def test_reload():
+    """测试重启请求的合并和平滑重启 (systemctl、systemd-run和v2ray由记录调用的脚本代替)"""
+    print("\n测试合并重启和平滑重启...")
+
+    test_dir = tempfile.mkdtemp()
+
+    try:
+        calls_file = os.path.join(test_dir, "calls")
+        failed_file = os.path.join(test_dir, "failed")
+        stubs = {}
+        for name in ("systemctl", "systemd-run", "v2ray"):
+            stubs[name] = os.path.join(test_dir, name)
+            with open(stubs[name], 'w') as f:
+                f.write(SERVICE_STUB.format(python=sys.executable, calls=calls_file, failed=failed_file))
+            os.chmod(stubs[name], 0o755)
+
+        config_file = os.path.join(test_dir, "config.json")
+        write_config(config_file, [])
+
+        def new_manager():
+            manager = V2rayManager(config_file)
+            manager.systemctl, manager.systemd_run = stubs["systemctl"], stubs["systemd-run"]
+            manager.v2ray_binary = stubs["v2ray"]
+            manager.reload_window, manager.health_wait, manager.overlap_time = 0.3, 0, 0
+            return manager
+
+        def take_calls():
+            if not os.path.exists(calls_file):
+                return []
+            with open(calls_file) as f:
+                calls = [json.loads(line) for line in f]
+            os.remove(calls_file)
+            return calls
+
+        # 窗口内的多次请求 (包括其他进程的请求) 推迟截止时间, 并发等待的进程中只有一个执行重启
+        started = time.perf_counter()
+        new_manager().schedule_restart([None])
+        time.sleep(0.2)
+        new_manager().schedule_restart([None])
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(new_manager().reload())) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        calls = take_calls()
+        if calls != [["systemctl", "restart", "v2ray"]] or results != [True] * 3 or elapsed < 0.5:
+            print(f"✗ 重启请求未合并: {calls}")
+            return False
+        print(f"✓ 两次请求、三个等待进程合并为一次重启 ({elapsed:.2f}s)")
+
+        manager = new_manager()
+        manager.zero_downtime = True
+        manager.schedule_restart([None])
+        manager.reload()
+        config = manager.load_config()
+        if take_calls() != [["systemctl", "restart", "v2ray"]] \
+                or config["inbounds"][0]["streamSettings"]["sockopt"] != {"reusePort": True} \
+                or not manager.set_profile("throughput") \
+                or manager.load_config()["inbounds"][0]["streamSettings"]["sockopt"].get("reusePort") is not True \
+                or detect_profile(manager.load_config()) != "throughput":
+            print("✗ 首次平滑重启未开启reusePort")
+            return False
+        print("✓ 首次平滑重启开启reusePort并普通重启, 切换性能配置时保留")
+
+        manager.schedule_restart([None])
+        manager.reload()
+        handover = os.path.join(test_dir, "handover.json")
+        expected = [
+            ["v2ray", "test", "-config", handover],
+            ["systemd-run", "--unit=v2ray-handover", "--collect", stubs["v2ray"], "run", "-config", handover],
+            ["systemctl", "is-active", "v2ray-handover"],
+            ["systemctl", "restart", "v2ray"],
+            ["systemctl", "is-active", "v2ray"],
+            ["systemctl", "stop", "v2ray-handover"],
+        ]
+        calls = take_calls()
+        if calls != expected or os.path.exists(handover):
+            print(f"✗ 平滑重启步骤错误: {calls}")
+            return False
+        print("✓ 临时实例健康后重启主服务, 再停止临时实例")
+
+        open(failed_file, 'w').close()
+        manager.schedule_restart([None])
+        manager.reload()
+        calls = take_calls()
+        if calls[-2:] != [["systemctl", "restart", "v2ray"], ["systemctl", "stop", "v2ray-handover"]] \
+                or ["systemctl", "is-active", "v2ray"] in calls:
+            print(f"✗ 临时实例失败时未改为普通重启: {calls}")
+            return False
+        print("✓ 临时实例启动失败时改为普通重启")
+
+        # 临时实例不监听api端口, 不开启统计
+        config = enable_stats(manager.load_config(), 10085)
+        config = handover_config(config, "/var/log/v2ray")
+        if [i.get("tag") for i in config["inbounds"]] != ["proxy"] or "api" in config or "stats" in config \
+                or any(r.get("outboundTag") == "api" for r in config["routing"]["rules"]) \
+                or config["log"]["error"] != "/var/log/v2ray/handover-error.log":
+            print("✗ 临时实例的配置错误")
+            return False
+        print("✓ 临时实例的配置不包含api和统计")
+        return True
+
+    except Exception as e:
+        print(f"✗ 合并重启和平滑重启测试失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+def main():
+    """运行所有测试"""
+    print("V2Ray管理工具功能测试")
+    print("=" * 40)
+
+    tests = [
+        test_subscription_server,
+        test_set_profile,
+        test_sharded_users,
+        test_stats,
+        test_user_store,
+        test_bulk_import,
+        test_hot_users,
+        test_concurrent_writes,
+        test_manage_daemon,
+        test_reload,
+    ]
+
+    passed = 0
+    total = len(tests)
+
+    for test in tests:
+        if test():
+            passed += 1
+
+    print("\n" + "=" * 40)
+    print(f"测试结果: {passed}/{total} 通过")
+
+    if passed == total:
+        print("✓ 所有测试通过！管理工具功能正常")
+        return True
+    else:
+        print("✗ 部分测试失败，请检查代码")
+        return False
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
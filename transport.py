@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 传输方式: 服务端入站和各客户端配置使用同一套设置
+# mux: 默认的多路复用并发数 (0表示关闭); grpc和h2本身支持多路复用, 不再开启mux
+# clients: 支持该传输方式的客户端配置
+TRANSPORTS = {
+    "tcp-http": {
+        "description": "TCP + HTTP伪装",
+        "mux": 0,
+        "clients": ["vmess", "clash", "v2rayng", "surge"],
+    },
+    "ws": {
+        "description": "WebSocket, 可经过CDN和反向代理",
+        "mux": 8,
+        "clients": ["vmess", "clash", "v2rayng", "surge"],
+    },
+    "grpc": {
+        "description": "gRPC, 单连接多路复用",
+        "mux": 0,
+        "clients": ["vmess", "clash", "v2rayng"],
+    },
+    "mkcp": {
+        "description": "mKCP (UDP), 适合丢包严重的移动网络",
+        "mux": 8,
+        "clients": ["vmess", "v2rayng"],
+    },
+    "h2": {
+        "description": "HTTP/2 (需要TLS)",
+        "mux": 0,
+        "clients": ["vmess", "clash", "v2rayng"],
+        "requires_tls": True,
+    },
+}
+
+DEFAULT_TRANSPORT = "tcp-http"
+
+# tcp-http传输的HTTP伪装头
+TCP_HTTP_SETTINGS = {
+    "header": {
+        "type": "http",
+        "request": {
+            "version": "1.1",
+            "method": "GET",
+            "path": ["/"],
+            "headers": {
+                "Host": ["www.cloudflare.com", "www.amazon.com"],
+                "User-Agent": [
+                    "Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/55.0.2883.75 Safari/537.36",
+                    "Mozilla/5.0 (iPhone; CPU iPhone OS 10_0_2 like Mac OS X) AppleWebKit/601.1 (KHTML, like Gecko) CriOS/53.0.2785.109 Mobile/14A456 Safari/601.1.46"
+                ],
+                "Accept-Encoding": ["gzip, deflate"],
+                "Connection": ["keep-alive"],
+                "Pragma": "no-cache"
+            }
+        }
+    }
+}
+
+# mKCP参数: 容量单位为MB/s, 缓冲单位为MB
+KCP_SETTINGS = {
+    "mtu": 1350,
+    "tti": 20,
+    "uplinkCapacity": 5,
+    "downlinkCapacity": 20,
+    "congestion": False,
+    "readBufferSize": 2,
+    "writeBufferSize": 2,
+    "header": {"type": "wechat-video"}
+}
+
+
+def get_transport(name):
+    """按名称获取传输方式, 名称未知时抛出ValueError"""
+    if name not in TRANSPORTS:
+        raise ValueError(f"未知的传输方式: {name} (可选: {', '.join(TRANSPORTS)})")
+    return TRANSPORTS[name]
+
+
+def detect_transport(stream):
+    """从服务端入站的streamSettings推断传输设置, 返回部署参数 (属性名 -> 值)"""
+    network = stream.get("network", "tcp")
+    if network == "ws":
+        settings = stream.get("wsSettings", {})
+        options = {"transport": "ws", "transport_path": settings.get("path", "/")}
+        host = settings.get("headers", {}).get("Host")
+    elif network == "grpc":
+        options = {"transport": "grpc",
+                   "grpc_service_name": stream.get("grpcSettings", {}).get("serviceName", "")}
+        host = None
+    elif network in ("kcp", "mkcp"):
+        options = {"transport": "mkcp", "kcp_seed": stream.get("kcpSettings", {}).get("seed")}
+        host = None
+    elif network in ("http", "h2"):
+        settings = stream.get("httpSettings", {})
+        options = {"transport": "h2", "transport_path": settings.get("path", "/")}
+        host = (settings.get("host") or [None])[0]
+    else:
+        options = {"transport": "tcp-http"}
+        host = None
+    # 服务端的TLS设置中没有域名, 只能从Host中取得
+    if stream.get("security") == "tls" and host:
+        options["tls_domain"] = host
+    return options
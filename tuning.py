@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 服务端性能配置: policy等级、sockopt和日志
+# policy: bufferSize单位为KB (0表示不使用内部缓冲), 其余为秒
+# default保持原有输出 (不设置policy和sockopt, 记录访问日志)
+PROFILES = {
+    "default": {
+        "description": "默认配置, 使用v2ray内置的超时和缓冲",
+        "policy": None,
+        "sockopt": None,
+        "access_log": True,
+        "loglevel": "warning",
+    },
+    "throughput": {
+        "description": "大缓冲区和BBR, 适合大流量下载",
+        "policy": {"handshake": 4, "connIdle": 300, "uplinkOnly": 2,
+                   "downlinkOnly": 5, "bufferSize": 512},
+        "sockopt": {"tcpFastOpen": True, "tcpKeepAliveInterval": 30,
+                    "tcpcongestion": "bbr"},
+        "access_log": False,
+        "loglevel": "warning",
+    },
+    "low-latency": {
+        "description": "小缓冲区、较短的握手和空闲超时, 适合交互式流量",
+        "policy": {"handshake": 2, "connIdle": 120, "uplinkOnly": 1,
+                   "downlinkOnly": 1, "bufferSize": 4},
+        "sockopt": {"tcpFastOpen": True, "tcpKeepAliveInterval": 15,
+                    "tcpcongestion": "bbr"},
+        "access_log": False,
+        "loglevel": "warning",
+    },
+    "low-memory": {
+        "description": "关闭内部缓冲并尽快回收空闲连接, 适合小内存机器",
+        "policy": {"handshake": 4, "connIdle": 60, "uplinkOnly": 1,
+                   "downlinkOnly": 1, "bufferSize": 0},
+        "sockopt": {"tcpFastOpen": False, "tcpKeepAliveInterval": 60,
+                    "tcpcongestion": "cubic"},
+        "access_log": False,
+        "loglevel": "error",
+    },
+}
+
+DEFAULT_PROFILE = "default"
+
+POLICY_FIELDS = ["handshake", "connIdle", "uplinkOnly", "downlinkOnly", "bufferSize"]
+LOG_LEVELS = ["debug", "info", "warning", "error", "none"]
+CONGESTION_CONTROLS = ["bbr", "cubic", "reno"]
+# 与性能配置无关的入站sockopt (平滑重启需要的reusePort), 切换和检查性能配置时保留
+LISTENER_SOCKOPT_FIELDS = ["reusePort"]
+
+
+def get_profile(name):
+    """按名称获取性能配置, 名称未知时抛出ValueError"""
+    if name not in PROFILES:
+        raise ValueError(f"未知的性能配置: {name} (可选: {', '.join(PROFILES)})")
+    return PROFILES[name]
+
+
+def tuned_inbounds(config):
+    """需要设置sockopt的入站 (不包括本机的api入站)"""
+    return [i for i in config.get("inbounds", []) if i.get("tag") != "api"]
+
+
+def tuned_outbounds(config):
+    """需要设置sockopt的出站 (freedom直连)"""
+    return [o for o in config.get("outbounds", []) if o.get("protocol") == "freedom"]
+
+
+def apply_profile(config, name, log_dir):
+    """将性能配置写入服务端配置 (原地修改), 返回config
+
+    切换配置时会移除上一个配置留下的policy和sockopt, policy中的其他设置 (如流量统计) 保持不变
+    """
+    profile = get_profile(name)
+
+    config["log"] = {
+        "access": f"{log_dir}/access.log" if profile["access_log"] else "none",
+        "error": f"{log_dir}/error.log",
+        "loglevel": profile["loglevel"]
+    }
+
+    policy = config.setdefault("policy", {})
+    levels = policy.setdefault("levels", {})
+    level = levels.setdefault("0", {})
+    for field in POLICY_FIELDS:
+        level.pop(field, None)
+    if profile["policy"]:
+        level.update(profile["policy"])
+    if not level:
+        del levels["0"]
+    if not levels:
+        del policy["levels"]
+    if not policy:
+        del config["policy"]
+
+    for inbound in tuned_inbounds(config):
+        stream = inbound.get("streamSettings", {})
+        sockopt = {k: v for k, v in stream.get("sockopt", {}).items() if k in LISTENER_SOCKOPT_FIELDS}
+        sockopt.update(profile["sockopt"] or {})
+        if sockopt:
+            inbound.setdefault("streamSettings", {})["sockopt"] = sockopt
+        elif "streamSettings" in inbound:
+            inbound["streamSettings"].pop("sockopt", None)
+
+    for outbound in tuned_outbounds(config):
+        if profile["sockopt"]:
+            outbound.setdefault("streamSettings", {})["sockopt"] = dict(profile["sockopt"])
+        elif "streamSettings" in outbound:
+            outbound["streamSettings"].pop("sockopt", None)
+            if not outbound["streamSettings"]:
+                del outbound["streamSettings"]
+
+    return config
+
+
+def validate_config(config, name):
+    """检查渲染结果是否符合性能配置, 不符合时抛出ValueError"""
+    profile = get_profile(name)
+    errors = []
+
+    log = config.get("log", {})
+    if log.get("loglevel") not in LOG_LEVELS:
+        errors.append(f"loglevel无效: {log.get('loglevel')}")
+    elif log.get("loglevel") != profile["loglevel"]:
+        errors.append(f"loglevel应为 {profile['loglevel']}")
+    if profile["access_log"] != (log.get("access", "none") != "none"):
+        errors.append("访问日志设置与性能配置不符")
+
+    level = config.get("policy", {}).get("levels", {}).get("0", {})
+    if profile["policy"]:
+        for field in POLICY_FIELDS:
+            value = level.get(field)
+            if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                errors.append(f"policy.{field} 必须是非负整数: {value!r}")
+            elif value != profile["policy"][field]:
+                errors.append(f"policy.{field} 应为 {profile['policy'][field]}")
+    elif any(field in level for field in POLICY_FIELDS):
+        errors.append("默认配置不应设置policy")
+
+    streams = [i.get("streamSettings", {}) for i in tuned_inbounds(config)]
+    streams += [o.get("streamSettings", {}) for o in tuned_outbounds(config)]
+    for stream in streams:
+        sockopt = {k: v for k, v in stream.get("sockopt", {}).items() if k not in LISTENER_SOCKOPT_FIELDS}
+        if not profile["sockopt"]:
+            if sockopt:
+                errors.append("默认配置不应设置sockopt")
+            continue
+        if sockopt != profile["sockopt"]:
+            errors.append(f"sockopt应为 {profile['sockopt']}")
+            continue
+        if not isinstance(sockopt["tcpFastOpen"], bool):
+            errors.append("sockopt.tcpFastOpen 必须是布尔值")
+        if not isinstance(sockopt["tcpKeepAliveInterval"], int) or sockopt["tcpKeepAliveInterval"] <= 0:
+            errors.append("sockopt.tcpKeepAliveInterval 必须是正整数")
+        if sockopt["tcpcongestion"] not in CONGESTION_CONTROLS:
+            errors.append(f"不支持的拥塞控制算法: {sockopt['tcpcongestion']}")
+
+    if errors:
+        raise ValueError(f"配置不符合性能配置 {name}: " + "; ".join(errors))
+    return True
+
+
+def detect_profile(config):
+    """返回与配置相符的性能配置名称, 都不相符时返回None"""
+    for name in PROFILES:
+        try:
+            validate_config(config, name)
+            return name
+        except ValueError:
+            continue
+    return None
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import csv
+import json
+import sqlite3
+import itertools
+
+# 用户库: 用户的唯一来源, config.json中的clients由它渲染
+# 按uuid (主键) 和email建索引, 增删查不需要解析和扫描整个配置文件
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    uuid TEXT PRIMARY KEY COLLATE NOCASE,
+    email TEXT,
+    alter_id INTEGER NOT NULL DEFAULT 0,
+    shard INTEGER,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS users_email ON users (email);
+CREATE INDEX IF NOT EXISTS users_shard ON users (shard);
+"""
+
+# 导入导出文件的字段; 导入时action为add (默认)、remove或update
+RECORD_FIELDS = ["action", "uuid", "email", "alterId"]
+RECORD_ACTIONS = ["add", "remove", "update"]
+RECORD_FORMATS = ["csv", "jsonl"]
+
+# clients中由单独列保存的字段, 其余字段 (level、security等) 以JSON保存在extra中
+CLIENT_FIELDS = {"id", "email", "alterId"}
+
+
+def client_row(client, shard=None):
+    """config.json中的client转为数据库行"""
+    extra = {k: v for k, v in client.items() if k not in CLIENT_FIELDS}
+    return (client["id"], client.get("email"), client.get("alterId", 0), shard,
+            json.dumps(extra, ensure_ascii=False) if extra else None)
+
+
+def row_client(row):
+    """数据库行 (uuid, email, alter_id, extra) 转为config.json中的client"""
+    user_id, email, alter_id, extra = row
+    client = {"id": user_id, "alterId": alter_id}
+    if email:
+        client["email"] = email
+    if extra:
+        client.update(json.loads(extra))
+    return client
+
+
+def record_format(path, fmt=None):
+    """导入导出文件的格式: 指定的格式, 或按扩展名判断 (默认jsonl)"""
+    if fmt:
+        if fmt not in RECORD_FORMATS:
+            raise ValueError(f"不支持的格式: {fmt} (可选: {', '.join(RECORD_FORMATS)})")
+        return fmt
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+
+def read_records(f, fmt):
+    """逐条读取导入文件, 返回 {action, uuid, email, alterId} 字典, 格式错误时抛出ValueError"""
+    rows = csv.DictReader(f) if fmt == "csv" else (json.loads(line) for line in f if line.strip())
+    for number, row in enumerate(rows, 1):
+        action = (row.get("action") or "add").strip().lower()
+        if action not in RECORD_ACTIONS:
+            raise ValueError(f"第 {number} 条记录的action无效: {action}")
+        alter_id = row.get("alterId")
+        record = {
+            "action": action,
+            "uuid": (row.get("uuid") or row.get("id") or "").strip() or None,
+            "email": (row.get("email") or "").strip() or None,
+            "alterId": int(alter_id) if alter_id not in (None, "") else None,
+        }
+        if action != "add" and not record["uuid"] and not record["email"]:
+            raise ValueError(f"第 {number} 条记录缺少uuid或email")
+        yield record
+
+
+def write_records(f, users, fmt):
+    """逐条写出 (所在实例, client), 返回写出的用户数"""
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(f)
+        writer.writerow(RECORD_FIELDS[1:])
+        for _, client in users:
+            writer.writerow([client["id"], client.get("email", ""), client.get("alterId", 0)])
+            count += 1
+    else:
+        for _, client in users:
+            f.write(json.dumps({"uuid": client["id"], "email": client.get("email"),
+                                "alterId": client.get("alterId", 0)}, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+class UserStore:
+    """SQLite用户库, 多实例部署时每个用户记录所在的实例 (单实例为NULL)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, client, shard=None):
+        """添加用户, UUID已存在时返回False"""
+        try:
+            with self.conn:
+                self.conn.execute("INSERT INTO users VALUES (?, ?, ?, ?, ?)", client_row(client, shard))
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    def remove(self, user_id):
+        """删除用户, 返回 (是否存在, 所在实例)"""
+        with self.conn:
+            row = self.conn.execute("SELECT shard FROM users WHERE uuid = ?", (user_id,)).fetchone()
+            if row is None:
+                return False, None
+            self.conn.execute("DELETE FROM users WHERE uuid = ?", (user_id,))
+        return True, row[0]
+
+    def get(self, user_id):
+        """按UUID查找用户, 返回 (所在实例, client), 不存在时返回None"""
+        row = self.conn.execute("SELECT shard, uuid, email, alter_id, extra FROM users WHERE uuid = ?",
+                                (user_id,)).fetchone()
+        return (row[0], row_client(row[1:])) if row else None
+
+    def find_email(self, email):
+        """按email查找用户, 返回client列表"""
+        rows = self.conn.execute("SELECT uuid, email, alter_id, extra FROM users WHERE email = ?",
+                                 (email,))
+        return [row_client(row) for row in rows]
+
+    def clients(self, shard=None):
+        """实例的所有用户 (按添加顺序), 用于渲染config.json"""
+        rows = self.conn.execute("SELECT uuid, email, alter_id, extra FROM users "
+                                 "WHERE shard IS ? ORDER BY rowid", (shard,))
+        return [row_client(row) for row in rows]
+
+    def users(self):
+        """所有用户, 返回 (所在实例, client) 列表"""
+        rows = self.conn.execute("SELECT shard, uuid, email, alter_id, extra FROM users "
+                                 "ORDER BY shard, rowid")
+        return [(row[0], row_client(row[1:])) for row in rows]
+
+    def iter_users(self):
+        """逐条返回所有用户 (所在实例, client), 不一次读入内存"""
+        rows = self.conn.execute("SELECT shard, uuid, email, alter_id, extra FROM users "
+                                 "ORDER BY shard, rowid")
+        for row in rows:
+            yield row[0], row_client(row[1:])
+
+    def index(self):
+        """所有用户的索引: 小写UUID -> (所在实例, email)"""
+        rows = self.conn.execute("SELECT uuid, shard, email FROM users")
+        return {user_id.lower(): (shard, email) for user_id, shard, email in rows}
+
+    def apply(self, ops):
+        """在一个事务中按顺序添加、删除和更新用户
+
+        ops为 ("add", client, 所在实例)、("remove", UUID) 或 ("update", UUID, email, alterId) 的列表,
+        更新时为None的字段保持不变; 连续的同类操作批量执行
+        """
+        statements = {
+            "add": ("INSERT INTO users VALUES (?, ?, ?, ?, ?)",
+                    lambda op: client_row(op[1], op[2])),
+            "remove": ("DELETE FROM users WHERE uuid = ?", lambda op: (op[1],)),
+            "update": ("UPDATE users SET email = COALESCE(?, email), "
+                       "alter_id = COALESCE(?, alter_id) WHERE uuid = ?", lambda op: (op[2], op[3], op[1])),
+        }
+        with self.conn:
+            for action, group in itertools.groupby(ops, key=lambda op: op[0]):
+                sql, params = statements[action]
+                self.conn.executemany(sql, (params(op) for op in group))
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def import_clients(self, clients, shard=None):
+        """导入config.json中的clients, 已存在的UUID跳过, 返回导入的用户数"""
+        before = self.conn.total_changes
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?, ?)",
+                                  (client_row(c, shard) for c in clients if c.get("id")))
+        return self.conn.total_changes - before